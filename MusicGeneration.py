@@ -1,20 +1,37 @@
 import random
-import fluidsynth
+import copy
 import math
 import numpy
-from pydub import AudioSegment
-from pyaudio import PyAudio
+from component_timer import ComponentTimer
+from midi import MidiSynth
+from quality import EVENT_RATE
 
+# fluidsynth renders blocks of this many samples, the notes sent in between start with the next block
+SYNTH_BLOCK = 64
 
 class Synth():
-	def __init__(self, samplerate=44100) -> None:
-		fs = fluidsynth.Synth(gain=2.0, samplerate=samplerate)
+	def __init__(self, samplerate=44100, channels=2, polyphony=256, effects=True) -> None:
+		"""
+		Args:
+			samplerate (int): The sample rate of the rendered audio.
+			channels (int): 2 for stereo, 1 to mix the synth's output down to mono.
+			polyphony (int): The number of voices that can sound at once.
+			effects (bool): Whether the reverb and chorus are rendered.
+		"""
+		# imported here so only the code that synthesizes pays for loading fluidsynth
+		import fluidsynth
+		fs = fluidsynth.Synth(gain=2.0, samplerate=samplerate, polyphony=polyphony,
+			**{"reverb.active": int(effects), "chorus.active": int(effects)})
+		self.channels = channels
 		# select instruments
 		soundfont_path = "ColomboGMGS2.sf2"
 		self.sfid = fs.sfload(soundfont_path)
 		assert self.sfid >= 0, f"Couldn't find soundfont (\"{soundfont_path}\")"
 
 		self.fs = fs
+		self.programs = {}
+		# the samples rendered so far, which decides where the notes start within the blocks
+		self.position = 0
 		# 2, 92 - good squarewave
 		# 0, 107 - koto
 		# 0, 40 - violin
@@ -23,6 +40,120 @@ class Synth():
 
 	def changeInstrument(self, channel:int, bank:int, instrument:int):
 		self.fs.program_select(channel, self.sfid, bank, instrument)
+		self.programs[channel] = (bank, instrument)
+
+	def noteon(self, channel:int, key:int, velocity:int):
+		self.fs.noteon(channel, key, velocity)
+
+	def noteoff(self, channel:int, key:int):
+		self.fs.noteoff(channel, key)
+
+	def set_tempo(self, bpm:float):
+		# the tempo only decides when the generators send notes, the synth has no use for it
+		pass
+
+	def get_samples(self, nsamples:int):
+		samples = self.fs.get_samples(nsamples)
+		self.position += nsamples
+		if self.channels == 1:
+			samples = samples.reshape(-1, 2).mean(axis=1)
+		return samples
+
+	def silence(self):
+		"""
+		Stops every voice at once, without its release, and clears the reverb and chorus tails.
+		"""
+		self.fs.system_reset()
+		# the reset also brings back the default instruments
+		for channel, (bank, instrument) in self.programs.items():
+			self.fs.program_select(channel, self.sfid, bank, instrument)
+
+	def align(self, position:int):
+		"""
+		Renders and drops samples until the synth is as far into its blocks as a render started after
+		reset() that reached the sample position, so the notes that follow start on the same samples.
+		"""
+		padding = (position - self.position) % SYNTH_BLOCK
+		if padding:
+			self.fs.get_samples(padding)
+			self.position += padding
+
+	def reset(self):
+		"""
+		Restores the initial instruments, keeping the loaded soundfont.
+		"""
+		self.changeInstrument(0, 17, 89)
+		self.changeInstrument(1, 0, 104)
+
+	def close(self):
+		self.fs.delete()
+
+class SynthControl():
+	"""
+	Sits between the parameter mapping and the synth, so the mapping can state the instruments and
+	generator parameters it wants as often as it likes.
+
+	Requests are held until the next event boundary, when the generators are about to play notes.
+	A later request for the same setting replaces the held one (merged) and requests matching the
+	current state are never sent (dropped). Instruments only apply to the notes started after the
+	change, so deferring them to the next note doesn't change the sound.
+	"""
+	def __init__(self, synth) -> None:
+		self.synth = synth
+		self.pending = {}
+		self.counts = {"requested": 0, "issued": 0, "dropped": 0, "merged": 0, "batches": 0}
+
+	def reset(self):
+		self.pending.clear()
+		for name in self.counts:
+			self.counts[name] = 0
+
+	def discard(self):
+		self.pending.clear()
+
+	def changeInstrument(self, channel:int, bank:int, instrument:int):
+		self.request(("program", channel), (bank, instrument))
+
+	def set(self, generator, name:str, value):
+		"""
+		Sets a parameter of a generator, e.g. set(music.chords, "volume", 0.5).
+		"""
+		self.request((generator, name), value)
+
+	def request(self, key:tuple, value):
+		self.counts["requested"] += 1
+		if key in self.pending:
+			self.counts["merged"] += 1
+		self.pending[key] = value
+
+	def current(self, key:tuple):
+		if key[0] == "program":
+			return self.synth.programs.get(key[1])
+		return getattr(key[0], key[1])
+
+	def flush(self):
+		"""
+		Applies the held requests that change something, as one batch.
+		"""
+		if not self.pending:
+			return
+		issued = 0
+		for key, value in self.pending.items():
+			if self.current(key) == value:
+				self.counts["dropped"] += 1
+			elif key[0] == "program":
+				self.synth.changeInstrument(key[1], *value)
+				issued += 1
+			else:
+				setattr(key[0], key[1], value)
+				issued += 1
+		self.pending.clear()
+		self.counts["issued"] += issued
+		self.counts["batches"] += issued > 0
+
+	def stats(self) -> dict:
+		return dict(self.counts)
+
 
 class MusicGenerator():
 	# scales are defined in semitones
@@ -42,10 +173,35 @@ class MusicGenerator():
 		"power": [1,5,8,12]
 	}
 
-	def __init__(self, samplerate=44100, live=True) -> None:
+	def __init__(self, samplerate=44100, live=True, timer:ComponentTimer = None, midi=False, channels=2, polyphony=256,
+			effects=True, seed=0) -> None:
+		"""
+		The notes are timed on an event clock of EVENT_RATE samples per second whatever the output
+		sample rate, so the same properties give the same notes at every render quality. samplerate
+		is the event clock, get_samples() takes a number of event samples and returns the audio
+		covering the same time at output_rate.
+
+		Args:
+			samplerate (int): The sample rate of the generated audio.
+			live (bool): Whether the synth plays to the audio device.
+			timer (ComponentTimer): Timer for the generators and the rendering, none are timed if not given.
+			midi (bool): Record the notes as MIDI events instead of rendering audio. get_samples() then
+				returns no samples and the events are saved with synth.save().
+			channels, polyphony, effects: The synth settings, see Synth.
+			seed: Seeds the random choices of the generators, so the same properties always give the
+				same music. None for different music on every run. Applied again by reset().
+		"""
 		scale = "maj"
-		self.samplerate = samplerate
-		self.synth = Synth(samplerate)
+		self.samplerate = EVENT_RATE
+		self.output_rate = EVENT_RATE if midi else samplerate
+		self.channels = channels
+		self.synth_settings = {"polyphony": polyphony, "effects": effects}
+		self.clock = 0
+		self.rendered = 0
+		self.seed = seed
+		self.timer = timer if timer else ComponentTimer(enabled=False)
+		self.synth = MidiSynth(EVENT_RATE) if midi else Synth(samplerate, channels, polyphony, effects)
+		self.control = SynthControl(self.synth)
 		if live:
 			self.synth.start()
 		self.melody = MelodyGenerator(self, self.scales[scale])
@@ -58,6 +214,97 @@ class MusicGenerator():
 		self.energy_avg = 0
 		self.tasks = []
 
+	def reset(self):
+		"""
+		Brings the generator back to its initial musical state so it can be reused for another video.
+		"""
+		self.melody.restart()
+		self.chords.restart()
+		self.synth.silence()
+		self.synth.reset()
+		# every render starts on a block, so the same notes give the same samples after earlier renders
+		self.synth.align(0)
+		self.control.reset()
+		self.melody = MelodyGenerator(self, self.scales["maj"])
+		self.chords = ChordGenerator(self, self.scales["maj"])
+		self.bpm = 120
+		self.do_restart = False
+		self.do_stop = False
+		self.energy_avg = 0
+		self.clock = 0
+		self.rendered = 0
+
+	def generator_seed(self, name:str):
+		# every generator draws its own sequence, so adding draws to one doesn't change the other
+		return None if self.seed is None else f"{self.seed}:{name}"
+
+	def close(self):
+		"""
+		Frees the synth and its soundfont.
+		"""
+		self.synth.close()
+
+	def restart(self):
+		"""
+		Stops the playing notes and starts new ones on the next samples.
+		"""
+		self.melody.restart()
+		self.chords.restart()
+		self.do_restart = False
+
+	def output_position(self, clock:int) -> int:
+		"""
+		Return:
+			The output sample at which the event clock is at clock, counted from reset().
+		"""
+		return clock * self.output_rate // self.samplerate
+
+	def align(self, clock:int):
+		"""
+		Brings the synth to where a render from reset() is at the event clock, see Synth.align().
+		Whatever sounds is rendered and dropped, call it before set_state() to continue a render there.
+		"""
+		self.synth.align(self.output_position(clock))
+
+	def get_state(self) -> dict:
+		"""
+		Return:
+			A JSON serializable snapshot of the musical state: tempo, instruments, and the state of
+			the generators including their random number generators and the notes they hold.
+		"""
+		# held changes are applied first, they make no difference before the next notes
+		self.control.flush()
+		return {
+			"bpm": self.bpm,
+			"do_restart": self.do_restart,
+			# only the position within the second decides how output samples are rounded
+			"clock": self.clock % self.samplerate,
+			"programs": {str(channel): list(program) for channel, program in self.synth.programs.items()},
+			"melody": self.melody.get_state(),
+			"chords": self.chords.get_state(),
+		}
+
+	def set_state(self, state:dict):
+		"""
+		Continues from a snapshot taken with get_state(). The synth is silenced first, the release
+		and effect tails of earlier notes end there, then the notes held in the snapshot are started
+		again. What follows is the same whatever was sounding before.
+		"""
+		self.restart()
+		self.synth.silence()
+		self.control.discard()
+		self.bpm = state["bpm"]
+		self.do_restart = state["do_restart"]
+		self.synth.set_tempo(self.bpm)
+		self.clock = state["clock"]
+		self.rendered = self.clock * self.output_rate // self.samplerate
+		for channel, (bank, instrument) in state["programs"].items():
+			self.synth.changeInstrument(int(channel), bank, instrument)
+		self.melody.set_state(state["melody"])
+		self.chords.set_state(state["chords"])
+		self.melody.resume()
+		self.chords.resume()
+
 	def update_melody(self):
 		"""
 		Called by the scheduler to change the melody note. The next update_melody() call is scheduled.
@@ -84,6 +331,7 @@ class MusicGenerator():
 	def setBPM(self, bpm):
 		self.do_restart = True
 		self.bpm = bpm
+		self.synth.set_tempo(bpm)
 	
 	def setScale(self, scale:str):
 		self.melody.scale = self.scales[scale]
@@ -99,10 +347,14 @@ class MusicGenerator():
 		samples = []
 		run = True
 		while(run):
+			self.timer.start("generators")
+			if self.melody.next_change_samples == 0 or self.chords.next_change_samples == 0:
+				self.control.flush()
 			if self.melody.next_change_samples == 0:
 				self.update_melody()
 			if self.chords.next_change_samples == 0:
 				self.update_chords()
+			self.timer.time("generators")
 			
 			next_change = min(self.melody.next_change_samples, self.chords.next_change_samples)
 
@@ -115,15 +367,37 @@ class MusicGenerator():
 			self.melody.next_change_samples -= batchsize
 			self.chords.next_change_samples -= batchsize
 			samples_done += batchsize
-			new_samples = self.synth.fs.get_samples(batchsize)
+			self.timer.start("render")
+			# rendered up to the output sample of the event clock, so the two never drift apart
+			self.clock += batchsize
+			frames = self.clock * self.output_rate // self.samplerate - self.rendered
+			self.rendered += frames
+			new_samples = self.synth.get_samples(frames)
+			self.timer.time("render")
 			samples = numpy.append(samples, new_samples)
 		
-		return fluidsynth.raw_audio_string(samples)
+		return numpy.asarray(samples, dtype=numpy.int16).tobytes()
+
+
+def get_generator_state(generator, attributes:tuple) -> dict:
+	state = {name: copy.copy(getattr(generator, name)) for name in attributes}
+	version, internal, gauss = generator.rnd.getstate()
+	state["rnd"] = [version, list(internal), gauss]
+	return state
+
+
+def set_generator_state(generator, attributes:tuple, state:dict):
+	for name in attributes:
+		setattr(generator, name, copy.copy(state[name]))
+	version, internal, gauss = state["rnd"]
+	generator.rnd.setstate((version, tuple(internal), gauss))
 
 
 class MelodyGenerator():
+	STATE = ("scale", "subdivision_rate", "rest_rate", "transposition", "volume", "next_change_samples", "note_midi", "playing")
+
 	def __init__(self, mg:MusicGenerator, scale) -> None:
-		self.rnd:random.Random = random.Random()
+		self.rnd:random.Random = random.Random(mg.generator_seed("melody"))
 		self.mg = mg
 		self.scale = scale
 		self.subdivision_rate = 0.0
@@ -132,10 +406,12 @@ class MelodyGenerator():
 		self.volume = 0.5
 		self.next_change_samples = 0
 		self.note_midi = 0
+		self.playing = False
 	
 	def next(self):
 		# disable preveously playing note
-		self.mg.synth.fs.noteoff(self.mg.channel["melody"], self.note_midi)
+		self.mg.synth.noteoff(self.mg.channel["melody"], self.note_midi)
+		self.playing = False
 
 		#calculate speed
 		musical_duration = 1.0
@@ -158,15 +434,31 @@ class MelodyGenerator():
 			self.note_midi = self.mg.note_from_scale(self.scale, note)
 			velocity = math.floor(self.volume * 127)
 
-			self.mg.synth.fs.noteon(self.mg.channel["melody"], self.note_midi, velocity)
+			self.mg.synth.noteon(self.mg.channel["melody"], self.note_midi, velocity)
+			self.playing = True
 	
 	def restart(self):
+		self.mg.synth.noteoff(self.mg.channel["melody"], self.note_midi)
+		self.playing = False
 		self.next_change_samples = 0
 
+	def get_state(self) -> dict:
+		return get_generator_state(self, MelodyGenerator.STATE)
+
+	def set_state(self, state:dict):
+		set_generator_state(self, MelodyGenerator.STATE, state)
+
+	def resume(self):
+		if self.playing:
+			self.mg.synth.noteon(self.mg.channel["melody"], self.note_midi, math.floor(self.volume * 127))
+
 
 class ChordGenerator():
+	STATE = ("transposition", "scale", "chord_type", "arpeggio_freq", "beats_per_chord", "volume", "notes_playing",
+		"notes_to_arpeggiate", "current_arpeggio_note", "arpeggio_note_duration", "next_change_samples")
+
 	def __init__(self, mg:MusicGenerator, scale) -> None:
-		self.rnd:random.Random = random.Random()
+		self.rnd:random.Random = random.Random(mg.generator_seed("chords"))
 		self.mg = mg
 		self.transposition = 0
 		self.scale = scale
@@ -183,7 +475,7 @@ class ChordGenerator():
 	def next(self):
 		# disable preveously playing notes
 		for note in self.notes_playing:
-			self.mg.synth.fs.noteoff(self.mg.channel["chords"], note)
+			self.mg.synth.noteoff(self.mg.channel["chords"], note)
 		self.notes_playing.clear()
 
 		#calculate pitches
@@ -203,7 +495,7 @@ class ChordGenerator():
 
 		if self.notes_to_arpeggiate:
 			midi_note = self.notes_to_arpeggiate[self.current_arpeggio_note]
-			self.mg.synth.fs.noteon(self.mg.channel["chords"], midi_note, velocity)
+			self.mg.synth.noteon(self.mg.channel["chords"], midi_note, velocity)
 			self.notes_playing.append(midi_note)
 			self.next_change_samples = int(self.arpeggio_note_duration * self.mg.samplerate)
 			self.current_arpeggio_note += 1
@@ -214,18 +506,28 @@ class ChordGenerator():
 			self.next_change_samples = int(duration * self.mg.samplerate)
 			for note in self.chord_type:
 				midi_note = self.mg.note_from_scale(self.scale, note-1 + mode)
-				self.mg.synth.fs.noteon(self.mg.channel["chords"], midi_note, velocity)
+				self.mg.synth.noteon(self.mg.channel["chords"], midi_note, velocity)
 				self.notes_playing.append(midi_note)
 			
 	
 	def restart(self):
 		for note in self.notes_playing:
-			self.mg.synth.fs.noteoff(self.mg.channel["chords"], note)
+			self.mg.synth.noteoff(self.mg.channel["chords"], note)
 		self.notes_playing.clear()
 		self.notes_to_arpeggiate.clear()
 		self.current_arpeggio_note = 0
 		self.arpeggio_note_duration = 0
 		self.next_change_samples = 0
+
+	def get_state(self) -> dict:
+		return get_generator_state(self, ChordGenerator.STATE)
+
+	def set_state(self, state:dict):
+		set_generator_state(self, ChordGenerator.STATE, state)
+
+	def resume(self):
+		for note in self.notes_playing:
+			self.mg.synth.noteon(self.mg.channel["chords"], note, math.floor(self.volume * 127))
 	
 	def calculate_note_midi(self, r):
 		scale_len = len(self.scale)
@@ -236,6 +538,9 @@ class ChordGenerator():
 		return note_midi
 
 if __name__ == "__main__":
+	from pydub import AudioSegment
+	from pyaudio import PyAudio
+
 	def play_audio(samples, sample_rate):
 		p = PyAudio()
 		stream = p.open(format=p.get_format_from_width(2),
@@ -1,12 +1,12 @@
-from threading import Thread
-from video_properties_2 import VideoPropertiesExtractor, ComponentTimer
+from video_properties_2 import VideoPropertiesExtractor
+from component_timer import ComponentTimer
 from MusicGeneration import MusicGenerator
-import sched
+from midi import MidiSynth
+from quality import quality_settings
+from mapping import MappingProfile
+from resources import ResourceMonitor
+from timeline import CHANNELS
 import numpy as np
-import time
-
-from pyaudio import PyAudio
-from pydub import AudioSegment
 
 
 
@@ -41,15 +41,41 @@ class Atmosvideo():
 	ERROR = 3
 	CANCELED = 4
 
-	def __init__(self, sample_rate=44100, live=True):
+	def __init__(self, sample_rate=None, live=True, music:MusicGenerator = None, timing=True, trace=False, midi=False,
+			quality="final", seed=0, profile="default", resources=False):
 		"""
 		Creates an atmosvideo object and initializes its components.
+
+		Args:
+			sample_rate (int): The sample rate of the generated audio, by default the one of the quality.
+			live (bool): Whether the synth plays to the audio device.
+			music (MusicGenerator): An already initialized generator to reuse, so the soundfont is only loaded once.
+			timing (bool): Whether the stages of every component are timed.
+			trace (bool): Whether every timed span is kept, to be exported with timer.export_chrome_trace.
+			midi (bool): Record the music as MIDI events instead of rendering it, see save_midi().
+			quality (str): The render tier out of quality.QUALITIES, "draft" for quick previews.
+				It picks the synth settings and the analysis height.
+			seed: The seed of the music generator, see MusicGenerator. Ignored when music is given.
+			profile: The mapping from the video properties to the music: the name of a built-in
+				profile, the path of a JSON profile or a profile dictionary, see mapping.py.
+			resources (bool): Whether the CPU time, memory and I/O of every run are recorded per stage,
+				see ResourceMonitor. A run starts with load() and its report is returned by resources.stop().
 		"""
-		self.music = MusicGenerator(sample_rate, live)
-		self.video = VideoPropertiesExtractor(180)
-		self.timer = ComponentTimer()
+		settings = quality_settings(quality, sample_rate)
+		self.quality = quality
+		self.profile = MappingProfile(profile)
+		self.timer = ComponentTimer(enabled=timing, trace=trace)
+		self.music = music if music else MusicGenerator(settings["sample_rate"], live, midi=midi, channels=settings["channels"],
+			polyphony=settings["polyphony"], effects=settings["effects"], seed=seed)
+		self.music.timer = self.timer
+		self.resources = ResourceMonitor() if resources else None
+		self.timer.monitor = self.resources
+		self.video = VideoPropertiesExtractor(settings["analysis_height"], self.timer)
+		# set to an AnalysisGovernor to keep the analysis of every frame within a deadline
+		self.governor = None
 		self.status = Atmosvideo.DISCONNECTED
-		self.properties = (Property(), Property(), Property(), Property())
+		self.properties = tuple(Property() for _ in CHANNELS)
+		self.i_frame = 0
 	
 	def load(self, video_path:str):
 		"""
@@ -58,43 +84,234 @@ class Atmosvideo():
 		Args:
 			video_path (str): The path to the video stream.
 		"""
-		self.i_frame = 0
+		self.timer.reset()
+		if self.resources:
+			self.resources.start()
+		self.reset()
 		self.video.load(video_path)
+		if self.video.status == VideoPropertiesExtractor.ERROR:
+			self.status = Atmosvideo.ERROR
+			return
 		self.frame_time = 1/self.video.fps
 		self.timer.start("atmosvideo")
 		self.status = Atmosvideo.RUNNING
+
+	def load_stream(self, grabber:"FrameGrabber"):
+		"""
+		Loads atmosvideo with a live source read by a started FrameGrabber, see live_input.py.
+		"""
+		self.timer.reset()
+		if self.resources:
+			self.resources.start()
+		self.reset()
+		self.video.load_stream(grabber)
+		if self.video.status != VideoPropertiesExtractor.RUNNING:
+			self.status = Atmosvideo.ERROR
+			return
+		self.frame_time = 1/self.video.fps
+		self.timer.start("atmosvideo")
+		self.status = Atmosvideo.RUNNING
+
+	def reset(self):
+		"""
+		Brings the parameter mapping and the music back to their initial state.
+		"""
+		self.i_frame = 0
+		self.properties = tuple(Property() for _ in CHANNELS)
+		self.music.reset()
 		self.force_update = True
 		self.force_last_sample = 0
 		self.samples_done = 0
 	
-	def start(self):
+	def start(self, sink=None):
+		"""
+		Analyses the loaded video until it ends, generating the music frame by frame.
+
+		Args:
+			sink: Optional callable that receives every chunk of samples as soon as it is generated,
+				e.g. AudioMuxer.write. When given the samples are not kept in memory.
+
+		Return:
+			The whole soundtrack as bytes, or None when a sink is given.
+		"""
 		nsamples_frame = round(self.music.samplerate/self.video.fps)
 		print("samples per frame", nsamples_frame)
-		samples = bytearray()
+		samples = bytearray() if sink is None else None
 		while(self.status == Atmosvideo.RUNNING):
-			self.frame()
-			self.update_parameters(self.video.values)
-			samples.extend(self.music.get_samples(nsamples_frame))
-			self.samples_done += nsamples_frame
+			chunk = self.process_frame(nsamples_frame)
+			if sink is None:
+				samples.extend(chunk)
+			else:
+				self.timer.start("mux")
+				sink(chunk)
+				self.timer.time("mux")
 		
+		# the video isn't needed anymore, even if more work follows (e.g. muxing)
+		self.video.release()
 		print("samples done: " + str(self.samples_done))
+		if sink is not None or self.status == Atmosvideo.CANCELED:
+			return None
 		return bytes(samples)
 
+	def render(self, values, fps:float, sink=None):
+		"""
+		Generates the music of an already analysed video from its property timeline, e.g. from the
+		feature cache, without opening the video. Can be canceled like start().
+
+		Args:
+			values: The (frames, channels) timeline, see timeline.CHANNELS, an array or a Timeline.
+			fps (float): The frame rate of the timeline.
+			sink: Optional callable that receives every chunk of samples, as in start().
+
+		Return:
+			The whole soundtrack as bytes, or None when a sink is given.
+		"""
+		self.timer.reset()
+		if self.resources:
+			self.resources.start()
+		self.reset()
+		self.status = Atmosvideo.RUNNING
+		nsamples_frame = round(self.music.samplerate / fps)
+		samples = bytearray() if sink is None else None
+		for row in values:
+			if self.status != Atmosvideo.RUNNING:
+				break
+			self.i_frame += 1
+			chunk = self.synthesize(tuple(float(x) for x in row), nsamples_frame)
+			if sink is None:
+				samples.extend(chunk)
+			else:
+				self.timer.start("mux")
+				sink(chunk)
+				self.timer.time("mux")
+		if self.status == Atmosvideo.RUNNING:
+			self.status = Atmosvideo.FINISHED
+		if sink is not None or self.status == Atmosvideo.CANCELED:
+			return None
+		return bytes(samples)
+
+	def process_frame(self, nsamples:int) -> bytes:
+		"""
+		Analyses the next frame and generates the samples that play along with it.
+		"""
+		self.timer.start("analysis")
+		self.frame()
+		self.timer.time("analysis")
+		return self.synthesize(self.video.values, nsamples)
+
+	def synthesize(self, values:tuple, nsamples:int) -> bytes:
+		"""
+		Generates the samples of a frame from its already extracted values, see timeline.CHANNELS.
+		"""
+		self.timer.start("synthesis")
+		self.update_parameters(values)
+		chunk = self.music.get_samples(nsamples)
+		self.samples_done += nsamples
+		self.timer.time("synthesis")
+		return chunk
+
+	def render_config(self) -> dict:
+		"""
+		Return:
+			Everything besides the property timeline that decides the rendered output: the mapping,
+			the seed, the output format and the synth settings.
+		"""
+		return {
+			# any change of the profile invalidates cached renders
+			"mapping": self.profile.hash,
+			"seed": self.music.seed,
+			"sample_rate": self.music.output_rate,
+			"channels": self.music.channels,
+			"synth": self.music.synth_settings,
+			"midi": isinstance(self.music.synth, MidiSynth),
+		}
+
+	def save_midi(self, path:str):
+		"""
+		Writes the music generated since load() as a Standard MIDI File aligned to the video.
+		Only available when the music is recorded as MIDI.
+		"""
+		if not isinstance(self.music.synth, MidiSynth):
+			raise RuntimeError("The music is rendered as audio, create Atmosvideo with midi=True to save it as MIDI")
+		self.music.synth.save(path)
+
+	def get_state(self) -> dict:
+		"""
+		Return:
+			A JSON serializable snapshot of everything that decides the music from here on:
+			the recent properties, when the parameters were last updated and the music state.
+		"""
+		return {
+			"properties": [{
+				"values": [None if v is None else float(v) for v in p.buffer.values],
+				"id": p.buffer.id,
+				"full": p.buffer.full,
+				"last_value": float(p.last_value),
+			} for p in self.properties],
+			"force_update": self.force_update,
+			"samples_since_update": self.samples_done - self.force_last_sample,
+			"music": self.music.get_state(),
+		}
+
+	def set_state(self, state:dict):
+		"""
+		Continues from a snapshot taken with get_state().
+		"""
+		for p, saved in zip(self.properties, state["properties"]):
+			p.buffer.values = list(saved["values"])
+			p.buffer.id = saved["id"]
+			p.buffer.full = saved["full"]
+			p.last_value = saved["last_value"]
+		self.force_update = state["force_update"]
+		self.force_last_sample = self.samples_done - state["samples_since_update"]
+		self.music.set_state(state["music"])
+
+	def seek(self, frame:int):
+		"""
+		Continues the analysis from another frame. The property history is dropped and the
+		playing notes are stopped, the rest of the musical state carries on.
+		"""
+		self.video.seek(frame)
+		if self.video.status != VideoPropertiesExtractor.RUNNING:
+			self.status = Atmosvideo.FINISHED
+			return
+		self.i_frame = frame
+		self.properties = tuple(Property() for _ in CHANNELS)
+		self.force_update = True
+		self.music.restart()
+		self.status = Atmosvideo.RUNNING
+
+	def cancel(self):
+		"""
+		Stops a running start() after the frame being processed. Can be called from any thread.
+		"""
+		if self.status == Atmosvideo.RUNNING:
+			self.status = Atmosvideo.CANCELED
+
+	def close(self):
+		"""
+		Releases the video and the synth. The object can't be used afterwards.
+		"""
+		self.video.release()
+		self.music.close()
+
 	def frame(self):
 		self.i_frame += 1
-		running = self.video.step()
-		e, h, s, v = self.video.values
+		running = self.governor.step() if self.governor else self.video.step()
+		e, h, s, v = self.video.values[:4]
 		#print("Frame {:5d}: Energy: {:.3f}, Hue: {:.3f}, Saturation: {:.3f}, Value: {:.3f}".format(self.i_frame, e, h, s, v))
-		if not running:
+		if not running and self.status == Atmosvideo.RUNNING:
 			self.timer.time("atmosvideo")
-			print(f"Took {self.timer.get('atmosvideo')/1_000_000_000.0} seconds")
+			if "atmosvideo" in self.timer.get_all_components():
+				print(f"Took {self.timer.get('atmosvideo')/1_000_000_000.0} seconds")
 			self.status = Atmosvideo.FINISHED
 	
 
 
 	def update_parameters(self, parameters):
-		for i in range(4):
-			self.properties[i].buffer.write(parameters[i])
+		# the values of the channels in timeline.CHANNELS, a timeline without the motion channels leaves them unset
+		for prop, parameter in zip(self.properties, parameters):
+			prop.buffer.write(parameter)
 
 		if not self.properties[0].buffer.full:
 			return
@@ -107,9 +324,11 @@ class Atmosvideo():
 
 
 	def maybe_set_parameters(self, distinction):
-		new_parameters = [None] * 4
-		avg_parameters = [None] * 4
-		for i in range(4):
+		new_parameters = [None] * len(self.properties)
+		avg_parameters = [None] * len(self.properties)
+		for i in range(len(self.properties)):
+			if not self.properties[i].buffer.full:
+				continue
 			avg_parameters[i] = np.mean(self.properties[i].buffer.values)
 			if abs(self.properties[i].last_value - avg_parameters[i]) > distinction:
 				new_parameters[i] = avg_parameters[i]
@@ -119,7 +338,7 @@ class Atmosvideo():
 
 	def set_parameters(self, parameters):
 		self.force_last_sample = self.samples_done
-		for i in range(4):
+		for i in range(len(self.properties)):
 			if parameters[i]:
 				self.properties[i].last_value = parameters[i]
 
@@ -127,137 +346,20 @@ class Atmosvideo():
 		#	if parameters[i] == None:
 		#		parameters[i] = -float('inf')
 		#print("Update Generators:\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}".format(parameters[0], parameters[1], parameters[2], parameters[3]))
-		self.update_generators(parameters[0], parameters[1], parameters[2], parameters[3])
-
+		self.update_generators(parameters)
 
 
-	# all video parameters normalized [0,1]
-	def update_generators(self, energy_p, hue_p, saturation_p, value_p):
-		#print(new_energy, hue, saturation, value)
 
-		energy = energy_p if energy_p else self.properties[0].last_value
-		hue = hue_p if hue_p else self.properties[1].last_value
-		saturation = saturation_p if saturation_p else self.properties[2].last_value
-		value = value_p if value_p else self.properties[3].last_value
+	# all video parameters normalized [0,1], in the order of timeline.CHANNELS
+	def update_generators(self, parameters):
+		self.profile.apply(self.music, tuple(parameters), tuple(p.last_value for p in self.properties))
 
-		# tempo
-		if energy_p:
-			new_bpm = energy * 110 + 50
-			old_bpm = self.music.bpm
-			if abs(new_bpm - old_bpm) > old_bpm*0.2:
-				#print("changing_bpm", new_bpm)
-				self.music.setBPM(new_bpm)
-				pass
-			
-			#self.music.melody.base_subdivision = energy
-		
-		# transposition
-		if value_p:
-			self.music.melody.transposition = value*3 - 1
-			self.music.chords.transposition = 2*value-1 * (-1 if value<0.5 else 1)
-
-		# melody parameters
-		if saturation_p or energy_p or value_p:
-			self.music.melody.rest_rate = 0.2
-			#self.music.melody.subdivision_rate = saturation*0.5 if energy+value > 0.6 else 0
-			#self.music.melody.subdivision_rate = saturation*0.5 if energy+value > 0.6 else 0
-
-		# scale
-		if hue_p:
-			if hue < 0.5/6 or hue > 5.5/6:
-				scale_name = "japanese"
-			elif hue < 1.5/6:
-				scale_name = "maj_pentatonic"
-			elif hue < 2.5/6:
-				scale_name = "maj"
-			elif hue < 3.5/6:
-				scale_name = "min_pentatonic"
-			elif hue < 4.5/6:
-				scale_name = "min"
-			else:
-				scale_name = "hmin"
-			self.music.melody.scale = MusicGenerator.scales[scale_name]
-			self.music.chords.scale = MusicGenerator.scales[scale_name]
-
-		# chord type
-		if saturation_p or energy_p:
-			chord_value = 0.5*(saturation) + 0.5*(1-energy)
-			if chord_value < 1/3:
-				self.music.chords.chord_type = MusicGenerator.chord_types["power"]
-			if chord_value < 2/3:
-				self.music.chords.chord_type = MusicGenerator.chord_types["triad"]
-			else:
-				self.music.chords.chord_type = MusicGenerator.chord_types["seven"]
-		
-		# arpegios
-		# modified by instrument
-
-		# chord speed
-		self.music.chords.beats_per_chord = 4.0
-
-		# instrument selection
-		# 
-		# the volume is adjusted based on the instrument to keep the volume leveled
-		if value_p or energy_p:
-			#print("actual energy", energy)
-			if value < 1/3:
-				if energy < 1/6:
-					self.music.synth.changeInstrument(self.music.channel["chords"],17, 89) # pad
-					self.music.synth.changeInstrument(self.music.channel["melody"], 0,104) # sitar
-					self.music.chords.arpeggio_freq = 0
-					self.music.chords.volume = 0.7
-					self.music.melody.volume = 0.5
-				elif energy < 1/2:
-					self.music.synth.changeInstrument(self.music.channel["chords"], 2, 92) # square
-					self.music.synth.changeInstrument(self.music.channel["melody"], 2, 92) # square
-					self.music.chords.arpeggio_freq = 0
-					self.music.chords.volume = 0.5
-					self.music.melody.volume = 0.7
-				else:
-					self.music.synth.changeInstrument(self.music.channel["chords"], 0, 29) # electric guitar
-					self.music.synth.changeInstrument(self.music.channel["melody"], 0, 34) # bass
-					self.music.chords.arpeggio_freq = 4
-					self.music.chords.volume = 0.5
-					self.music.melody.volume = 0.7
-			elif value < 2/3:
-				if energy < 1/6:
-					self.music.synth.changeInstrument(self.music.channel["chords"], 0, 0) # piano
-					self.music.synth.changeInstrument(self.music.channel["melody"], 0, 0) # piano
-					self.music.chords.arpeggio_freq = 0
-					self.music.chords.volume = 0.5
-					self.music.melody.volume = 0.6
-				elif energy < 1/2:
-					self.music.synth.changeInstrument(self.music.channel["chords"], 0, 0) # piano
-					self.music.synth.changeInstrument(self.music.channel["melody"], 0, 71) # clarinet
-					self.music.chords.arpeggio_freq = 0
-					self.music.chords.volume = 0.5
-					self.music.melody.volume = 0.6
-				else:
-					pass
-			else:
-				if energy < 1/6:
-					self.music.synth.changeInstrument(self.music.channel["chords"], 0, 4) # ep
-					self.music.synth.changeInstrument(self.music.channel["melody"], 0, 4) # ep
-					self.music.chords.arpeggio_freq = 0
-					self.music.chords.volume = 0.5
-					self.music.melody.volume = 0.6
-				elif energy < 1/2:
-					self.music.synth.changeInstrument(self.music.channel["chords"], 0,107) # koto
-					self.music.synth.changeInstrument(self.music.channel["melody"], 1,104) # tampura
-					self.music.chords.arpeggio_freq = 2
-					self.music.chords.volume = 0.5
-					self.music.melody.volume = 0.5
-				else:
-					self.music.synth.changeInstrument(self.music.channel["chords"], 0, 61) # brass
-					self.music.synth.changeInstrument(self.music.channel["melody"], 0, 60) # f.horn
-					self.music.chords.arpeggio_freq = 0
-					self.music.chords.volume = 0.45
-					self.music.melody.volume = 0.55
-	
 
 
 
 if __name__ == "__main__":
+	from pyaudio import PyAudio
+	from pydub import AudioSegment
 
 	video_name = "v7" # name of the video
 	sample_rate = 44100  # Sample rate in Hz	
@@ -0,0 +1,482 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from library_index import LibraryIndex, VIDEO_EXTENSIONS
+from muxer import AudioMuxer
+from quality import QUALITIES
+import resources
+
+
+OUTPUT_FORMATS = ("mp4", "wav", "mp3", "mid")
+STAGES = ("analysis", "synthesis", "mux")
+RENDER_CACHE_BYTES = 2 * 1024**3
+# the length of the cached segments
+SEGMENT_SECONDS = 10.0
+
+# one atmosvideo per worker process, created by init_worker so the soundfont is loaded once
+worker_atmos = None
+# where the workers send the progress of their jobs, see ProgressReporter
+worker_progress = None
+# the CPU time and memory it took to create worker_atmos, soundfont included
+worker_setup = None
+
+
+
+def find_videos(inputs:list, index:LibraryIndex = None) -> list:
+	"""
+	Expands the given files, directories and glob patterns into a sorted list of video paths.
+
+	Args:
+		inputs (list): Paths to video files or directories, or glob patterns.
+		index (LibraryIndex): When given, directories are listed through the index after an incremental rescan.
+	"""
+	videos = set()
+	for item in inputs:
+		if os.path.isdir(item) and index is not None:
+			index.scan(item)
+			videos.update(entry["path"] for entry in index.videos(item))
+		elif os.path.isdir(item):
+			for root, dirs, files in os.walk(item):
+				for filename in files:
+					if filename.lower().endswith(VIDEO_EXTENSIONS):
+						videos.add(os.path.abspath(os.path.join(root, filename)))
+		elif os.path.isfile(item):
+			videos.add(os.path.abspath(item))
+		else:
+			for path in glob.glob(item, recursive=True):
+				if os.path.isfile(path) and path.lower().endswith(VIDEO_EXTENSIONS):
+					videos.add(os.path.abspath(path))
+	return sorted(videos)
+
+
+def output_path_for(video_path:str, output_dir:str, output_format:str) -> str:
+	"""
+	Return:
+		The path of the soundtrack of a video, named after the video and a short hash of its directory,
+		so videos of the same name in different directories don't write the same file.
+	"""
+	name = os.path.splitext(os.path.basename(video_path))[0]
+	directory = hashlib.sha1(os.fsencode(os.path.dirname(os.path.abspath(video_path)))).hexdigest()[:8]
+	return os.path.join(output_dir, f"{name}.{directory}.{output_format}")
+
+
+def render_settings(output_format:str, sample_rate:int, quality:str, analysis_quality:str, seed:int, profile,
+		segment_seconds:float = None) -> dict:
+	"""
+	Return:
+		The settings deciding what an output sounds like, recorded next to it by record_settings().
+		A profile given as a file is identified by its contents.
+	"""
+	settings = {"format": output_format, "sample_rate": sample_rate, "quality": quality,
+		"analysis_quality": analysis_quality or quality, "seed": seed, "profile": profile, "segment_seconds": segment_seconds}
+	if isinstance(profile, str) and os.path.isfile(profile):
+		with open(profile, "rb") as f:
+			settings["profile_sha1"] = hashlib.sha1(f.read()).hexdigest()
+	# as read back from the file
+	return json.loads(json.dumps(settings))
+
+
+def settings_path_for(output_path:str) -> str:
+	directory, name = os.path.split(output_path)
+	return os.path.join(directory, f".{name}.settings.json")
+
+
+def record_settings(output_path:str, settings:dict) -> None:
+	path = settings_path_for(output_path)
+	with open(f"{path}.part", "w") as f:
+		json.dump(settings, f)
+	os.replace(f"{path}.part", path)
+
+
+def is_up_to_date(video_path:str, output_path:str, settings:dict = None) -> bool:
+	"""
+	Return:
+		Whether the output is newer than the video and, when settings are given, was rendered with them.
+	"""
+	if not os.path.exists(output_path) or os.path.getmtime(output_path) < os.path.getmtime(video_path):
+		return False
+	if settings is None:
+		return True
+	try:
+		with open(settings_path_for(output_path)) as f:
+			return json.load(f) == settings
+	except (OSError, ValueError):
+		return False
+
+
+def init_worker(sample_rate:int, trace:bool, midi:bool = False, quality:str = "final", analysis_quality:str = None,
+		seed:int = 0, profile:str = "default", progress = None) -> None:
+	global worker_atmos, worker_progress, worker_setup
+	worker_progress = progress
+	before = resources.usage()
+	# the analysis and synthesis stack is only loaded by the workers
+	from atmosvideo import Atmosvideo
+	from quality import quality_settings
+	from video_properties_2 import VideoPropertiesExtractor
+	worker_atmos = Atmosvideo(sample_rate=sample_rate, live=False, trace=trace, midi=midi, quality=quality, seed=seed,
+		profile=profile, resources=True)
+	worker_setup = resources.difference(resources.usage(), before)
+	if analysis_quality and analysis_quality != quality:
+		# e.g. a final render of the timeline analysed for a draft, whose notes it then matches
+		worker_atmos.video = VideoPropertiesExtractor(quality_settings(analysis_quality)["analysis_height"], worker_atmos.timer)
+
+
+class WavSink():
+	"""
+	Writes the generated chunks straight into a WAV file.
+	"""
+	def __init__(self, output_path:str, sample_rate:int, channels:int = 2) -> None:
+		self.wave_file = wave.open(output_path, "wb")
+		self.wave_file.setframerate(sample_rate)
+		self.wave_file.setsampwidth(2)
+		self.wave_file.setnchannels(channels)
+
+	def write(self, samples:bytes) -> None:
+		self.wave_file.writeframesraw(samples)
+
+	def close(self) -> None:
+		self.wave_file.close()
+
+
+class MidiSink():
+	"""
+	Writes the MIDI events recorded while generating, there are no samples to write.
+	"""
+	def __init__(self, output_path:str, atmos) -> None:
+		self.output_path = output_path
+		self.atmos = atmos
+
+	def write(self, samples:bytes) -> None:
+		pass
+
+	def close(self) -> None:
+		self.atmos.save_midi(self.output_path)
+
+
+class ProgressReporter():
+	"""
+	Sends the progress of a job from a worker process to the parent, through the queue given to init_worker:
+	(job_id, stage, frames done, total frames) on every change of stage and a few times per second.
+	"""
+	def __init__(self, queue, job_id:str, atmos, interval:float = 0.25) -> None:
+		self.queue = queue
+		self.job_id = job_id
+		self.atmos = atmos
+		self.interval = interval
+		self.stage_name = None
+		self.total = None
+		self.done = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def stage(self, stage:str, total:int = None) -> None:
+		self.stage_name = stage
+		self.total = total
+		self.send()
+
+	def send(self) -> None:
+		frames, total = 0, self.total
+		if self.stage_name == "render":
+			frames = self.atmos.i_frame
+		elif self.stage_name == "analysis" and self.atmos.video.timeline is not None:
+			# the feature cache records the timeline while analysing
+			frames, total = self.atmos.video.timeline.frames, self.atmos.video.frame_count
+		self.queue.put((self.job_id, self.stage_name, frames, total))
+
+	def run(self) -> None:
+		while not self.done.wait(self.interval):
+			if self.stage_name is not None:
+				self.send()
+
+	def close(self) -> None:
+		self.done.set()
+		self.thread.join()
+
+
+class NullReporter():
+	def stage(self, stage:str, total:int = None) -> None:
+		pass
+
+	def close(self) -> None:
+		pass
+
+
+def process_video(video_path:str, output_path:str, output_format:str, trace_dir:str = None, cache_dir:str = None,
+		render_cache_bytes:int = RENDER_CACHE_BYTES, job_id:str = None) -> dict:
+	"""
+	Generates the soundtrack of a single video inside a worker process.
+
+	Args:
+		trace_dir (str): Directory where a Chrome trace of the run is written, or None.
+		cache_dir (str): Directory of the feature, segment and render caches. When given the video is analysed
+			once into a property timeline, the soundtrack is rendered from cached segments, and a render
+			already made with the same settings is reused as it is.
+		render_cache_bytes (int): The size the render cache is kept under.
+		job_id (str): Identifies the job in the progress sent to the parent, when init_worker was given a queue.
+
+	Return:
+		A dictionary with the result, the time spent in each stage, in seconds, and the resources used,
+		see ResourceMonitor.report(), with those taken to set the worker up.
+	"""
+	reporter = ProgressReporter(worker_progress, job_id, worker_atmos) if worker_progress and job_id else NullReporter()
+	monitor = worker_atmos.resources
+	monitor.start()
+	try:
+		result = generate(video_path, output_path, output_format, trace_dir, cache_dir, render_cache_bytes, reporter)
+	finally:
+		reporter.close()
+		report = monitor.stop()
+	report["setup"] = worker_setup
+	result["resources"] = report
+	return result
+
+
+def generate(video_path:str, output_path:str, output_format:str, trace_dir:str, cache_dir:str, render_cache_bytes:int,
+		reporter) -> dict:
+	atmos = worker_atmos
+	sample_rate = atmos.music.output_rate
+	channels = atmos.music.channels
+	result = {"input": video_path, "output": output_path, "status": "done"}
+	start = time.perf_counter()
+
+	if cache_dir:
+		from feature_cache import FeatureCache
+		from segments import SegmentRenderer
+		from render_cache import RenderCache
+		renders = RenderCache(os.path.join(cache_dir, "renders"), render_cache_bytes)
+		try:
+			# the notes are those of the streamed render, but the effect tails after a pre-roll can differ slightly
+			config = dict(atmos.render_config(), segments=True)
+			render_key = renders.key(FeatureCache.key(video_path, atmos.video.params()), config, output_format)
+		except OSError as e:
+			result["status"] = "error"
+			result["error"] = str(e)
+			return result
+		if renders.fetch(render_key, output_format, output_path):
+			result["cached"] = True
+			result["seconds"] = time.perf_counter() - start
+			return result
+
+		atmos.timer.reset()
+		atmos.timer.start("analysis")
+		reporter.stage("analysis")
+		try:
+			features_key, fps, values = FeatureCache(os.path.join(cache_dir, "features")).extract(video_path, atmos.video)
+		except RuntimeError as e:
+			result["status"] = "error"
+			result["error"] = str(e)
+			return result
+		atmos.timer.time("analysis")
+		result["features_key"] = features_key
+		# both renders below start from the initial state
+		atmos.reset()
+		reporter.stage("render", len(values))
+	else:
+		atmos.load(video_path)
+		if atmos.status == atmos.ERROR:
+			result["status"] = "error"
+			result["error"] = "could not open video"
+			return result
+		fps = atmos.video.fps
+		reporter.stage("render", atmos.video.frame_count)
+
+	tmp_path = f"{output_path}.part.{output_format}"
+	if output_format == "wav":
+		sink = WavSink(tmp_path, sample_rate, channels)
+	elif output_format == "mid":
+		sink = MidiSink(tmp_path, atmos)
+	else:
+		sink = AudioMuxer(tmp_path, sample_rate, channels, video_path=video_path if output_format == "mp4" else None)
+	try:
+		if isinstance(sink, AudioMuxer):
+			sink.open()
+		if cache_dir and output_format == "mid":
+			# segments only cache samples, the events are generated again from the cached timeline
+			nsamples_frame = round(atmos.music.samplerate / fps)
+			for row in values:
+				atmos.i_frame += 1
+				atmos.synthesize(tuple(float(x) for x in row), nsamples_frame)
+		elif cache_dir:
+			renderer = SegmentRenderer(os.path.join(cache_dir, "segments"), atmos, SEGMENT_SECONDS)
+			result["segments"] = renderer.render(features_key, fps, values, sink.write)
+		else:
+			atmos.start(sink=sink.write)
+		atmos.timer.start("mux")
+		reporter.stage("mux")
+		sink.close()
+		atmos.timer.time("mux")
+		os.replace(tmp_path, output_path)
+		if cache_dir:
+			renders.store(render_key, output_format, output_path)
+	except Exception as e:
+		if isinstance(sink, AudioMuxer):
+			sink.abort()
+		elif os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		result["status"] = "error"
+		result["error"] = str(e)
+		return result
+
+	result["frames"] = atmos.i_frame
+	result["fps"] = fps
+	result["stages"] = {k: v / 1_000_000_000.0 for k, v in atmos.timer.get_all_components().items() if k in STAGES}
+	result["latency"] = atmos.timer.summary()
+	result["synth_control"] = atmos.music.control.stats()
+	if trace_dir:
+		name = os.path.splitext(os.path.basename(output_path))[0]
+		atmos.timer.export_chrome_trace(os.path.join(trace_dir, f"{name}.trace.json"))
+	result["seconds"] = time.perf_counter() - start
+	return result
+
+
+def run_batch(videos:list, output_dir:str, output_format:str, jobs:int, sample_rate:int, force:bool, trace_dir:str = None,
+		index:LibraryIndex = None, cache_dir:str = None, quality:str = "final", analysis_quality:str = None, seed:int = 0,
+		render_cache_bytes:int = RENDER_CACHE_BYTES, profile:str = "default") -> dict:
+	os.makedirs(output_dir, exist_ok=True)
+	if trace_dir:
+		os.makedirs(trace_dir, exist_ok=True)
+	report = {"format": output_format, "sample_rate": sample_rate, "seed": seed, "profile": profile, "quality": quality,
+		"analysis_quality": analysis_quality or quality, "jobs": jobs, "videos": []}
+	start = time.perf_counter()
+	# the renders from cached segments can differ slightly from the streamed ones, see SegmentRenderer
+	settings = render_settings(output_format, sample_rate, quality, analysis_quality, seed, profile,
+		SEGMENT_SECONDS if cache_dir and output_format != "mid" else None)
+
+	pending = []
+	for video_path in videos:
+		output_path = output_path_for(video_path, output_dir, output_format)
+		if not force and is_up_to_date(video_path, output_path, settings):
+			report["videos"].append({"input": video_path, "output": output_path, "status": "skipped"})
+		else:
+			pending.append((video_path, output_path))
+
+	n_done = len(report["videos"])
+	n_total = len(videos)
+	if n_done:
+		print(f"Skipping {n_done} up to date video(s)")
+
+	with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(sample_rate, bool(trace_dir), output_format == "mid", quality, analysis_quality, seed,
+			profile)) as pool:
+		futures = {pool.submit(process_video, v, o, output_format, trace_dir, cache_dir, render_cache_bytes): (v, o) for v, o in pending}
+		for future in as_completed(futures):
+			try:
+				result = future.result()
+			except Exception as e:
+				# e.g. BrokenProcessPool, when a worker was killed
+				video_path, output_path = futures[future]
+				result = {"input": video_path, "output": output_path, "status": "error", "error": str(e) or type(e).__name__}
+			report["videos"].append(result)
+			n_done += 1
+			name = os.path.basename(result["input"])
+			if result["status"] == "done":
+				try:
+					record_settings(result["output"], settings)
+				except OSError:
+					# the output is then rendered again on the next run
+					pass
+				if index is not None:
+					index.update_file(result["input"])
+					index.set_audio(result["input"], os.path.abspath(result["output"]))
+					if "features_key" in result:
+						index.set_features(result["input"], result["features_key"])
+				if result.get("cached"):
+					print(f"[{n_done}/{n_total}] {name}: reused from the render cache")
+				else:
+					print(f"[{n_done}/{n_total}] {name}: {result['frames']} frames in {result['seconds']:.1f}s")
+			else:
+				print(f"[{n_done}/{n_total}] {name}: {result['status']} ({result.get('error')})")
+
+	report["seconds"] = time.perf_counter() - start
+	report["resources"] = summarize_resources(report["videos"])
+	return report
+
+
+def summarize_resources(results:list) -> dict:
+	"""
+	Return:
+		What the videos needed at most and in total, for sizing the worker pool: the memory of a
+		worker (after its setup and at its peak), the CPU seconds per video second and the bytes
+		read and written.
+	"""
+	reports = [result["resources"] for result in results if result.get("resources")]
+	if not reports:
+		return None
+	rendered = [result for result in results if result.get("resources") and result.get("fps")]
+	seconds = sum(result["frames"] / result["fps"] for result in rendered)
+	setups = [report["setup"] for report in reports if report.get("setup")]
+	peaks = [report["peak_rss_bytes"] for report in reports if report["peak_rss_bytes"] is not None]
+	summary = {
+		"videos": len(reports),
+		"cpu_seconds": sum(report["cpu_seconds"] for report in reports),
+		"cpu_seconds_per_video_second": sum(result["resources"]["cpu_seconds"] for result in rendered) / seconds if seconds else None,
+		"setup_rss_bytes": max((setup["rss_bytes"] for setup in setups if setup["rss_bytes"] is not None), default=None),
+		"peak_rss_bytes": max(peaks, default=None),
+		"stages": {},
+	}
+	for field in resources.IO_FIELDS.values():
+		if all(field in report for report in reports):
+			summary[field] = sum(report[field] for report in reports)
+	for report in reports:
+		for name, stage in report["stages"].items():
+			totals = summary["stages"].setdefault(name, {"cpu_seconds": 0.0, "peak_rss_bytes": None})
+			totals["cpu_seconds"] += stage["cpu_seconds"]
+			if stage["peak_rss_bytes"] is not None:
+				totals["peak_rss_bytes"] = max(totals["peak_rss_bytes"] or 0, stage["peak_rss_bytes"])
+	return summary
+
+
+def main(argv=None) -> int:
+	parser = argparse.ArgumentParser(description="Generate Atmosvideo soundtracks for many videos without the GUI.")
+	parser.add_argument("inputs", nargs="+", help="video files, directories or glob patterns")
+	parser.add_argument("-o", "--output-dir", default="sound_output", help="directory for the generated files")
+	parser.add_argument("-f", "--format", choices=OUTPUT_FORMATS, default="mp4", help="muxed video, audio only as wav/mp3, or the notes as a MIDI file")
+	parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+	parser.add_argument("-r", "--sample-rate", type=int, help="sample rate of the audio, by default the one of the quality")
+	parser.add_argument("-q", "--quality", choices=QUALITIES, default="final", help="render tier, draft is a fast low quality preview")
+	parser.add_argument("--analysis-quality", choices=QUALITIES,
+		help="analyse with the settings of another tier, the built-in tiers share them so a final render reuses the timeline of a draft")
+	parser.add_argument("--report", help="write a JSON report with per video stage timings to this path")
+	parser.add_argument("--trace-dir", help="write a Chrome trace JSON of every video to this directory")
+	parser.add_argument("--index", help="SQLite library index used to list directories and record the outputs")
+	parser.add_argument("--cache-dir", help="cache property timelines and soundtrack segments here, so reruns only render what changed")
+	parser.add_argument("--profile", default="default", help="mapping profile, a built-in name or the path of a JSON profile")
+	parser.add_argument("--seed", type=int, default=0, help="seed of the music, the same seed always gives the same soundtrack")
+	parser.add_argument("--render-cache-size", type=int, default=RENDER_CACHE_BYTES // 1024**2,
+		help="MB of finished renders kept in the cache directory")
+	parser.add_argument("--force", action="store_true", help="regenerate outputs that are already up to date")
+	args = parser.parse_args(argv)
+
+	index = LibraryIndex(args.index) if args.index else None
+	videos = find_videos(args.inputs, index)
+	if not videos:
+		print("No videos found")
+		return 1
+
+	report = run_batch(videos, args.output_dir, args.format, args.jobs, args.sample_rate, args.force, args.trace_dir, index, args.cache_dir,
+		args.quality, args.analysis_quality, args.seed, args.render_cache_size * 1024**2,
+		args.profile)
+	if index is not None:
+		index.close()
+	if args.report:
+		with open(args.report, "w") as f:
+			json.dump(report, f, indent=2)
+
+	failed = sum(1 for v in report["videos"] if v["status"] == "error")
+	print(f"Finished {len(videos)} video(s) in {report['seconds']:.1f}s, {failed} failed")
+	usage = report["resources"]
+	if usage and usage["peak_rss_bytes"]:
+		print(f"Per worker: peak memory {usage['peak_rss_bytes'] / 1024**2:.0f} MB ({(usage['setup_rss_bytes'] or 0) / 1024**2:.0f} MB after setup), "
+			f"{usage['cpu_seconds']:.1f} CPU seconds"
+			+ (f", {usage['cpu_seconds_per_video_second']:.2f} per second of video" if usage["cpu_seconds_per_video_second"] else ""))
+	return 1 if failed else 0
+
+
+if __name__ == "__main__":
+	raise SystemExit(main())
@@ -0,0 +1,1117 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from atmosvideo import Atmosvideo
+from MusicGeneration import MusicGenerator, Synth
+from mapping import MappingProfile
+from quality import QUALITIES, quality_settings
+from muxer import AudioMuxer
+from segments import SegmentRenderer
+from video_properties_2 import VideoPropertiesExtractor
+from component_timer import ComponentTimer
+from governor import LADDER, AnalysisGovernor
+from live_input import LiveInput, ReplaySource
+from live_preview import LivePreview
+from service import JobService, serve
+import farm
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_fixtures")
+FIXTURE_KINDS = ("shapes", "sweep", "cuts")
+RESOLUTIONS = {180: (320, 180), 360: (640, 360), 720: (1280, 720), 1080: (1920, 1080)}
+STAGES = ("decode", "resize", "flow", "color", "parameters", "synthesis", "mux")
+FPS = 30
+
+# cold start budgets of the entry points: the cumulative import time allowed, in ms, and the
+# heavy modules they must only load once they are used
+IMPORT_BUDGETS = {
+	"main": (1500, ("cv2", "fluidsynth", "pyaudio", "pydub", "moviepy", "imageio_ffmpeg", "atmosvideo")),
+	"batch": (300, ("cv2", "fluidsynth", "pyaudio", "pydub", "imageio_ffmpeg", "atmosvideo")),
+	"atmosvideo": (3000, ("pyaudio", "pydub", "moviepy", "fluidsynth")),
+}
+
+
+
+def draw_frame(kind:str, i:int, width:int, height:int) -> np.ndarray:
+	"""
+	Draws frame i of a synthetic fixture. Frames only depend on their arguments, so fixtures are deterministic.
+
+	Args:
+		kind (str): "shapes" for moving shapes on a still background, "sweep" for a hue sweep
+			with a slowly moving square, "cuts" for hard cuts between different scenes every second.
+	"""
+	t = i / FPS
+	frame = np.zeros((height, width, 3), dtype=np.uint8)
+	scale = height / 180
+
+	if kind == "sweep":
+		hue = int(i * 2) % 180
+		frame[:] = cv2.cvtColor(np.uint8([[[hue, 200, 200]]]), cv2.COLOR_HSV2BGR)[0, 0]
+		x = int((0.5 + 0.4 * np.sin(t * 0.5)) * width)
+		cv2.rectangle(frame, (x - int(20*scale), height//2 - int(20*scale)), (x + int(20*scale), height//2 + int(20*scale)), (255, 255, 255), -1)
+		return frame
+
+	scene = i // FPS if kind == "cuts" else 0
+	background = ((scene * 67) % 200 + 20, (scene * 131) % 200 + 20, (scene * 29) % 200 + 20)
+	frame[:] = background
+	speed = 1.0 + scene % 3
+	for k in range(4):
+		phase = k * np.pi / 2 + scene
+		cx = int((0.5 + 0.35 * np.cos(t * speed + phase)) * width)
+		cy = int((0.5 + 0.35 * np.sin(t * speed * 1.3 + phase)) * height)
+		color = ((k * 80) % 256, (255 - k * 60) % 256, (k * 40 + 100) % 256)
+		if k % 2:
+			cv2.circle(frame, (cx, cy), int(15 * scale), color, -1)
+		else:
+			cv2.rectangle(frame, (cx - int(12*scale), cy - int(12*scale)), (cx + int(12*scale), cy + int(12*scale)), color, -1)
+	return frame
+
+
+def make_fixture(kind:str, resolution:int, seconds:float) -> str:
+	"""
+	Writes the fixture video if it doesn't exist yet and returns its path.
+	"""
+	os.makedirs(FIXTURES_DIR, exist_ok=True)
+	path = os.path.join(FIXTURES_DIR, f"{kind}_{resolution}p_{seconds:g}s.mp4")
+	if os.path.exists(path):
+		return path
+	width, height = RESOLUTIONS[resolution]
+	writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), FPS, (width, height))
+	for i in range(int(seconds * FPS)):
+		writer.write(draw_frame(kind, i, width, height))
+	writer.release()
+	return path
+
+
+def bench_video(path:str, atmos:Atmosvideo, height:int) -> dict:
+	"""
+	Runs the whole pipeline on a video, timing every stage on its own.
+
+	Return:
+		A dictionary with the frame count and the seconds and milliseconds per frame of each stage.
+	"""
+	timer = ComponentTimer()
+	extractor = VideoPropertiesExtractor(height)
+	capture = cv2.VideoCapture(path)
+	fps = capture.get(cv2.CAP_PROP_FPS)
+	extractor.set_size(int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+	nsamples_frame = round(atmos.music.samplerate / fps)
+	atmos.load(path)
+	output_fd, output_path = tempfile.mkstemp(suffix=".mp4")
+	os.close(output_fd)
+	muxer = AudioMuxer(output_path, atmos.music.output_rate, atmos.music.channels, video_path=path)
+	muxer.open()
+
+	prev_gray = None
+	n_frames = 0
+	while True:
+		timer.start("decode")
+		success, frame = capture.read()
+		timer.time("decode")
+		if not success:
+			break
+
+		timer.start("resize")
+		frame = cv2.resize(frame, (extractor.width, extractor.height), interpolation=cv2.INTER_AREA)
+		gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+		timer.time("resize")
+
+		energy = 0.0
+		if prev_gray is not None:
+			timer.start("flow")
+			threads, energies = extractor.start_energy(gray, prev_gray)
+			energy = extractor.join_energy(threads, energies)
+			timer.time("flow")
+		prev_gray = gray
+
+		timer.start("color")
+		h, s, v = extractor.color_stats(frame)
+		timer.time("color")
+
+		timer.start("parameters")
+		atmos.update_parameters((energy, h, s, v))
+		timer.time("parameters")
+
+		timer.start("synthesis")
+		samples = atmos.music.get_samples(nsamples_frame)
+		atmos.samples_done += nsamples_frame
+		timer.time("synthesis")
+
+		timer.start("mux")
+		muxer.write(samples)
+		timer.time("mux")
+		n_frames += 1
+
+	timer.start("mux")
+	muxer.close()
+	timer.time("mux")
+	capture.release()
+	os.remove(output_path)
+
+	stages = {}
+	for stage in STAGES:
+		seconds = timer.get_all_components().get(stage, 0) / 1_000_000_000.0
+		stages[stage] = {"seconds": seconds, "ms_per_frame": 1000.0 * seconds / max(n_frames, 1)}
+	return {"frames": n_frames, "stages": stages, "synth_control": atmos.music.control.stats()}
+
+
+def strip_energy(gray:np.ndarray, prev_gray:np.ndarray, n_threads:int) -> float:
+	"""
+	The mean flow magnitude as the extractor computed it before tiling, one thread per column strip and
+	the last one stopping a column short, kept to compare the tiled flow against.
+	"""
+	width = gray.shape[1]
+	length = width // n_threads
+	energy = [0.0] * n_threads
+	def strip(i):
+		start = length * i
+		end = start + length if i != n_threads - 1 else width - 1
+		flow = cv2.calcOpticalFlowFarneback(prev_gray[:, start:end], gray[:, start:end], None, 0.5, 3, 15, 3, 5, 1.2, 0)
+		energy[i] = np.mean(np.sqrt(flow[..., 0]**2 + flow[..., 1]**2))
+	threads = [threading.Thread(target=strip, args=(i,)) for i in range(n_threads)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return float(np.mean(energy))
+
+
+def bench_tiling(path:str, height:int, workers:list, halos:list) -> dict:
+	"""
+	Measures the flow of every pair of frames of a video untiled, split in column strips and tiled,
+	for every number of workers and halo width.
+
+	Return:
+		The milliseconds per frame of each and the mean absolute difference of their mean flow
+		magnitude with the untiled one, keyed "untiled", "strips/{n}" and "tiles/{n}/{halo}".
+	"""
+	capture = cv2.VideoCapture(path)
+	extractor = VideoPropertiesExtractor(height)
+	extractor.set_size(int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+	grays = []
+	while True:
+		success, frame = capture.read()
+		if not success:
+			break
+		grays.append(cv2.cvtColor(cv2.resize(frame, (extractor.width, extractor.height), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY))
+	capture.release()
+	pairs = list(zip(grays, grays[1:]))
+
+	def run(energy) -> tuple:
+		values = []
+		start = time.perf_counter()
+		for prev_gray, gray in pairs:
+			values.append(energy(gray, prev_gray))
+		return np.array(values), 1000.0 * (time.perf_counter() - start) / max(len(pairs), 1)
+
+	def untiled(gray, prev_gray):
+		flow = cv2.calcOpticalFlowFarneback(prev_gray, gray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+		return float(np.mean(np.sqrt(flow[..., 0]**2 + flow[..., 1]**2)))
+
+	def tiled(extractor):
+		def energy(gray, prev_gray):
+			running, sums = extractor.start_energy(gray, prev_gray)
+			for worker in running:
+				worker.result()
+			return sum(tile[0] for tile in sums) / (extractor.width * extractor.height)
+		return energy
+
+	reference, ms = run(untiled)
+	results = {"frames": len(pairs), "untiled": {"ms_per_frame": ms, "difference": 0.0}}
+	for n in workers:
+		values, ms = run(lambda gray, prev_gray: strip_energy(gray, prev_gray, n))
+		results[f"strips/{n}"] = {"ms_per_frame": ms, "difference": float(np.mean(np.abs(values - reference)))}
+		for halo in halos:
+			tiling = VideoPropertiesExtractor(height, halo=halo)
+			tiling.n_threads = n
+			tiling.set_size(grays[0].shape[1], grays[0].shape[0])
+			values, ms = run(tiled(tiling))
+			results[f"tiles/{n}/{halo}"] = {"ms_per_frame": ms, "difference": float(np.mean(np.abs(values - reference))),
+				"tiles": len(tiling.tiles)}
+	return results
+
+
+def bench_motion(path:str, height:int) -> dict:
+	"""
+	Measures what the motion features add to the flow pass: the flow of every pair of frames is
+	computed once, then reduced to the energy alone as before and to all the flow statistics.
+
+	Return:
+		The milliseconds per frame of the flow, of both reductions, and the extra cost of the motion
+		features as a fraction of the energy-only pass.
+	"""
+	capture = cv2.VideoCapture(path)
+	extractor = VideoPropertiesExtractor(height)
+	extractor.n_threads = 1
+	extractor.set_size(int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+	center = extractor.tile_centers[0]
+	seconds = {"flow": 0.0, "energy": 0.0, "motion": 0.0}
+	prev_gray = None
+	frames = 0
+	while True:
+		success, frame = capture.read()
+		if not success:
+			break
+		gray = cv2.cvtColor(cv2.resize(frame, (extractor.width, extractor.height), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+		if prev_gray is not None:
+			start = time.perf_counter()
+			flow = cv2.calcOpticalFlowFarneback(prev_gray, gray, None, 0.5, extractor.levels, 15, extractor.iterations, 5, 1.2, 0)
+			seconds["flow"] += time.perf_counter() - start
+			reductions = {
+				"energy": lambda: float(np.sqrt(flow[..., 0]**2 + flow[..., 1]**2).sum()),
+				"motion": lambda: extractor.flow_stats(flow, center, 0.5),
+			}
+			# the first reduction after the flow reads it from colder caches, the order alternates
+			for name in sorted(reductions, reverse=frames % 2 == 1):
+				start = time.perf_counter()
+				reductions[name]()
+				seconds[name] += time.perf_counter() - start
+			frames += 1
+		prev_gray = gray
+	capture.release()
+	ms = {name: 1000.0 * value / max(frames, 1) for name, value in seconds.items()}
+	return {"frames": frames, "ms_per_frame": ms,
+		"overhead": (ms["motion"] - ms["energy"]) / max(ms["flow"] + ms["energy"], 1e-9)}
+
+
+def bench_governor(path:str, height:int, deadline:float) -> dict:
+	"""
+	Analyses a video as fast as possible under an AnalysisGovernor with the given deadline per frame.
+
+	Return:
+		The governor's stats and the mean analysis time per frame, in ms.
+	"""
+	extractor = VideoPropertiesExtractor(height)
+	governor = AnalysisGovernor(extractor, deadline, log=None)
+	extractor.load(path)
+	start = time.perf_counter()
+	running = extractor.status == VideoPropertiesExtractor.RUNNING
+	while running:
+		running = governor.step()
+	seconds = time.perf_counter() - start
+	extractor.release()
+	return dict(governor.stats(), ms_per_frame=1000.0 * seconds / max(governor.frames, 1))
+
+
+def check_governor_levels(path:str, height:int, frames:int = 150) -> list:
+	"""
+	Analyses the start of a video at every level of the governor's ladder, held fixed.
+
+	Return:
+		For every level its mean energy, its difference with level 0 as a fraction of it, and its ms per frame.
+	"""
+	levels = []
+	for settings in LADDER:
+		extractor = VideoPropertiesExtractor(height)
+		settings = dict(settings, height=max(int(round(height * settings["height"])), 16))
+		extractor.configure(**settings)
+		extractor.load(path)
+		energies = []
+		start = time.perf_counter()
+		while len(energies) < frames and extractor.status == VideoPropertiesExtractor.RUNNING:
+			extractor.step()
+			energies.append(extractor.values[0])
+		seconds = time.perf_counter() - start
+		extractor.release()
+		energy = float(np.mean(energies)) if energies else 0.0
+		levels.append({"energy": energy, "ms_per_frame": 1000.0 * seconds / max(len(energies), 1)})
+	for level in levels:
+		level["difference"] = (level["energy"] - levels[0]["energy"]) / max(levels[0]["energy"], 1e-9)
+	return levels
+
+
+def bench_live(path:str, speed:float, max_latency:float) -> dict:
+	"""
+	Replays a video at speed times real time as a live source and generates its music as MIDI, so
+	no synth is needed. The playback latency isn't measured, MIDI has no audio to play.
+
+	Return:
+		The stats of the LiveInput, see LiveInput.stats(), the frames the replay skipped itself, and
+		whether the end of the source was reached and the run timed.
+	"""
+	atmos = Atmosvideo(live=False, midi=True)
+	source = ReplaySource(path, speed)
+	live = LiveInput(source, max_latency=max_latency, output="null", atmos=atmos)
+	live.start()
+	live.wait()
+	stats = live.stats()
+	finished = atmos.status == Atmosvideo.FINISHED and "atmosvideo" in atmos.timer.get_all_components()
+	live.stop()
+	atmos.close()
+	return dict(stats, replay_skipped=source.skipped, finished=finished)
+
+
+class PlayerClock():
+	"""
+	Stands in for a video player: its time runs at speed times real time and can be moved, like a seek.
+	"""
+	def __init__(self, speed:float) -> None:
+		self.speed = speed
+		self.seek(0.0)
+
+	def seek(self, seconds:float) -> None:
+		self.origin = time.perf_counter() - seconds / self.speed
+
+	def get_time(self) -> int:
+		return int(1000.0 * self.speed * (time.perf_counter() - self.origin))
+
+
+def bench_preview(path:str, speed:float, timeout:float = 60.0) -> dict:
+	"""
+	Previews a video as MIDI against a player clock running at speed times real time until the end of
+	the video, then seeks back to its start and plays it to its end again.
+
+	Return:
+		For both passes whether the end was reached with the preview thread still running, the frames
+		generated and the stats of the preview, and whether the run was timed.
+	"""
+	atmos = Atmosvideo(live=False, midi=True)
+	clock = PlayerClock(speed)
+	preview = LivePreview(path, clock.get_time, lambda: True, output="null", atmos=atmos)
+	preview.start()
+	passes = []
+	for _ in range(2):
+		frames = preview.frames
+		deadline = time.perf_counter() + timeout
+		while atmos.status == Atmosvideo.RUNNING and preview.thread.is_alive() and time.perf_counter() < deadline:
+			time.sleep(0.05)
+		passes.append({"finished": atmos.status == Atmosvideo.FINISHED, "alive": preview.thread.is_alive(),
+			"frames": preview.frames - frames})
+		clock.seek(0.0)
+		# the preview sees the seek on its next check of the clock
+		deadline = time.perf_counter() + timeout
+		while atmos.status != Atmosvideo.RUNNING and preview.thread.is_alive() and time.perf_counter() < deadline:
+			time.sleep(0.01)
+	stats = preview.stats()
+	preview.stop()
+	timed = "atmosvideo" in atmos.timer.get_all_components()
+	atmos.close()
+	return {"passes": passes, "timed": timed, "stats": stats}
+
+
+def request_soundtrack(port:int, video_path:str, output_format:str) -> dict:
+	"""
+	Asks the service for a soundtrack like a client would: submits the job, follows its event stream
+	until it ends and downloads the result.
+
+	Return:
+		The latency in seconds, the job, whether it was refused at first, and the size of the result.
+	"""
+	start = time.perf_counter()
+	refused = 0
+	body = json.dumps({"path": video_path, "format": output_format})
+	while True:
+		connection = http.client.HTTPConnection("127.0.0.1", port)
+		connection.request("POST", "/jobs", body, {"Content-Type": "application/json"})
+		response = connection.getresponse()
+		job = json.loads(response.read())
+		connection.close()
+		if response.status != 503:
+			break
+		refused += 1
+		time.sleep(float(response.getheader("Retry-After", 1)))
+
+	connection = http.client.HTTPConnection("127.0.0.1", port)
+	connection.request("GET", f"/jobs/{job['id']}/events")
+	response = connection.getresponse()
+	for line in response:
+		if line.startswith(b"data: "):
+			job = json.loads(line[6:])
+	connection.close()
+
+	size = 0
+	if job["status"] == "done":
+		connection = http.client.HTTPConnection("127.0.0.1", port)
+		connection.request("GET", f"/jobs/{job['id']}/result")
+		size = len(connection.getresponse().read())
+		connection.close()
+	return {"seconds": time.perf_counter() - start, "job": job, "refused": refused, "bytes": size}
+
+
+def bench_service(videos:list, output_format:str, requests:int, concurrency:int, jobs:int) -> dict:
+	"""
+	Load tests the HTTP service with concurrent clients asking for the soundtracks of videos in turn,
+	so most requests repeat an earlier one. It runs once on an empty cache, then again with a
+	restarted service on the same cache, which only remembers the soundtracks through its caches.
+
+	Return:
+		For the "cold" and "warm" runs: the throughput in requests per second, the latency
+		percentiles in seconds, and how many jobs were rendered, joined or answered from the caches.
+	"""
+	cache_dir = tempfile.mkdtemp(prefix="atmos_service_")
+	results = {}
+	for run in ("cold", "warm"):
+		service = JobService(cache_dir, jobs=jobs, max_pending=max(concurrency // 2, 1))
+		server = serve(service, 0)
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		port = server.server_address[1]
+
+		start = time.perf_counter()
+		with ThreadPoolExecutor(max_workers=concurrency) as clients:
+			answers = list(clients.map(lambda i: request_soundtrack(port, videos[i % len(videos)], output_format), range(requests)))
+		seconds = time.perf_counter() - start
+		server.shutdown()
+		server.server_close()
+		service.close()
+
+		latencies = np.array([answer["seconds"] for answer in answers])
+		latency = {f"p{p}": float(np.percentile(latencies, p)) for p in (50, 95, 99)}
+		latency["max"] = float(latencies.max())
+		jobs_seen = {answer["job"]["id"]: answer["job"] for answer in answers}
+		results[run] = {
+			"requests": requests,
+			"seconds": seconds,
+			"throughput": requests / seconds,
+			"latency": latency,
+			"errors": sum(answer["job"]["status"] != "done" for answer in answers),
+			"refused": sum(answer["refused"] for answer in answers),
+			"jobs": len(jobs_seen),
+			"from_cache": sum(job["cached"] for job in jobs_seen.values()),
+			"joined": requests - len(jobs_seen),
+		}
+	shutil.rmtree(cache_dir, ignore_errors=True)
+	return results
+
+
+def run_farm(videos:list, output_dir:str, cache_dir:str, output_format:str, workers:int, faults:bool) -> dict:
+	coordinator = farm.FarmCoordinator(videos, output_dir, output_format, port=0, cache_dir=cache_dir, range_seconds=1.0,
+		segment_seconds=2.0, heartbeat_timeout=3.0)
+	port = coordinator.start()
+	processes = farm.start_local_workers(port, workers)
+	try:
+		if faults:
+			# one worker dies in the middle of a task, another hangs without closing its connection
+			for process, fault in zip(processes, (signal.SIGKILL, signal.SIGSTOP)):
+				name = f"local{processes.index(process)}"
+				while not coordinator.finished and not (coordinator.workers.get(name) or {}).get("busy"):
+					time.sleep(0.01)
+				process.send_signal(fault)
+		return coordinator.wait(600)
+	finally:
+		coordinator.close()
+		for process in processes:
+			if process.poll() is None:
+				process.kill()
+		farm.stop_local_workers(processes)
+
+
+def bench_farm(videos:list, output_format:str, workers:int) -> dict:
+	"""
+	Runs the render farm on local workers, once as it is and once with a worker killed and another
+	frozen in the middle of their tasks, and compares both with a single process analysis and the
+	outputs with a streamed render by batch.py.
+
+	Return:
+		The seconds of the single process analysis and of both runs, the workers lost and tasks
+		reassigned, the largest difference between the stitched and sequential timelines, whether
+		the outputs of both runs are identical, and the largest difference of the farm's outputs with
+		the local ones (see output_difference()), None for the formats that are encoded lossily.
+	"""
+	from feature_cache import FeatureCache
+	from timeline import Timeline
+	work_dir = tempfile.mkdtemp(prefix="atmos_farm_")
+	start = time.perf_counter()
+	sequential = [FeatureCache(os.path.join(work_dir, "sequential")).extract(video)[2] for video in videos]
+	results = {"videos": len(videos), "sequential_analysis_seconds": time.perf_counter() - start}
+	for run in ("clean", "faults"):
+		report = run_farm(videos, os.path.join(work_dir, run), os.path.join(work_dir, f"{run}_cache"), output_format,
+			workers, run == "faults")
+		difference = 0.0
+		for video, values in zip(report["videos"], sequential):
+			if video["status"] == "done":
+				timeline = Timeline(os.path.join(work_dir, f"{run}_cache", "features", f"{video['features_key']}.timeline"))
+				difference = max(difference, float(np.abs(np.asarray(timeline) - np.asarray(values)).max()) if len(timeline) == len(values) else np.inf)
+		results[run] = {
+			"seconds": report["seconds"],
+			"errors": sum(video["status"] != "done" for video in report["videos"]),
+			"tasks": sum(video["tasks"] for video in report["videos"]),
+			"lost_workers": report["lost_workers"],
+			"reassigned": sum(video["reassigned"] for video in report["videos"]),
+			"timeline_difference": difference,
+		}
+	outputs = [farm.output_path_for(video, os.path.join(work_dir, run), output_format) for run in ("clean", "faults") for video in videos]
+	contents = [open(path, "rb").read() if os.path.exists(path) else None for path in outputs]
+	results["identical"] = contents[:len(videos)] == contents[len(videos):] and None not in contents
+	results["local_difference"] = None
+	if output_format in ("wav", "mid"):
+		import batch
+		batch.run_batch(videos, os.path.join(work_dir, "local"), output_format, 1, None, True)
+		results["local_difference"] = max(output_difference(farm.output_path_for(video, os.path.join(work_dir, "local"),
+			output_format), path) for video, path in zip(videos, outputs))
+	shutil.rmtree(work_dir, ignore_errors=True)
+	return results
+
+
+def output_difference(reference:str, path:str) -> float:
+	"""
+	Return:
+		For WAV files the RMS of the difference of the samples relative to the RMS of the reference's,
+		for other files 0 if they are the same byte for byte, inf if either is missing or the lengths differ.
+	"""
+	if not os.path.exists(reference) or not os.path.exists(path):
+		return float("inf")
+	if not reference.endswith(".wav"):
+		with open(reference, "rb") as a, open(path, "rb") as b:
+			return 0.0 if a.read() == b.read() else float("inf")
+	import wave
+	samples = []
+	for name in (reference, path):
+		with wave.open(name) as f:
+			samples.append(np.frombuffer(f.readframes(f.getnframes()), np.int16).astype(np.float64))
+	if len(samples[0]) != len(samples[1]):
+		return float("inf")
+	return float(np.sqrt(np.mean((samples[1] - samples[0]) ** 2) / max(np.mean(samples[0] ** 2), 1.0)))
+
+
+def check_midi(path:str) -> dict:
+	"""
+	Generates the music of a video both as audio and as MIDI events from the same starting state,
+	then plays the events through a new synth and compares the result with the audio.
+
+	Return:
+		Whether the audio matches sample for sample, and the seconds spent generating each.
+	"""
+	audio = Atmosvideo(live=False, timing=False)
+	midi = Atmosvideo(live=False, timing=False, midi=True)
+	audio.load(path)
+	values = []
+	while audio.status == Atmosvideo.RUNNING:
+		audio.frame()
+		values.append(audio.video.values)
+	audio.video.release()
+	nsamples_frame = round(audio.music.samplerate / audio.video.fps)
+
+	# the random number generators decide the notes, so both start from the same ones
+	audio.reset()
+	midi.reset()
+	midi.set_state(audio.get_state())
+	outputs = {}
+	seconds = {}
+	for name, atmos in (("audio", audio), ("midi", midi)):
+		start = time.perf_counter()
+		outputs[name] = b"".join(atmos.synthesize(v, nsamples_frame) for v in values)
+		seconds[name] = time.perf_counter() - start
+
+	synth = Synth(audio.music.samplerate)
+	replayed = midi.music.synth.replay(synth)
+	synth.close()
+	audio.close()
+	midi.close()
+	difference = np.abs(np.frombuffer(replayed, np.int16).astype(np.int32) - np.frombuffer(outputs["audio"], np.int16)) \
+		if len(replayed) == len(outputs["audio"]) else None
+	return {
+		"frames": len(values),
+		"match": replayed == outputs["audio"],
+		"max_difference": None if difference is None else int(difference.max(initial=0)),
+		"events": len(midi.music.synth.events),
+		"seconds": seconds,
+	}
+
+
+def check_segments(path:str, quality:str = "final", segment_seconds:float = 1.0) -> dict:
+	"""
+	Renders the soundtrack of a video as cached segments three times: with no segment cached, with
+	every other one cached, and with all of them cached, and compares them with the streamed render.
+
+	Return:
+		Whether the renders with no and with all segments cached are the same as the streamed render
+		byte for byte, the difference of the one with every other segment cached, whose segments start
+		from a pre-roll, as its RMS relative to the streamed render's, and the segments each one reused.
+	"""
+	atmos = Atmosvideo(live=False, timing=False, quality=quality)
+	atmos.load(path)
+	values = []
+	while atmos.status == Atmosvideo.RUNNING:
+		atmos.frame()
+		values.append(atmos.video.values)
+	atmos.video.release()
+	values = np.array(values, dtype=np.float32)
+	cache_dir = tempfile.mkdtemp(prefix="atmos_segments_")
+	renderer = SegmentRenderer(cache_dir, atmos, segment_seconds)
+	outputs = {"streamed": atmos.render(values, atmos.video.fps)}
+	reused = {}
+	try:
+		for run in ("cold", "half", "warm"):
+			if run == "half":
+				# the segments are written in their order
+				written = sorted((entry for entry in os.scandir(cache_dir) if entry.name.endswith(".json")),
+					key=lambda entry: entry.stat().st_mtime_ns)
+				for entry in written[::2]:
+					os.remove(entry.path)
+			chunks = []
+			stats = renderer.render(os.path.basename(path), atmos.video.fps, values, chunks.append)
+			outputs[run] = b"".join(bytes(chunk) for chunk in chunks)
+			reused[run] = stats["reused"]
+	finally:
+		shutil.rmtree(cache_dir, ignore_errors=True)
+		atmos.close()
+	streamed = np.frombuffer(outputs["streamed"], np.int16).astype(np.float64)
+	half = np.frombuffer(outputs["half"], np.int16).astype(np.float64)
+	difference = np.sqrt(np.mean((half - streamed) ** 2) / max(np.mean(streamed ** 2), 1.0)) \
+		if len(half) == len(streamed) else float("inf")
+	return {
+		"segments": stats["segments"],
+		"reused": reused,
+		"match": outputs["cold"] == outputs["streamed"] == outputs["warm"],
+		"difference": float(difference),
+	}
+
+
+def reference_mapping(music:MusicGenerator, energy_p, hue_p, saturation_p, value_p, last:tuple) -> None:
+	"""
+	The hand written mapping the default profile was compiled from, kept to check it still maps the same.
+	"""
+	energy = energy_p if energy_p else last[0]
+	hue = hue_p if hue_p else last[1]
+	saturation = saturation_p if saturation_p else last[2]
+	value = value_p if value_p else last[3]
+
+	# tempo
+	if energy_p:
+		new_bpm = energy * 110 + 50
+		old_bpm = music.bpm
+		if abs(new_bpm - old_bpm) > old_bpm*0.2:
+			music.setBPM(new_bpm)
+
+	# transposition
+	if value_p:
+		music.melody.transposition = value*3 - 1
+		music.chords.transposition = 2*value-1 * (-1 if value<0.5 else 1)
+
+	# melody parameters
+	if saturation_p or energy_p or value_p:
+		music.melody.rest_rate = 0.2
+
+	# scale
+	if hue_p:
+		if hue < 0.5/6 or hue > 5.5/6:
+			scale_name = "japanese"
+		elif hue < 1.5/6:
+			scale_name = "maj_pentatonic"
+		elif hue < 2.5/6:
+			scale_name = "maj"
+		elif hue < 3.5/6:
+			scale_name = "min_pentatonic"
+		elif hue < 4.5/6:
+			scale_name = "min"
+		else:
+			scale_name = "hmin"
+		music.melody.scale = MusicGenerator.scales[scale_name]
+		music.chords.scale = MusicGenerator.scales[scale_name]
+
+	# chord type
+	if saturation_p or energy_p:
+		chord_value = 0.5*(saturation) + 0.5*(1-energy)
+		if chord_value < 1/3:
+			music.chords.chord_type = MusicGenerator.chord_types["power"]
+		if chord_value < 2/3:
+			music.chords.chord_type = MusicGenerator.chord_types["triad"]
+		else:
+			music.chords.chord_type = MusicGenerator.chord_types["seven"]
+	
+	# arpegios
+	# modified by instrument
+
+	# chord speed
+	music.chords.beats_per_chord = 4.0
+
+	# instrument selection
+	# 
+	# the volume is adjusted based on the instrument to keep the volume leveled
+	if value_p or energy_p:
+		if value < 1/3:
+			if energy < 1/6:
+				music.control.changeInstrument(music.channel["chords"],17, 89) # pad
+				music.control.changeInstrument(music.channel["melody"], 0,104) # sitar
+				music.control.set(music.chords, "arpeggio_freq", 0)
+				music.control.set(music.chords, "volume", 0.7)
+				music.control.set(music.melody, "volume", 0.5)
+			elif energy < 1/2:
+				music.control.changeInstrument(music.channel["chords"], 2, 92) # square
+				music.control.changeInstrument(music.channel["melody"], 2, 92) # square
+				music.control.set(music.chords, "arpeggio_freq", 0)
+				music.control.set(music.chords, "volume", 0.5)
+				music.control.set(music.melody, "volume", 0.7)
+			else:
+				music.control.changeInstrument(music.channel["chords"], 0, 29) # electric guitar
+				music.control.changeInstrument(music.channel["melody"], 0, 34) # bass
+				music.control.set(music.chords, "arpeggio_freq", 4)
+				music.control.set(music.chords, "volume", 0.5)
+				music.control.set(music.melody, "volume", 0.7)
+		elif value < 2/3:
+			if energy < 1/6:
+				music.control.changeInstrument(music.channel["chords"], 0, 0) # piano
+				music.control.changeInstrument(music.channel["melody"], 0, 0) # piano
+				music.control.set(music.chords, "arpeggio_freq", 0)
+				music.control.set(music.chords, "volume", 0.5)
+				music.control.set(music.melody, "volume", 0.6)
+			elif energy < 1/2:
+				music.control.changeInstrument(music.channel["chords"], 0, 0) # piano
+				music.control.changeInstrument(music.channel["melody"], 0, 71) # clarinet
+				music.control.set(music.chords, "arpeggio_freq", 0)
+				music.control.set(music.chords, "volume", 0.5)
+				music.control.set(music.melody, "volume", 0.6)
+			else:
+				pass
+		else:
+			if energy < 1/6:
+				music.control.changeInstrument(music.channel["chords"], 0, 4) # ep
+				music.control.changeInstrument(music.channel["melody"], 0, 4) # ep
+				music.control.set(music.chords, "arpeggio_freq", 0)
+				music.control.set(music.chords, "volume", 0.5)
+				music.control.set(music.melody, "volume", 0.6)
+			elif energy < 1/2:
+				music.control.changeInstrument(music.channel["chords"], 0,107) # koto
+				music.control.changeInstrument(music.channel["melody"], 1,104) # tampura
+				music.control.set(music.chords, "arpeggio_freq", 2)
+				music.control.set(music.chords, "volume", 0.5)
+				music.control.set(music.melody, "volume", 0.5)
+			else:
+				music.control.changeInstrument(music.channel["chords"], 0, 61) # brass
+				music.control.changeInstrument(music.channel["melody"], 0, 60) # f.horn
+				music.control.set(music.chords, "arpeggio_freq", 0)
+				music.control.set(music.chords, "volume", 0.45)
+				music.control.set(music.melody, "volume", 0.55)
+
+
+def check_mapping(cases:int = 20000, seed:int = 1) -> int:
+	"""
+	Applies random property changes, including the bin edges and unchanged (None or 0) properties,
+	with both the default profile and reference_mapping, and compares the resulting music state
+	and synth commands.
+
+	Return:
+		The number of cases that differ.
+	"""
+	profile = MappingProfile("default")
+	rnd = random.Random(seed)
+	edges = [-10, 0, 1/6, 1/3, 0.5, 2/3, 0.5/6, 1.5/6, 2.5/6, 3.5/6, 4.5/6, 5.5/6, 1.0]
+	mismatches = 0
+	for _ in range(cases):
+		reference = MusicGenerator(live=False, midi=True)
+		compiled = MusicGenerator(live=False, midi=True)
+		reference.bpm = compiled.bpm = rnd.choice([60, 90.5, 120, 150])
+		last = tuple(rnd.choice(edges + [rnd.random()]) for _ in range(4))
+		changed = tuple(rnd.choice([None, 0.0, rnd.random(), rnd.choice(edges)]) for _ in range(4))
+		reference_mapping(reference, *changed, last)
+		profile.apply(compiled, changed, last)
+		states = [json.dumps(music.get_state(), sort_keys=True) for music in (reference, compiled)]
+		if states[0] != states[1] or reference.synth.events != compiled.synth.events \
+				or reference.control.stats() != compiled.control.stats():
+			mismatches += 1
+	return mismatches
+
+
+def compare(results:dict, baseline:dict, threshold:float) -> list:
+	"""
+	Finds the stages that got slower than the baseline by more than the threshold.
+
+	Return:
+		A list of (fixture, stage, baseline ms, current ms) for every regression.
+	"""
+	regressions = []
+	for name, result in results["fixtures"].items():
+		if name not in baseline["fixtures"]:
+			continue
+		for stage, current in result["stages"].items():
+			before = baseline["fixtures"][name]["stages"].get(stage)
+			if before is None or before["ms_per_frame"] <= 0:
+				continue
+			if current["ms_per_frame"] > before["ms_per_frame"] * (1 + threshold):
+				regressions.append((name, stage, before["ms_per_frame"], current["ms_per_frame"]))
+	return regressions
+
+
+def import_times(module:str) -> dict:
+	"""
+	Imports a module in a fresh interpreter with -X importtime.
+
+	Return:
+		The cumulative import time of every module it loaded, in ms.
+	"""
+	process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+		cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+	if process.returncode != 0:
+		raise RuntimeError(f"Importing {module} failed:\n{process.stderr.strip().splitlines()[-1]}")
+	times = {}
+	for line in process.stderr.splitlines():
+		if not line.startswith("import time:") or "cumulative" in line:
+			continue
+		self_us, cumulative_us, name = line[len("import time:"):].split("|")
+		times[name.strip()] = int(cumulative_us) / 1000
+	return times
+
+
+def check_import_times(budgets:dict = IMPORT_BUDGETS, repeat:int = 3) -> list:
+	"""
+	Measures the cold start of the entry points against their budgets.
+
+	Return:
+		A list of failure messages, empty if every entry point is within its budget.
+	"""
+	failures = []
+	for module, (budget, forbidden) in budgets.items():
+		# the fastest run, the others include the OS warming its file cache
+		runs = [import_times(module) for _ in range(repeat)]
+		total = min(times[module] for times in runs)
+		loaded = sorted(name for name in forbidden if name in runs[0])
+		heaviest = sorted(((ms, name) for name, ms in runs[0].items() if name != module and "." not in name), reverse=True)[:5]
+		print(f"{module:<12} {total:8.1f} ms (budget {budget} ms)  heaviest: " + ", ".join(f"{name} {ms:.0f}" for ms, name in heaviest))
+		if total > budget:
+			failures.append(f"{module} takes {total:.1f} ms to import, over its {budget} ms budget")
+		if loaded:
+			failures.append(f"{module} imports {', '.join(loaded)} at startup")
+	return failures
+
+
+def main(argv=None) -> int:
+	parser = argparse.ArgumentParser(description="Benchmark every stage of the Atmosvideo pipeline on synthetic videos.")
+	parser.add_argument("--kinds", default=",".join(FIXTURE_KINDS), help="comma separated fixture kinds")
+	parser.add_argument("--resolutions", default="180,720", help=f"comma separated heights out of {sorted(RESOLUTIONS)}")
+	parser.add_argument("--seconds", default="4", help="comma separated fixture lengths in seconds")
+	parser.add_argument("--height", type=int, help="analysis height, by default the one of the quality")
+	parser.add_argument("--qualities", default="final", help=f"comma separated render tiers out of {', '.join(QUALITIES)}")
+	parser.add_argument("--save", help="write the results as a JSON baseline")
+	parser.add_argument("--compare", help="compare against a JSON baseline and fail on regressions")
+	parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown per stage, as a fraction")
+	parser.add_argument("--importtime", action="store_true", help="only check the cold start of the entry points")
+	parser.add_argument("--midi", action="store_true", help="only check that MIDI export played through the synth matches the audio")
+	parser.add_argument("--segments", action="store_true",
+		help="only check that segment renders match the streamed render whichever segments were cached")
+	parser.add_argument("--audio-tolerance", type=float, default=0.01,
+		help="RMS difference with the streamed render allowed to a render continued after cached segments, "
+		"and to the WAV outputs of --farm, as a fraction")
+	parser.add_argument("--mapping", action="store_true", help="only check that the default mapping profile maps like the reference mapping")
+	parser.add_argument("--tiling", action="store_true",
+		help="only compare the tiled optical flow with column strips and the untiled flow, in time and energy")
+	parser.add_argument("--workers", help=f"comma separated worker counts for --tiling, by default 1, 2, 4 and {os.cpu_count()}")
+	parser.add_argument("--halos", default="0,12,24", help="comma separated halo widths for --tiling")
+	parser.add_argument("--service", type=int, metavar="REQUESTS",
+		help="only load test the HTTP service with this many requests for the fixtures")
+	parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients of --service")
+	parser.add_argument("--format", choices=("mp4", "wav", "mp3", "mid"), default="wav", help="output format of --service and --farm")
+	parser.add_argument("--farm", type=int, metavar="WORKERS",
+		help="only check the render farm on this many local workers (at least 3), with and without lost workers")
+	parser.add_argument("--governor", type=float, metavar="MS",
+		help="only run the analysis under the adaptive governor with this deadline per frame, and check that "
+			"every level of its ladder keeps the energy of level 0")
+	parser.add_argument("--videos", help="comma separated videos --governor runs on instead of the synthetic fixtures, e.g. videos/earth1.mp4")
+	parser.add_argument("--energy-tolerance", type=float, default=0.05,
+		help="difference of the mean energy with level 0 allowed to every level of --governor, as a fraction")
+	parser.add_argument("--motion", action="store_true", help="only measure the cost of the motion features over the energy alone")
+	parser.add_argument("--live", type=float, metavar="SPEED",
+		help="only replay the fixtures as live sources at this many times real time, failing over --max-latency")
+	parser.add_argument("--preview", type=float, metavar="SPEED",
+		help="only check that a live preview, against a player at SPEED times real time, survives the end of the video and a seek back")
+	parser.add_argument("--max-latency", type=float, default=0.25, help="latency bound of --live, in seconds")
+	args = parser.parse_args(argv)
+
+	if args.importtime:
+		failures = check_import_times()
+		for failure in failures:
+			print(f"REGRESSION {failure}")
+		return 1 if failures else 0
+
+	if args.mapping:
+		mismatches = check_mapping()
+		print(f"Default profile: {mismatches} mismatches with the reference mapping")
+		return 1 if mismatches else 0
+
+	if args.service:
+		videos = [make_fixture(kind, resolution, float(args.seconds.split(",")[0]))
+			for kind in args.kinds.split(",") for resolution in map(int, args.resolutions.split(","))]
+		results = bench_service(videos, args.format, args.service, args.concurrency, max(os.cpu_count() // 2, 1))
+		for run, result in results.items():
+			latency = result["latency"]
+			print(f"{run}: {result['requests']} requests for {len(videos)} videos from {args.concurrency} clients in "
+				f"{result['seconds']:.1f}s, {result['throughput']:.1f} requests/s")
+			print(f"  latency p50 {latency['p50']:.2f}s  p95 {latency['p95']:.2f}s  p99 {latency['p99']:.2f}s  max {latency['max']:.2f}s")
+			print(f"  {result['jobs']} jobs ({result['from_cache']} from the render cache), {result['joined']} requests joined a job, "
+				f"{result['refused']} refusals, {result['errors']} errors")
+		return 1 if any(result["errors"] for result in results.values()) else 0
+
+	if args.farm:
+		videos = [os.path.abspath(make_fixture(kind, resolution, float(args.seconds.split(",")[0])))
+			for kind in args.kinds.split(",") for resolution in map(int, args.resolutions.split(","))]
+		results = bench_farm(videos, args.format, max(args.farm, 3))
+		print(f"{results['videos']} videos, single process analysis {results['sequential_analysis_seconds']:.1f}s")
+		for run in ("clean", "faults"):
+			result = results[run]
+			print(f"{run}: {result['seconds']:.1f}s, {result['tasks']} tasks, {result['lost_workers']} workers lost, "
+				f"{result['reassigned']} tasks reassigned, {result['errors']} errors, "
+				f"timeline difference {result['timeline_difference']:g}")
+		print(f"outputs {'identical' if results['identical'] else 'DIFFER'}")
+		local = results["local_difference"]
+		print("outputs not compared with a local render, the format is lossy" if local is None else
+			f"largest difference with a local render {local:.2%}")
+		failed = results["faults"]["reassigned"] < 1 or not results["identical"] or (local is not None and local > args.audio_tolerance)
+		return 1 if failed or any(results[run]["errors"] or results[run]["timeline_difference"] for run in ("clean", "faults")) else 0
+
+	if args.tiling:
+		height = args.height if args.height else quality_settings(args.qualities.split(",")[0])["analysis_height"]
+		workers = list(map(int, args.workers.split(","))) if args.workers else sorted({1, 2, 4, os.cpu_count()})
+		halos = list(map(int, args.halos.split(",")))
+		for kind in args.kinds.split(","):
+			for resolution in map(int, args.resolutions.split(",")):
+				path = make_fixture(kind, resolution, float(args.seconds.split(",")[0]))
+				results = bench_tiling(path, height, workers, halos)
+				untiled = results["untiled"]["ms_per_frame"]
+				print(f"{os.path.basename(path)}: {results['frames']} frame pairs, untiled {untiled:.2f} ms/frame")
+				for name, result in results.items():
+					if name in ("frames", "untiled"):
+						continue
+					print(f"  {name:<12} {result['ms_per_frame']:7.2f} ms/frame  {untiled / max(result['ms_per_frame'], 1e-9):5.2f}x  "
+						f"energy difference {result['difference']:.4f}" + (f"  {result['tiles']} tiles" if "tiles" in result else ""))
+		return 0
+
+	if args.governor:
+		height = args.height if args.height else quality_settings(args.qualities.split(",")[0])["analysis_height"]
+		paths = args.videos.split(",") if args.videos else [make_fixture(kind, resolution, float(args.seconds.split(",")[0]))
+			for kind in args.kinds.split(",") for resolution in map(int, args.resolutions.split(","))]
+		over = 0
+		for path in paths:
+			result = bench_governor(path, height, args.governor / 1000.0)
+			print(f"{os.path.basename(path):<22} {result['frames']:5d} frames  {result['ms_per_frame']:.2f} ms/frame  "
+				f"{result['deadline_misses']} over {args.governor:g} ms  {len(result['decisions'])} decisions  "
+				f"final level {result['level']} {result['settings']}")
+			levels = check_governor_levels(path, height)
+			over += sum(abs(level["difference"]) > args.energy_tolerance for level in levels)
+			print("  levels: " + "  ".join(f"{i}: {level['ms_per_frame']:.1f} ms, energy {level['energy']:.4f} "
+				f"({100.0 * level['difference']:+.1f}%{'' if abs(level['difference']) <= args.energy_tolerance else ' OVER'})"
+				for i, level in enumerate(levels)))
+		return 1 if over else 0
+
+	if args.motion:
+		height = args.height if args.height else quality_settings(args.qualities.split(",")[0])["analysis_height"]
+		for kind in args.kinds.split(","):
+			for resolution in map(int, args.resolutions.split(",")):
+				path = make_fixture(kind, resolution, float(args.seconds.split(",")[0]))
+				result = bench_motion(path, height)
+				ms = result["ms_per_frame"]
+				print(f"{os.path.basename(path):<22} {result['frames']:5d} frame pairs  flow {ms['flow']:.2f} ms/frame  "
+					f"energy only {ms['energy']:.3f} ms  with motion {ms['motion']:.3f} ms  ({100.0 * result['overhead']:+.1f}% of the pass)")
+		return 0
+
+	if args.live:
+		over = 0
+		for kind in args.kinds.split(","):
+			for resolution in map(int, args.resolutions.split(",")):
+				path = make_fixture(kind, resolution, float(args.seconds.split(",")[0]))
+				result = bench_live(path, args.live, args.max_latency)
+				latency = result["synthesis_latency"]
+				over += latency["p95_s"] is None or latency["p95_s"] > args.max_latency or not result["finished"]
+				print(f"{os.path.basename(path):<22} {result['frames']:5d} of {result['source_frames']} frames analysed, "
+					f"{result['dropped_frames']} dropped  capture to synthesis mean {1000.0 * latency['mean_s']:.1f} ms  "
+					f"p95 {1000.0 * latency['p95_s']:.1f} ms  max {1000.0 * latency['max_s']:.1f} ms  "
+					f"{len(result['analysis']['decisions'])} governor decisions"
+					+ ("" if result["finished"] else "  END NOT REACHED"))
+		return 1 if over else 0
+
+	if args.preview:
+		failures = 0
+		for kind in args.kinds.split(","):
+			path = make_fixture(kind, 180, float(args.seconds.split(",")[0]))
+			result = bench_preview(path, args.preview)
+			ok = result["timed"] and all(run["finished"] and run["alive"] and run["frames"] for run in result["passes"])
+			failures += not ok
+			print(f"{os.path.basename(path):<22} " + "  ".join(f"pass {i + 1}: {run['frames']} frames, "
+				f"{'finished' if run['finished'] else 'NOT FINISHED'}{'' if run['alive'] else ', THREAD DIED'}"
+				for i, run in enumerate(result["passes"])) + f"  {result['stats']['seeks']} seeks  {'ok' if ok else 'FAILED'}")
+		return 1 if failures else 0
+
+	if args.segments:
+		mismatches = 0
+		for quality in args.qualities.split(","):
+			for kind in args.kinds.split(","):
+				path = make_fixture(kind, 180, float(args.seconds.split(",")[0]))
+				check = check_segments(path, quality)
+				ok = check["match"] and check["difference"] <= args.audio_tolerance
+				mismatches += not ok
+				print(f"{os.path.basename(path):<22} {quality:<6} {check['segments']:3d} segments  reused cold {check['reused']['cold']}, "
+					f"half {check['reused']['half']}, warm {check['reused']['warm']}  "
+					f"{'same as streamed' if check['match'] else 'DIFFERENT FROM STREAMED'}, "
+					f"half cached off by {check['difference']:.2%}  {'ok' if ok else 'FAILED'}")
+		return 1 if mismatches else 0
+
+	if args.midi:
+		mismatches = 0
+		for kind in args.kinds.split(","):
+			path = make_fixture(kind, 180, float(args.seconds.split(",")[0]))
+			check = check_midi(path)
+			mismatches += not check["match"]
+			speedup = check["seconds"]["audio"] / max(check["seconds"]["midi"], 1e-9)
+			print(f"{os.path.basename(path):<22} {check['frames']:5d} frames  {check['events']:5d} events  "
+				f"{'match' if check['match'] else 'MISMATCH'} (max difference {check['max_difference']})  "
+				f"audio {check['seconds']['audio']:.2f}s  midi {check['seconds']['midi']:.2f}s  ({speedup:.0f}x)")
+		return 1 if mismatches else 0
+
+	results = {
+		"machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+		"height": args.height,
+		"fixtures": {},
+	}
+	qualities = args.qualities.split(",")
+	for quality in qualities:
+		atmos = Atmosvideo(live=False, timing=False, quality=quality)
+		height = args.height if args.height else quality_settings(quality)["analysis_height"]
+		for kind in args.kinds.split(","):
+			for resolution in map(int, args.resolutions.split(",")):
+				for seconds in map(float, args.seconds.split(",")):
+					path = make_fixture(kind, resolution, seconds)
+					name = os.path.splitext(os.path.basename(path))[0]
+					# the final tier keeps the plain names, so older baselines still compare
+					name = name if quality == "final" else f"{name}@{quality}"
+					result = bench_video(path, atmos, height)
+					results["fixtures"][name] = result
+					timings = "  ".join(f"{stage} {result['stages'][stage]['ms_per_frame']:.2f}" for stage in STAGES)
+					control = result["synth_control"]
+					print(f"{name:<28} {result['frames']:5d} frames  ms/frame: {timings}  "
+						f"synth commands: {control['issued']} issued, {control['dropped'] + control['merged']} dropped")
+		atmos.close()
+
+	if "final" in qualities:
+		for quality in qualities:
+			if quality == "final":
+				continue
+			for name, result in results["fixtures"].items():
+				if "@" in name or f"{name}@{quality}" not in results["fixtures"]:
+					continue
+				final = sum(stage["seconds"] for stage in result["stages"].values())
+				tier = sum(stage["seconds"] for stage in results["fixtures"][f"{name}@{quality}"]["stages"].values())
+				print(f"{quality} speedup {name}: {final / max(tier, 1e-9):.2f}x")
+
+	if args.save:
+		with open(args.save, "w") as f:
+			json.dump(results, f, indent=2)
+		print(f"Baseline written to {args.save}")
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		regressions = compare(results, baseline, args.threshold)
+		for name, stage, before, current in regressions:
+			print(f"REGRESSION {name} {stage}: {before:.2f} -> {current:.2f} ms/frame ({current/before - 1:+.0%})")
+		if regressions:
+			return 1
+		print(f"No regressions beyond {args.threshold:.0%}")
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
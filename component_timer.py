@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+import time
+from array import array
+
+import numpy as np
+
+
+
+# class to time specific parts of the code
+class ComponentTimer():
+	"""
+	Times named components of the code, from any thread.
+
+	Besides the cumulative time of each component, the duration of every event is kept so
+	latency percentiles can be reported, and with trace enabled every span is recorded with
+	its thread so the run can be exported to the Chrome trace format (chrome://tracing, Perfetto).
+	A disabled timer returns immediately from start() and time(). A component is ended by time()
+	on the thread that started it, a time() without a matching start() is ignored.
+
+	A ResourceMonitor set as monitor is told when the stages it accounts for start and end,
+	whether the timer is enabled or not.
+	"""
+	def __init__(self, enabled:bool = True, trace:bool = False) -> None:
+		"""
+		Args:
+			enabled (bool): Whether anything is timed at all.
+			trace (bool): Whether every span is kept for export_chrome_trace.
+		"""
+		self.enabled = enabled
+		self.trace = trace
+		self.lock = threading.Lock()
+		self.monitor = None
+		self.reset()
+
+
+	def reset(self) -> None:
+		self.component = {}
+		self.durations = {}
+		self.start_time = {}
+		self.spans = []
+		self.thread_names = {}
+		self.origin = time.perf_counter_ns()
+	
+
+	def start(self, component = "__default__") -> None:
+		if self.monitor is not None and component in self.monitor.stages:
+			self.monitor.enter(component)
+		if not self.enabled:
+			return
+		self.start_time[(component, threading.get_ident())] = time.perf_counter_ns()
+
+
+	def time(self, component = "__default__") -> None:
+		if self.monitor is not None and component in self.monitor.stages:
+			self.monitor.leave(component)
+		if not self.enabled:
+			return
+		new_ts = time.perf_counter_ns()
+		tid = threading.get_ident()
+		start_ts = self.start_time.pop((component, tid), None)
+		# started on another thread, or already ended: there is no span to record
+		if start_ts is None:
+			return
+		with self.lock:
+			if component in self.component.keys():
+				self.component[component] += new_ts - start_ts
+				self.durations[component].append(new_ts - start_ts)
+			else:
+				self.component[component] = new_ts - start_ts
+				self.durations[component] = array("q", [new_ts - start_ts])
+			if self.trace:
+				self.spans.append((component, tid, start_ts, new_ts))
+				if tid not in self.thread_names:
+					self.thread_names[tid] = threading.current_thread().name
+
+
+	def get_all_components(self) -> dict:
+		return self.component
+
+
+	def get(self, component = "__default__") -> int:
+		return self.component[component]
+
+	def get_sum(self) -> int:
+		sum = 0
+		for _, v in self.component.items():
+			sum += v
+		return sum
+
+
+	def percentiles(self, component = "__default__", percents = (50, 95, 99)) -> list:
+		"""
+		Return:
+			The event durations of the component at the given percentiles, in nanoseconds.
+		"""
+		durations = np.frombuffer(self.durations[component], dtype=np.int64)
+		return [float(p) for p in np.percentile(durations, percents)]
+
+
+	def summary(self) -> dict:
+		"""
+		Return:
+			For every component the event count and the total, p50, p95, p99 and max durations in milliseconds.
+		"""
+		summary = {}
+		for component, durations in self.durations.items():
+			p50, p95, p99 = self.percentiles(component)
+			summary[component] = {
+				"count": len(durations),
+				"total_ms": self.component[component] / 1_000_000.0,
+				"p50_ms": p50 / 1_000_000.0,
+				"p95_ms": p95 / 1_000_000.0,
+				"p99_ms": p99 / 1_000_000.0,
+				"max_ms": max(durations) / 1_000_000.0,
+			}
+		return summary
+
+
+	def export_chrome_trace(self, path:str) -> None:
+		"""
+		Writes the recorded spans as a Chrome trace JSON file. Requires trace to be enabled.
+		"""
+		pid = os.getpid()
+		events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+			for tid, name in self.thread_names.items()]
+		for component, tid, start_ts, end_ts in self.spans:
+			events.append({
+				"name": component,
+				"ph": "X",
+				"pid": pid,
+				"tid": tid,
+				"ts": (start_ts - self.origin) / 1000.0,
+				"dur": (end_ts - start_ts) / 1000.0,
+			})
+		with open(path, "w") as f:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
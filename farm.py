@@ -0,0 +1,781 @@
+import argparse
+import heapq
+import itertools
+import json
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from batch import OUTPUT_FORMATS, WavSink, find_videos, is_up_to_date, output_path_for, record_settings, render_settings
+from muxer import AudioMuxer
+from quality import QUALITIES, quality_settings
+from timeline import CHANNELS
+
+
+# A message is a fixed prefix, little endian (header length u32, payload length u32), then the
+# header as JSON and the payload as raw bytes: timeline values as float32 (frames, channels)
+# arrays, audio as 16 bit PCM, MIDI files as they are saved.
+#
+#   worker -> coordinator    hello {name}, ready {params}, heartbeat, result {id, ...}, error {id, error}
+#   coordinator -> worker    welcome {settings}, task {id, kind, ...}, stop
+PREFIX = struct.Struct("<II")
+DEFAULT_PORT = 8766
+HEARTBEAT = 2.0
+
+
+
+def send_message(sock:socket.socket, header:dict, payload:bytes = b"") -> None:
+	data = json.dumps(header).encode()
+	sock.sendall(PREFIX.pack(len(data), len(payload)) + data)
+	if payload:
+		sock.sendall(payload)
+
+
+def recv_exactly(sock:socket.socket, size:int) -> bytes:
+	data = bytearray(size)
+	view = memoryview(data)
+	received = 0
+	while received < size:
+		n = sock.recv_into(view[received:])
+		if not n:
+			raise ConnectionError("connection closed")
+		received += n
+	return bytes(data)
+
+
+def recv_message(sock:socket.socket) -> tuple:
+	"""
+	Return:
+		(header, payload) of the next message.
+	"""
+	header_size, payload_size = PREFIX.unpack(recv_exactly(sock, PREFIX.size))
+	header = json.loads(recv_exactly(sock, header_size))
+	return header, recv_exactly(sock, payload_size) if payload_size else b""
+
+
+def probe(video_path:str) -> tuple:
+	"""
+	Return:
+		(frames, fps) of a video from its container, the frame count can be off by a few frames.
+	"""
+	import cv2
+	capture = cv2.VideoCapture(video_path)
+	try:
+		if not capture.isOpened():
+			raise RuntimeError(f"Couldn't open \"{video_path}\"")
+		return int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), capture.get(cv2.CAP_PROP_FPS)
+	finally:
+		capture.release()
+
+
+class FarmVideo():
+	"""
+	A video going through the farm: analysed in ranges, scored, then rendered in segments.
+	Its fields are only changed under the coordinator's lock.
+	"""
+	def __init__(self, index:int, path:str, output_path:str) -> None:
+		self.index = index
+		self.path = path
+		self.output_path = output_path
+		self.status = "queued"
+		self.fps = None
+		self.features_key = None
+		self.ranges = []
+		self.timeline = None
+		self.segment_frames = None
+		self.segments = []
+		self.tasks = 0
+		self.reassigned = 0
+		self.error = None
+		self.start = None
+		self.seconds = None
+
+	def report(self) -> dict:
+		result = {"input": self.path, "output": self.output_path, "status": self.status, "tasks": self.tasks,
+			"reassigned": self.reassigned}
+		if self.error:
+			result["error"] = self.error
+		if self.timeline is not None:
+			result["frames"] = len(self.timeline)
+			result["fps"] = self.fps
+		if self.features_key:
+			result["features_key"] = self.features_key
+		if self.seconds is not None:
+			result["seconds"] = self.seconds
+		return result
+
+
+class FarmTask():
+	"""
+	A unit of work handed to a worker.
+
+	analysis    the values of a range of frames of a video, [start, stop) of its timeline, stop None to its end
+	score       where the pre-roll of every segment starts and the music state there, found by generating the
+	            MIDI of the whole timeline, which costs no more than reading it, see segments.score_segments().
+	            For MIDI output it is the soundtrack.
+	render      the audio of a segment, from the music state at the start of its pre-roll and the values from
+	            there, [preroll, stop) of the timeline, of which the samples before start are dropped
+	"""
+	ANALYSIS = "analysis"
+	SCORE = "score"
+	RENDER = "render"
+
+	def __init__(self, task_id:int, video:FarmVideo, kind:str, index:int = 0, start:int = 0, stop:int = None,
+			state:dict = None, preroll:int = None) -> None:
+		self.id = task_id
+		self.video = video
+		self.kind = kind
+		self.index = index
+		self.start = start
+		self.stop = stop
+		self.state = state
+		self.preroll = start if preroll is None else preroll
+		self.attempts = 0
+
+	def message(self, coordinator:"FarmCoordinator") -> tuple:
+		header = {"type": "task", "id": self.id, "kind": self.kind, "video": self.video.path, "index": self.index,
+			"start": self.start, "stop": self.stop}
+		payload = b""
+		if self.kind != FarmTask.ANALYSIS:
+			header["fps"] = self.video.fps
+			header["segment_frames"] = self.video.segment_frames
+			header["state"] = self.state
+			header["preroll"] = self.preroll
+			header["output_format"] = coordinator.output_format
+			payload = self.video.timeline.read(self.preroll, self.stop).tobytes()
+		return header, payload
+
+
+class FarmCoordinator():
+	"""
+	Generates the soundtracks of many videos on worker processes connected over TCP, see FarmWorker.
+
+	Every video is analysed in ranges of range_seconds, which the workers analyse in parallel and the
+	coordinator stitches into a timeline (kept in the feature cache when cache_dir is given). A
+	score task then plays the timeline through the music generators without synthesizing audio,
+	finding where the pre-roll of every segment of segment_seconds starts and the music state there.
+	The segments are rendered in parallel from those states, each after its pre-roll as a segment
+	following a cached one is by SegmentRenderer, so they have the notes of a local render, and are
+	concatenated into the output.
+
+	Workers send heartbeats while working. A worker whose connection drops or stays silent for
+	heartbeat_timeout is dropped and its task handed to another, a task losing its worker
+	max_attempts times fails its video. The workers need the videos at the same paths, e.g. on a
+	shared drive, everything else goes through the connections.
+	"""
+
+	def __init__(self, videos:list, output_dir:str, output_format:str = "wav", host:str = "127.0.0.1", port:int = DEFAULT_PORT,
+			cache_dir:str = None, sample_rate:int = None, quality:str = "final", seed:int = 0, profile:str = "default",
+			range_seconds:float = 30.0, segment_seconds:float = 10.0, heartbeat_timeout:float = 5 * HEARTBEAT,
+			max_attempts:int = 3, force:bool = False) -> None:
+		"""
+		Args:
+			videos (list): The paths of the videos.
+			output_dir (str): Where the soundtracks are written.
+			host, port: The address the workers connect to, port 0 picks a free port.
+			cache_dir (str): Directory of the feature cache, videos already analysed aren't analysed again.
+			sample_rate, quality, seed, profile: The settings of the soundtracks, see batch.py. They are
+				sent to the workers, so every worker renders the same music.
+			range_seconds (float): The length of the ranges the videos are analysed in.
+			segment_seconds (float): The length of the rendered segments.
+			heartbeat_timeout (float): The seconds without news after which a busy worker is dropped.
+			max_attempts (int): The workers a task may lose before its video fails.
+			force (bool): Generate soundtracks that are already up to date.
+		"""
+		if output_format not in OUTPUT_FORMATS:
+			raise ValueError(f"Unknown format \"{output_format}\", expected one of {', '.join(OUTPUT_FORMATS)}")
+		settings = quality_settings(quality, sample_rate)
+		self.output_dir = output_dir
+		self.output_format = output_format
+		self.address = (host, port)
+		self.cache_dir = cache_dir
+		self.settings = {"sample_rate": sample_rate, "quality": quality, "seed": seed, "profile": profile,
+			"midi": output_format == "mid"}
+		self.sample_rate = settings["sample_rate"]
+		self.channels = settings["channels"]
+		self.range_seconds = range_seconds
+		self.segment_seconds = segment_seconds
+		self.heartbeat_timeout = heartbeat_timeout
+		self.max_attempts = max_attempts
+		self.force = force
+		# recorded next to every output, the segments are rendered as by batch.py with a cache directory
+		self.render_settings = render_settings(output_format, sample_rate, quality, None, seed, profile,
+			segment_seconds if output_format != "mid" else None)
+		self.params = None
+		os.makedirs(output_dir, exist_ok=True)
+		self.work_dir = tempfile.mkdtemp(prefix=".farm-", dir=output_dir)
+		self.videos = [FarmVideo(i, path, output_path_for(path, output_dir, output_format)) for i, path in enumerate(videos)]
+		self.lock = threading.Condition()
+		self.queue = []
+		self.task_ids = itertools.count()
+		self.workers = {}
+		self.lost_workers = 0
+		self.finished = False
+		self.server = None
+		self.start_time = None
+		# timelines and soundtracks are put together here, the connections keep serving the workers
+		self.stitcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stitch")
+
+	def start(self) -> int:
+		"""
+		Plans the work and starts accepting workers.
+
+		Return:
+			The port the workers connect to.
+		"""
+		from video_properties_2 import VideoPropertiesExtractor
+		# the workers analyse with the extractor of the quality, whose settings key the feature cache
+		self.params = VideoPropertiesExtractor(quality_settings(self.settings["quality"])["analysis_height"]).params()
+		self.start_time = time.perf_counter()
+		with self.lock:
+			for video in self.videos:
+				self.plan(video)
+			self.check_finished()
+
+		self.server = socket.create_server(self.address)
+		threading.Thread(target=self.accept, daemon=True).start()
+		return self.server.getsockname()[1]
+
+	def plan(self, video:FarmVideo) -> None:
+		# called under the lock
+		if not self.force and is_up_to_date(video.path, video.output_path, self.render_settings):
+			video.status = "skipped"
+			return
+		video.start = time.perf_counter()
+		try:
+			frames, video.fps = probe(video.path)
+			if self.cache_dir:
+				from feature_cache import FeatureCache
+				features = FeatureCache(os.path.join(self.cache_dir, "features"))
+				video.features_key = features.key(video.path, self.params)
+				cached = features.load(video.features_key)
+				if cached is not None:
+					video.fps, video.timeline = cached
+					self.score(video)
+					return
+		except (OSError, RuntimeError) as e:
+			self.fail(video, str(e))
+			return
+
+		video.status = "analysis"
+		# a frame's values need the frame before, the timeline has one row less than the video
+		range_frames = max(1, round(self.range_seconds * video.fps))
+		starts = list(range(0, max(frames - 1, 1), range_frames))
+		video.ranges = [None] * len(starts)
+		for i, start in enumerate(starts):
+			# the last range goes to the end whatever the container said
+			stop = starts[i + 1] if i + 1 < len(starts) else None
+			self.push(FarmTask(next(self.task_ids), video, FarmTask.ANALYSIS, i, start, stop))
+
+	def push(self, task:FarmTask) -> None:
+		# called under the lock. The earliest video is served first so soundtracks are finished one after the other
+		task.video.tasks += 1
+		heapq.heappush(self.queue, (task.video.index, task.id, task))
+		self.lock.notify_all()
+
+	def next_task(self) -> FarmTask:
+		"""
+		Waits for a task to hand out.
+
+		Return:
+			The task, or None once every video is finished.
+		"""
+		with self.lock:
+			while True:
+				while self.queue:
+					_, _, task = heapq.heappop(self.queue)
+					# the tasks of a failed video are dropped
+					if task.video.status not in ("done", "error"):
+						return task
+				if self.finished:
+					return None
+				self.lock.wait()
+
+	def accept(self) -> None:
+		while True:
+			try:
+				conn, address = self.server.accept()
+			except OSError:
+				return
+			threading.Thread(target=self.serve_worker, args=(conn,), daemon=True).start()
+
+	def serve_worker(self, conn:socket.socket) -> None:
+		name = None
+		task = None
+		try:
+			conn.settimeout(self.heartbeat_timeout)
+			conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			header, _ = recv_message(conn)
+			name = header.get("name", "worker")
+			send_message(conn, {"type": "welcome", "settings": self.settings})
+			header, _ = recv_message(conn)
+			if header.get("params") != self.params:
+				raise ConnectionError(f"{name} analyses with {header.get('params')} instead of {self.params}")
+			with self.lock:
+				self.workers[name] = {"tasks": 0, "busy": None, "connected": time.time()}
+			while True:
+				task = self.next_task()
+				if task is None:
+					send_message(conn, {"type": "stop"})
+					return
+				with self.lock:
+					self.workers[name]["busy"] = task.kind
+				send_message(conn, *task.message(self))
+				while True:
+					# anything, heartbeats included, shows the worker is alive
+					header, payload = recv_message(conn)
+					if header["type"] != "heartbeat":
+						break
+				if header["type"] == "error":
+					with self.lock:
+						self.fail(task.video, header["error"])
+				else:
+					self.complete(task, header, payload)
+				with self.lock:
+					self.workers[name]["tasks"] += 1
+					self.workers[name]["busy"] = None
+				task = None
+		except (OSError, ValueError, KeyError) as e:
+			with self.lock:
+				if name in self.workers:
+					self.workers[name]["busy"] = None
+					self.workers[name]["lost"] = str(e) or type(e).__name__
+				if task is not None:
+					self.lost_workers += 1
+					self.reassign(task, name, e)
+		finally:
+			conn.close()
+
+	def reassign(self, task:FarmTask, name:str, error:Exception) -> None:
+		# called under the lock
+		task.attempts += 1
+		task.video.reassigned += 1
+		if task.attempts >= self.max_attempts:
+			self.fail(task.video, f"lost {task.attempts} workers on its {task.kind} task, the last was {name} ({error})")
+			return
+		print(f"Lost {name} ({error or type(error).__name__}), reassigning {task.kind} {task.index} of {os.path.basename(task.video.path)}")
+		task.video.tasks -= 1
+		self.push(task)
+
+	def complete(self, task:FarmTask, header:dict, payload:bytes) -> None:
+		video = task.video
+		if task.kind == FarmTask.ANALYSIS:
+			values = np.frombuffer(payload, dtype=np.float32).reshape(header["frames"], -1)
+			with self.lock:
+				if video.status == "error":
+					return
+				video.ranges[task.index] = values
+				if any(values is None for values in video.ranges):
+					return
+			self.stitcher.submit(self.stitch_timeline, video)
+		elif task.kind == FarmTask.SCORE:
+			if self.output_format == "mid":
+				self.stitcher.submit(self.write_output, video, payload)
+				return
+			with self.lock:
+				if video.status == "error":
+					return
+				video.status = "render"
+				video.segments = [None] * len(header["states"])
+				for i, (preroll, state) in enumerate(zip(header["prerolls"], header["states"])):
+					start = i * video.segment_frames
+					self.push(FarmTask(next(self.task_ids), video, FarmTask.RENDER, i, start, start + video.segment_frames, state,
+						preroll))
+		else:
+			path = os.path.join(self.work_dir, f"{video.index}.{task.index}.pcm")
+			with open(path, "wb") as f:
+				f.write(payload)
+			with self.lock:
+				if video.status == "error":
+					return
+				video.segments[task.index] = path
+				if any(path is None for path in video.segments):
+					return
+			self.stitcher.submit(self.stitch_audio, video)
+
+	def stitch_timeline(self, video:FarmVideo) -> None:
+		try:
+			if self.cache_dir:
+				from feature_cache import FeatureCache
+				writer = FeatureCache(os.path.join(self.cache_dir, "features")).writer(video.features_key, video.fps, self.params)
+			else:
+				from timeline import TimelineWriter
+				writer = TimelineWriter(os.path.join(self.work_dir, f"{video.index}.timeline"), video.fps, self.params)
+			for values in video.ranges:
+				for row in values:
+					writer.append(row)
+			writer.close()
+			from timeline import Timeline
+			timeline = Timeline(writer.path)
+		except OSError as e:
+			with self.lock:
+				self.fail(video, str(e))
+			return
+		with self.lock:
+			video.ranges = []
+			video.timeline = timeline
+			self.score(video)
+
+	def score(self, video:FarmVideo) -> None:
+		# called under the lock
+		if not len(video.timeline):
+			self.fail(video, "no frames could be read")
+			return
+		video.status = "score"
+		video.segment_frames = max(1, round(self.segment_seconds * video.fps))
+		self.push(FarmTask(next(self.task_ids), video, FarmTask.SCORE))
+
+	def stitch_audio(self, video:FarmVideo) -> None:
+		tmp_path = f"{video.output_path}.part.{self.output_format}"
+		if self.output_format == "wav":
+			sink = WavSink(tmp_path, self.sample_rate, self.channels)
+		else:
+			sink = AudioMuxer(tmp_path, self.sample_rate, self.channels,
+				video_path=video.path if self.output_format == "mp4" else None)
+		try:
+			if isinstance(sink, AudioMuxer):
+				sink.open()
+			for path in video.segments:
+				with open(path, "rb") as f:
+					sink.write(f.read())
+				os.remove(path)
+			sink.close()
+			os.replace(tmp_path, video.output_path)
+		except Exception as e:
+			if isinstance(sink, AudioMuxer):
+				sink.abort()
+			elif os.path.exists(tmp_path):
+				os.remove(tmp_path)
+			with self.lock:
+				self.fail(video, str(e))
+			return
+		with self.lock:
+			self.done(video)
+
+	def write_output(self, video:FarmVideo, data:bytes) -> None:
+		tmp_path = f"{video.output_path}.part.{self.output_format}"
+		try:
+			with open(tmp_path, "wb") as f:
+				f.write(data)
+			os.replace(tmp_path, video.output_path)
+		except OSError as e:
+			with self.lock:
+				self.fail(video, str(e))
+			return
+		with self.lock:
+			self.done(video)
+
+	def done(self, video:FarmVideo) -> None:
+		# called under the lock
+		if video.status == "error":
+			return
+		video.status = "done"
+		try:
+			record_settings(video.output_path, self.render_settings)
+		except OSError:
+			# the output is then rendered again on the next run
+			pass
+		self.finish(video)
+		print(f"{os.path.basename(video.path)}: {len(video.timeline)} frames in {video.seconds:.1f}s, {video.tasks} tasks"
+			+ (f", {video.reassigned} reassigned" if video.reassigned else ""))
+
+	def fail(self, video:FarmVideo, error:str) -> None:
+		# called under the lock
+		if video.status in ("done", "error"):
+			return
+		video.status = "error"
+		video.error = error
+		self.finish(video)
+		print(f"{os.path.basename(video.path)}: error ({error})")
+
+	def finish(self, video:FarmVideo) -> None:
+		# called under the lock
+		video.ranges = []
+		if video.start is not None:
+			video.seconds = time.perf_counter() - video.start
+		if video.timeline is not None:
+			video.timeline.close()
+		for path in video.segments:
+			if path is not None and os.path.exists(path):
+				os.remove(path)
+		self.check_finished()
+
+	def check_finished(self) -> None:
+		# called under the lock
+		if all(video.status in ("done", "error", "skipped") for video in self.videos):
+			self.finished = True
+			self.lock.notify_all()
+
+	def wait(self, timeout:float = None) -> dict:
+		"""
+		Waits until every video is finished.
+
+		Return:
+			The report of the run, like the one of batch.py with the tasks of every video and the workers.
+		"""
+		with self.lock:
+			self.lock.wait_for(lambda: self.finished, timeout)
+			return {
+				"format": self.output_format,
+				"settings": self.settings,
+				"finished": self.finished,
+				"seconds": time.perf_counter() - self.start_time,
+				"workers": {name: dict(worker) for name, worker in self.workers.items()},
+				"lost_workers": self.lost_workers,
+				"videos": [video.report() for video in self.videos],
+			}
+
+	def close(self) -> None:
+		with self.lock:
+			self.finished = True
+			self.lock.notify_all()
+		if self.server is not None:
+			self.server.close()
+		self.stitcher.shutdown(wait=True)
+		shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class FarmWorker():
+	"""
+	Runs the tasks of a FarmCoordinator until it says stop or goes away.
+	"""
+
+	def __init__(self, host:str, port:int = DEFAULT_PORT, name:str = None, heartbeat:float = HEARTBEAT) -> None:
+		self.address = (host, port)
+		self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+		self.heartbeat = heartbeat
+		self.sock = None
+		self.send_lock = threading.Lock()
+		self.atmos = None
+		# generates the music states without synthesizing audio, see score()
+		self.scorer = None
+
+	def send(self, header:dict, payload:bytes = b"") -> None:
+		with self.send_lock:
+			send_message(self.sock, header, payload)
+
+	def connect(self, retry_seconds:float) -> None:
+		deadline = time.monotonic() + retry_seconds
+		while True:
+			try:
+				self.sock = socket.create_connection(self.address)
+				self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+				return
+			except OSError:
+				# the coordinator may still be starting
+				if time.monotonic() > deadline:
+					raise
+				time.sleep(0.5)
+
+	def run(self, retry_seconds:float = 30.0) -> int:
+		self.connect(retry_seconds)
+		try:
+			self.send({"type": "hello", "name": self.name})
+			header, _ = recv_message(self.sock)
+			# loading the soundfont can take longer than the coordinator waits for news
+			self.busy(self.setup, header["settings"])
+			self.send({"type": "ready", "params": self.atmos.video.params()})
+			while True:
+				header, payload = recv_message(self.sock)
+				if header["type"] == "stop":
+					return 0
+				self.run_task(header, payload)
+		except ConnectionError:
+			# the coordinator is gone, it hands the task to another worker if it comes back
+			return 1
+		finally:
+			self.sock.close()
+
+	def setup(self, settings:dict) -> None:
+		import batch
+		batch.init_worker(settings["sample_rate"], False, settings["midi"], settings["quality"], None, settings["seed"],
+			settings["profile"])
+		self.settings = settings
+		self.atmos = batch.worker_atmos
+
+	def run_task(self, header:dict, payload:bytes) -> None:
+		kind = header["kind"]
+		try:
+			if kind == FarmTask.ANALYSIS:
+				result, data = self.busy(self.analyse, header)
+			elif kind == FarmTask.SCORE:
+				result, data = self.busy(self.score, header, payload)
+			else:
+				result, data = self.busy(self.render, header, payload)
+			result.update(type="result", id=header["id"])
+		except Exception as e:
+			result, data = {"type": "error", "id": header["id"], "error": str(e) or type(e).__name__}, b""
+		self.send(result, data)
+
+	def busy(self, work, *args):
+		"""
+		Return:
+			The result of work(*args), with heartbeats sent to the coordinator until it returns.
+		"""
+		done = threading.Event()
+		beats = threading.Thread(target=self.beat, args=(done,), daemon=True)
+		beats.start()
+		try:
+			return work(*args)
+		finally:
+			done.set()
+			beats.join()
+
+	def beat(self, done:threading.Event) -> None:
+		while not done.wait(self.heartbeat):
+			self.send({"type": "heartbeat"})
+
+	def analyse(self, header:dict) -> tuple:
+		from video_properties_2 import VideoPropertiesExtractor
+		extractor = self.atmos.video
+		start, stop = header["start"], header["stop"]
+		extractor.load(header["video"])
+		if extractor.status == VideoPropertiesExtractor.ERROR:
+			raise RuntimeError(f"Couldn't open \"{header['video']}\"")
+		if start > 0:
+			# row i of the timeline is frame i + 1 measured against frame i
+			extractor.seek(start + 1)
+		values = []
+		try:
+			while extractor.status == VideoPropertiesExtractor.RUNNING and (stop is None or len(values) < stop - start):
+				extractor.step()
+				values.append(extractor.values)
+		finally:
+			extractor.release()
+		return {"frames": len(values)}, np.asarray(values, dtype=np.float32).reshape(len(values), -1).tobytes()
+
+	def score(self, header:dict, payload:bytes) -> tuple:
+		values = np.frombuffer(payload, dtype=np.float32).reshape(-1, len(CHANNELS))
+		midi = header["output_format"] == "mid"
+		if self.settings["midi"]:
+			atmos = self.atmos
+		else:
+			if self.scorer is None:
+				from atmosvideo import Atmosvideo
+				# the notes are timed on the event clock, a MIDI run goes through the states of the audio render
+				s = self.settings
+				self.scorer = Atmosvideo(s["sample_rate"], live=False, timing=False, midi=True, quality=s["quality"],
+					seed=s["seed"], profile=s["profile"])
+			atmos = self.scorer
+		if not midi:
+			from segments import score_segments
+			scores = score_segments(atmos, values, header["fps"], header["segment_frames"])
+			return {"prerolls": [preroll for preroll, _ in scores], "states": [state for _, state in scores]}, b""
+		atmos.reset()
+		nsamples_frame = round(atmos.music.samplerate / header["fps"])
+		for row in values:
+			atmos.i_frame += 1
+			atmos.synthesize(tuple(float(x) for x in row), nsamples_frame)
+		fd, path = tempfile.mkstemp(suffix=".mid")
+		os.close(fd)
+		try:
+			atmos.save_midi(path)
+			with open(path, "rb") as f:
+				return {}, f.read()
+		finally:
+			os.remove(path)
+
+	def render(self, header:dict, payload:bytes) -> tuple:
+		values = np.frombuffer(payload, dtype=np.float32).reshape(-1, len(CHANNELS))
+		atmos = self.atmos
+		atmos.reset()
+		nsamples_frame = round(atmos.music.samplerate / header["fps"])
+		preroll = header["start"] - header["preroll"]
+		if header["start"] > 0:
+			from segments import continue_from
+			# the notes heard at the start are played from the pre-roll on, as SegmentRenderer does after a cached segment
+			continue_from(atmos, header["preroll"], header["state"], values[:preroll], nsamples_frame)
+		chunks = []
+		for row in values[preroll:]:
+			atmos.i_frame += 1
+			chunks.append(atmos.synthesize(tuple(float(x) for x in row), nsamples_frame))
+		return {}, b"".join(bytes(chunk) for chunk in chunks)
+
+
+def start_local_workers(port:int, count:int) -> list:
+	"""
+	Return:
+		The processes of count workers connected to a coordinator on this machine.
+	"""
+	here = os.path.dirname(os.path.abspath(__file__))
+	return [subprocess.Popen([sys.executable, os.path.join(here, "farm.py"), "worker", "--connect", f"127.0.0.1:{port}",
+		"--name", f"local{i}"], cwd=here) for i in range(count)]
+
+
+def stop_local_workers(processes:list, timeout:float = 10.0) -> None:
+	for process in processes:
+		try:
+			process.wait(timeout)
+		except subprocess.TimeoutExpired:
+			process.kill()
+			process.wait()
+
+
+def main(argv=None) -> int:
+	parser = argparse.ArgumentParser(description="Generate Atmosvideo soundtracks on a farm of worker processes.")
+	commands = parser.add_subparsers(dest="command", required=True)
+
+	coordinator = commands.add_parser("coordinator", help="split the videos into tasks and hand them to the workers")
+	coordinator.add_argument("inputs", nargs="+", help="video files, directories or glob patterns, at the same paths on the workers")
+	coordinator.add_argument("-o", "--output-dir", default="sound_output", help="directory for the generated files")
+	coordinator.add_argument("-f", "--format", choices=OUTPUT_FORMATS, default="mp4", help="muxed video, audio only as wav/mp3, or the notes as a MIDI file")
+	coordinator.add_argument("--host", default="127.0.0.1", help="address the workers connect to, 0.0.0.0 for workers on other machines")
+	coordinator.add_argument("-p", "--port", type=int, default=DEFAULT_PORT, help="port the workers connect to")
+	coordinator.add_argument("--local-workers", type=int, default=0, help="also start this many workers on this machine")
+	coordinator.add_argument("-r", "--sample-rate", type=int, help="sample rate of the audio, by default the one of the quality")
+	coordinator.add_argument("-q", "--quality", choices=QUALITIES, default="final", help="render tier")
+	coordinator.add_argument("--seed", type=int, default=0, help="seed of the music")
+	coordinator.add_argument("--profile", default="default", help="mapping profile, a built-in name or the path of a JSON profile")
+	coordinator.add_argument("--cache-dir", help="keep the analysed timelines here, so reruns only render")
+	coordinator.add_argument("--range-seconds", type=float, default=30.0, help="length of the ranges the videos are analysed in")
+	coordinator.add_argument("--segment-seconds", type=float, default=10.0, help="length of the rendered segments")
+	coordinator.add_argument("--heartbeat-timeout", type=float, default=5 * HEARTBEAT, help="seconds of silence after which a worker is dropped")
+	coordinator.add_argument("--report", help="write a JSON report to this path")
+	coordinator.add_argument("--force", action="store_true", help="regenerate outputs that are already up to date")
+
+	worker = commands.add_parser("worker", help="run tasks for a coordinator")
+	worker.add_argument("--connect", default=f"127.0.0.1:{DEFAULT_PORT}", help="host:port of the coordinator")
+	worker.add_argument("--name", help="name of the worker in the reports, host:pid by default")
+	args = parser.parse_args(argv)
+
+	if args.command == "worker":
+		host, port = args.connect.rsplit(":", 1)
+		return FarmWorker(host, int(port), args.name).run()
+
+	videos = find_videos(args.inputs)
+	if not videos:
+		print("No videos found")
+		return 1
+	farm = FarmCoordinator(videos, args.output_dir, args.format, args.host, args.port, args.cache_dir, args.sample_rate,
+		args.quality, args.seed, args.profile, args.range_seconds, args.segment_seconds, args.heartbeat_timeout,
+		force=args.force)
+	port = farm.start()
+	print(f"Coordinating {len(videos)} video(s) on {args.host}:{port}")
+	workers = start_local_workers(port, args.local_workers)
+	try:
+		report = farm.wait()
+	except KeyboardInterrupt:
+		report = farm.wait(0)
+	finally:
+		farm.close()
+		stop_local_workers(workers)
+	if args.report:
+		with open(args.report, "w") as f:
+			json.dump(report, f, indent=2)
+
+	failed = sum(1 for v in report["videos"] if v["status"] == "error")
+	print(f"Finished {len(videos)} video(s) in {report['seconds']:.1f}s, {failed} failed, {report['lost_workers']} worker(s) lost")
+	return 1 if failed else 0
+
+
+if __name__ == "__main__":
+	raise SystemExit(main())
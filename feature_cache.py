@@ -0,0 +1,159 @@
+import bisect
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from timeline import Timeline, TimelineWriter
+
+
+# the jump of the average hue, saturation or value from one frame to the next above which a new shot starts
+CUT_THRESHOLD = 0.08
+
+
+def detect_cuts(values, fps:float, threshold:float = CUT_THRESHOLD, min_gap:float = 0.5) -> list:
+	"""
+	Finds the hard cuts of a video from its timeline, without looking at the video again.
+
+	Motion and fades change the average color of a frame by a few hundredths at most, a cut to
+	another shot changes it at once. Of the jumps closer than min_gap seconds only the largest is
+	kept, so a flash or a dissolve over a few frames counts once.
+
+	Args:
+		values: The (frames, 4) timeline, an array or a Timeline, of which only the colors are read.
+
+	Return:
+		The sorted rows of the timeline that start a new shot.
+	"""
+	if isinstance(values, Timeline):
+		colors = values.read(channels=("hue", "saturation", "value"))
+	else:
+		colors = np.asarray(values, dtype=np.float32)[:, 1:4]
+	jumps = np.abs(np.diff(colors, axis=0))
+	# the hue wraps around
+	jumps[:, 0] = np.minimum(jumps[:, 0], 1.0 - jumps[:, 0])
+	scores = jumps.max(axis=1)
+	gap = max(int(round(min_gap * fps)), 1)
+	candidates = np.flatnonzero(scores > threshold)
+	cuts = []
+	# the largest jumps first, each one keeps the others out of its gap
+	for row in candidates[np.argsort(-scores[candidates], kind="stable")]:
+		i = bisect.bisect_left(cuts, row)
+		if (i == 0 or row - cuts[i - 1] >= gap) and (i == len(cuts) or cuts[i] - row >= gap):
+			cuts.insert(i, int(row))
+	# a jump is between a row and the next one, which starts the new shot
+	return [cut + 1 for cut in cuts]
+
+
+
+class FeatureCache():
+	"""
+	Stores the per frame properties (energy, hue, saturation, value) extracted from videos as timeline files.
+
+	Entries are keyed by the video's path, size and mtime and the extractor settings, so an
+	edited video or a change of settings is analysed again. Timelines are memory mapped, so
+	any range of a long video is read without loading the rest.
+	"""
+
+	def __init__(self, cache_dir:str) -> None:
+		self.cache_dir = cache_dir
+		os.makedirs(cache_dir, exist_ok=True)
+
+	@staticmethod
+	def key(video_path:str, params:dict) -> str:
+		stat = os.stat(video_path)
+		identity = json.dumps([os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns, params], sort_keys=True)
+		return hashlib.sha1(identity.encode()).hexdigest()
+
+	def path(self, key:str) -> str:
+		return os.path.join(self.cache_dir, f"{key}.timeline")
+
+	def load(self, key:str) -> tuple:
+		"""
+		Return:
+			(fps, timeline) with timeline the memory mapped Timeline of the values, or None if the key isn't cached.
+		"""
+		path = self.path(key)
+		if not os.path.exists(path):
+			return None
+		timeline = Timeline(path)
+		return timeline.fps, timeline
+
+	def cuts(self, key:str) -> list:
+		"""
+		Return:
+			The rows starting a new shot in the cached timeline, see detect_cuts(), found once and kept
+			next to the timeline. None if the key isn't cached.
+		"""
+		path = os.path.join(self.cache_dir, f"{key}.cuts.json")
+		if os.path.exists(path):
+			with open(path) as f:
+				return json.load(f)
+		cached = self.load(key)
+		if cached is None:
+			return None
+		fps, timeline = cached
+		cuts = detect_cuts(timeline, fps)
+		timeline.close()
+		tmp_path = f"{path}.{os.getpid()}.part"
+		with open(tmp_path, "w") as f:
+			json.dump(cuts, f)
+		os.replace(tmp_path, path)
+		return cuts
+
+	def writer(self, key:str, fps:float, params:dict) -> TimelineWriter:
+		"""
+		Return:
+			A writer adding the entry once closed, e.g. for VideoPropertiesExtractor.record().
+		"""
+		return TimelineWriter(self.path(key), fps, params)
+
+	def store(self, key:str, fps:float, values:np.ndarray, params:dict) -> None:
+		writer = self.writer(key, fps, params)
+		for row in values:
+			writer.append(row)
+		# the file only appears once complete
+		writer.close()
+
+	def extract(self, video_path:str, extractor:"VideoPropertiesExtractor" = None, wait = None) -> tuple:
+		"""
+		Returns the properties of every frame of the video, analysing it only if they aren't cached.
+		The timeline is written while the video is analysed, it is never held in memory.
+
+		Args:
+			wait: Called with the key before every frame, e.g. to hold a background analysis while the
+				machine is busy. When it returns False the extraction is canceled.
+
+		Return:
+			(key, fps, timeline) with timeline the Timeline of the values, indexed like a (frames, 4) array.
+		"""
+		from video_properties_2 import VideoPropertiesExtractor
+		extractor = extractor if extractor else VideoPropertiesExtractor(180)
+		params = extractor.params()
+		key = self.key(video_path, params)
+		cached = self.load(key)
+		if cached is not None:
+			return (key,) + cached
+
+		extractor.load(video_path)
+		if extractor.status == VideoPropertiesExtractor.ERROR:
+			raise RuntimeError(f"Couldn't open \"{video_path}\"")
+		writer = self.writer(key, extractor.fps, params)
+		extractor.record(writer)
+		running = extractor.status == VideoPropertiesExtractor.RUNNING
+		try:
+			while running:
+				if wait is not None and not wait(key):
+					break
+				running = extractor.step()
+		finally:
+			extractor.record(None)
+			extractor.release()
+			if extractor.status != VideoPropertiesExtractor.FINISHED:
+				writer.abort()
+		if extractor.status == VideoPropertiesExtractor.CANCELED:
+			raise RuntimeError(f"Extraction of \"{video_path}\" was canceled")
+
+		writer.close()
+		return (key,) + self.load(key)
@@ -0,0 +1,116 @@
+import time
+from collections import deque
+
+
+
+# analysis settings from the most to the least expensive, height is a fraction of the extractor's height.
+# Steps are small enough that a level running under low * deadline fits the deadline one level up.
+# Every level keeps the mean energy of the real clips within 5% of level 0 (benchmark.py --governor), so
+# the music doesn't change with the load of the machine: the height, which changes it by up to 60% on
+# grainy footage even with the scaling of the extractor, and a single iteration of the flow are left out.
+LADDER = (
+	{"height": 1.0, "levels": 3, "iterations": 3, "stride": 1},
+	{"height": 1.0, "levels": 3, "iterations": 2, "stride": 1},
+	{"height": 1.0, "levels": 2, "iterations": 2, "stride": 1},
+	{"height": 1.0, "levels": 2, "iterations": 2, "stride": 2},
+	{"height": 1.0, "levels": 2, "iterations": 2, "stride": 3},
+)
+
+
+class AnalysisGovernor():
+	"""
+	Keeps the per frame analysis of a VideoPropertiesExtractor within a deadline, for real-time use.
+
+	It times every step() and compares the mean of the last frames with the deadline. Over
+	high * deadline the analysis is made cheaper by one level of the ladder (fewer flow iterations
+	and pyramid levels, then analysing one frame out of stride); under
+	low * deadline it goes back up one level. After a change the new level is measured for
+	a full window before the next decision. Every change is kept in decisions and passed to log.
+	"""
+
+	def __init__(self, extractor:"VideoPropertiesExtractor", deadline:float, high:float = 0.9, low:float = 0.5,
+			window:int = 15, ladder:tuple = LADDER, log = print) -> None:
+		"""
+		Args:
+			extractor (VideoPropertiesExtractor): The extractor being governed, at its highest quality.
+			deadline (float): The seconds the analysis of a frame may take, e.g. a share of 1/fps.
+			high, low (float): The fractions of the deadline the mean time has to cross for a step down or up.
+			window (int): The number of frames the mean time is taken over.
+			ladder (tuple): The analysis settings from the most to the least expensive.
+			log: Callable receiving a line for every decision, None to only keep them in decisions.
+		"""
+		self.extractor = extractor
+		self.deadline = deadline
+		self.high = high
+		self.low = low
+		self.window = window
+		self.ladder = ladder
+		self.log = log
+		self.base_height = extractor.height
+		self.level = 0
+		self.times = deque(maxlen=window)
+		self.frames = 0
+		self.deadline_misses = 0
+		self.decisions = []
+
+	def step(self) -> bool:
+		"""
+		Analyses the next frame, see VideoPropertiesExtractor.step(), then adapts the settings.
+		"""
+		start = time.perf_counter()
+		running = self.extractor.step()
+		elapsed = time.perf_counter() - start
+		self.frames += 1
+		if elapsed > self.deadline:
+			self.deadline_misses += 1
+		self.times.append(elapsed)
+		if len(self.times) == self.window:
+			self.adapt(sum(self.times) / self.window)
+		return running
+
+	def adapt(self, mean:float) -> None:
+		if mean > self.high * self.deadline and self.level < len(self.ladder) - 1:
+			self.set_level(self.level + 1, "over", mean)
+		elif mean < self.low * self.deadline and self.level > 0:
+			self.set_level(self.level - 1, "slack", mean)
+
+	def set_level(self, level:int, reason:str, mean:float) -> None:
+		settings = dict(self.ladder[level])
+		settings["height"] = max(int(round(self.base_height * settings["height"])), 16)
+		self.extractor.configure(**settings)
+		decision = {
+			"frame": self.frames,
+			"from": self.level,
+			"to": level,
+			"reason": reason,
+			"mean_ms": 1000.0 * mean,
+			"deadline_ms": 1000.0 * self.deadline,
+			"settings": settings,
+		}
+		self.decisions.append(decision)
+		self.level = level
+		# the frames timed at the previous level don't tell how this one does
+		self.times.clear()
+		if self.log:
+			self.log(f"Governor frame {decision['frame']}: level {decision['from']} -> {level} ({reason}, "
+				f"{decision['mean_ms']:.1f} of {decision['deadline_ms']:.1f} ms), {settings}")
+
+	def reset(self) -> None:
+		"""
+		Brings the extractor back to its highest quality, e.g. before it is used for offline rendering.
+		"""
+		if self.level != 0:
+			self.set_level(0, "reset", sum(self.times) / len(self.times) if self.times else 0.0)
+
+	def stats(self) -> dict:
+		"""
+		Return:
+			The frames analysed, those over the deadline, the current level and every decision taken.
+		"""
+		return {
+			"frames": self.frames,
+			"deadline_misses": self.deadline_misses,
+			"level": self.level,
+			"settings": self.extractor.params(),
+			"decisions": self.decisions,
+		}
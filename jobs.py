@@ -0,0 +1,309 @@
+import os
+import tempfile
+import threading
+import time
+
+from muxer import AudioMuxer, mux_raw_prefix
+
+
+
+class GenerationJob():
+	"""
+	Generates the soundtrack of a video and muxes it into a new file on a background thread.
+
+	The job reports its stage, the frames processed and an estimate of the remaining time,
+	and can be canceled at any point: the analysis stops after the current frame, the encoder
+	is killed and the capture, synth and partial output are released.
+
+	In progressive mode the job also muxes playable prefixes of the video while it renders:
+	the first one as soon as preview_seconds of audio exist, then every time the rendered
+	length doubles. They are listed in previews so playback can start before the job ends.
+	"""
+	# status codes
+	QUEUED = 0
+	RUNNING = 1
+	FINISHED = 2
+	ERROR = 3
+	CANCELED = 4
+
+	# stages
+	LOADING = "loading"
+	GENERATING = "generating"
+	MERGING = "merging"
+	DONE = "done"
+
+	def __init__(self, video_path:str, output_path:str = None, sample_rate:int = None, atmos:"Atmosvideo" = None,
+			preview_seconds:float = None, quality:str = "final", seed:int = 0, render_cache:"RenderCache" = None,
+			profile = "default", features:"FeatureCache" = None) -> None:
+		"""
+		Args:
+			video_path (str): The video to generate the soundtrack for.
+			output_path (str): Where the muxed video is written, a temporary file if not given.
+			sample_rate (int): The sample rate of the generated audio, by default the one of the quality.
+			atmos (Atmosvideo): An atmosvideo to reuse. It is left open when the job ends,
+				otherwise the job creates its own and closes it.
+			preview_seconds (float): The length of the first playable prefix, or None to disable progressive mode.
+			quality (str): The render tier, "draft" for a quick low quality render with the same notes as "final".
+			seed (int): The seed of the music, None for a different soundtrack on every run.
+			render_cache (RenderCache): Where finished videos are kept, so generating a video again with
+				the same settings returns the earlier result immediately.
+			profile: The mapping profile, a built-in name, the path of a JSON profile or a dictionary.
+			features (FeatureCache): Where the property timeline of the video is recorded while it is
+				analysed. Its path is in timeline_path once the job is done. A video already in the
+				cache, e.g. analysed in the background, isn't analysed again, only its music is generated.
+
+		Once the job ends, resources holds the CPU time, memory and I/O it used per stage, see
+		ResourceMonitor.report(), when its atmosvideo records them (those the job creates do).
+		"""
+		self.video_path = video_path
+		self.output_path = output_path
+		self.sample_rate = sample_rate
+		self.quality = quality
+		self.seed = seed
+		self.profile = profile
+		self.render_cache = render_cache
+		self.render_key = None
+		self.features = features
+		self.features_key = None
+		self.timeline_writer = None
+		self.timeline_path = None
+		self.atmos = atmos
+		self.owns_atmos = atmos is None
+		self.muxer = None
+		self.thread = None
+		self.status = GenerationJob.QUEUED
+		self.stage = GenerationJob.LOADING
+		self.error = None
+		self.frame_count = 0
+		self.start_time = None
+		self.end_time = None
+		self.resources = None
+		self.lock = threading.Lock()
+		self.preview_seconds = preview_seconds
+		self.previews = []
+		self.preview_thread = None
+		self.raw_file = None
+		self.raw_path = None
+		self.raw_bytes = 0
+		self.next_preview_bytes = 0
+
+	def start(self) -> None:
+		self.status = GenerationJob.RUNNING
+		self.start_time = time.perf_counter()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def run(self) -> None:
+		try:
+			self.generate()
+		except Exception as e:
+			if self.status != GenerationJob.CANCELED:
+				self.status = GenerationJob.ERROR
+				self.error = str(e)
+				print(f"Generation failed: {e}")
+		finally:
+			self.release()
+			self.end_time = time.perf_counter()
+
+	def generate(self) -> None:
+		# loaded by the job so opening the GUI doesn't import the analysis and synthesis stack
+		from atmosvideo import Atmosvideo
+		if self.atmos is None:
+			self.atmos = Atmosvideo(sample_rate=self.sample_rate, live=False, quality=self.quality, seed=self.seed,
+				profile=self.profile, resources=True)
+		if self.atmos.resources:
+			self.atmos.resources.start()
+		if self.status == GenerationJob.CANCELED:
+			return
+		if self.output_path is None:
+			output_fd, self.output_path = tempfile.mkstemp(suffix='.mp4')
+			os.close(output_fd)
+
+		if self.render_cache is not None or self.features is not None:
+			from feature_cache import FeatureCache
+			self.features_key = FeatureCache.key(self.video_path, self.atmos.video.params())
+			if self.features is not None and os.path.exists(self.features.path(self.features_key)):
+				self.timeline_path = self.features.path(self.features_key)
+
+		if self.render_cache is not None and self.atmos.music.seed is not None:
+			self.render_key = self.render_cache.key(self.features_key, self.atmos.render_config(), "mp4")
+			if self.render_cache.fetch(self.render_key, "mp4", self.output_path):
+				self.stage = GenerationJob.DONE
+				self.status = GenerationJob.FINISHED
+				return
+
+		timeline = None
+		if self.timeline_path is not None:
+			from timeline import Timeline
+			timeline = Timeline(self.timeline_path)
+			self.frame_count = len(timeline)
+		else:
+			self.atmos.load(self.video_path)
+			if self.atmos.status == self.atmos.ERROR:
+				raise RuntimeError(f"Couldn't open \"{self.video_path}\"")
+			self.frame_count = self.atmos.video.frame_count
+			if self.features is not None:
+				self.timeline_writer = self.features.writer(self.features_key, self.atmos.video.fps, self.atmos.video.params())
+				self.atmos.video.record(self.timeline_writer)
+
+		with self.lock:
+			if self.status == GenerationJob.CANCELED:
+				if timeline is not None:
+					timeline.close()
+				return
+			self.muxer = AudioMuxer(self.output_path, self.atmos.music.output_rate, self.atmos.music.channels,
+				video_path=self.video_path)
+			self.muxer.open()
+
+		sink = self.muxer.write
+		if self.preview_seconds:
+			raw_fd, self.raw_path = tempfile.mkstemp(suffix='.pcm')
+			self.raw_file = open(raw_fd, 'wb')
+			self.next_preview_bytes = int(self.preview_seconds * self.bytes_per_second())
+			sink = self.write_progressive
+
+		# the audio is encoded and muxed while it is generated
+		self.stage = GenerationJob.GENERATING
+		if timeline is not None:
+			# only the synthesis is left, the analysis was cached
+			self.atmos.render(timeline, timeline.fps, sink=sink)
+			timeline.close()
+		else:
+			self.atmos.start(sink=sink)
+		if self.atmos.status == self.atmos.CANCELED:
+			return
+
+		self.stage = GenerationJob.MERGING
+		if self.timeline_writer:
+			self.atmos.video.record(None)
+			self.timeline_writer.close()
+			self.timeline_path = self.timeline_writer.path
+			self.timeline_writer = None
+		# the encoder finishes the file and exits, its CPU time is counted once it is waited for
+		self.atmos.timer.start("mux")
+		self.muxer.close()
+		self.atmos.timer.time("mux")
+		if self.render_key:
+			self.render_cache.store(self.render_key, "mp4", self.output_path)
+		self.stage = GenerationJob.DONE
+		self.status = GenerationJob.FINISHED
+
+	def bytes_per_second(self) -> int:
+		return self.atmos.music.output_rate * 2 * self.atmos.music.channels
+
+	def write_progressive(self, samples:bytes) -> None:
+		self.muxer.write(samples)
+		self.raw_file.write(samples)
+		self.raw_bytes += len(samples)
+		if self.raw_bytes >= self.next_preview_bytes and (self.preview_thread is None or not self.preview_thread.is_alive()):
+			self.raw_file.flush()
+			seconds = self.raw_bytes / self.bytes_per_second()
+			self.next_preview_bytes = self.raw_bytes * 2
+			self.preview_thread = threading.Thread(target=self.mux_preview, args=(seconds,), daemon=True)
+			self.preview_thread.start()
+
+	def mux_preview(self, seconds:float) -> None:
+		output_fd, output_path = tempfile.mkstemp(suffix='.mp4')
+		os.close(output_fd)
+		try:
+			mux_raw_prefix(self.raw_path, self.video_path, output_path, seconds, self.atmos.music.output_rate,
+				self.atmos.music.channels)
+		except RuntimeError as e:
+			print(f"Preview failed: {e}")
+			os.remove(output_path)
+			return
+		with self.lock:
+			if self.status == GenerationJob.RUNNING:
+				self.previews.append((output_path, seconds))
+				return
+		os.remove(output_path)
+
+	def remove_previews(self) -> None:
+		"""
+		Deletes the preview files. Files still open elsewhere (e.g. by a player on Windows) are left behind.
+		"""
+		for path, _ in self.previews:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+		self.previews = []
+
+	def cancel(self) -> None:
+		"""
+		Cancels the job. Returns immediately, the worker thread finishes shortly after.
+		"""
+		with self.lock:
+			if self.status not in (GenerationJob.QUEUED, GenerationJob.RUNNING):
+				return
+			self.status = GenerationJob.CANCELED
+			if self.atmos:
+				self.atmos.cancel()
+			# unblocks a worker waiting on the encoder's stdin
+			if self.muxer:
+				self.muxer.abort()
+
+	def release(self) -> None:
+		if self.timeline_writer:
+			# an incomplete timeline isn't kept
+			self.atmos.video.record(None)
+			self.timeline_writer.abort()
+			self.timeline_writer = None
+		if self.raw_file:
+			if self.preview_thread:
+				self.preview_thread.join()
+			self.raw_file.close()
+			os.remove(self.raw_path)
+			self.raw_file = None
+		if self.status != GenerationJob.FINISHED:
+			self.remove_previews()
+			if self.muxer:
+				self.muxer.abort()
+			elif self.output_path and os.path.exists(self.output_path):
+				os.remove(self.output_path)
+		if self.atmos:
+			if self.atmos.resources:
+				self.resources = self.atmos.resources.stop()
+			if self.owns_atmos:
+				self.atmos.close()
+			else:
+				self.atmos.video.release()
+
+	def wait(self, timeout:float = None) -> bool:
+		"""
+		Return:
+			True if the job ended within the timeout.
+		"""
+		self.thread.join(timeout)
+		return not self.thread.is_alive()
+
+	def is_done(self) -> bool:
+		return self.end_time is not None
+
+	@property
+	def frames_done(self) -> int:
+		if self.atmos is None or self.stage == GenerationJob.LOADING:
+			return 0
+		return self.atmos.i_frame
+
+	@property
+	def progress(self) -> float:
+		"""
+		The fraction of the frames already processed, from 0 to 1.
+		"""
+		if self.stage in (GenerationJob.MERGING, GenerationJob.DONE):
+			return 1.0
+		if not self.frame_count:
+			return 0.0
+		return min(self.frames_done / self.frame_count, 1.0)
+
+	@property
+	def eta(self) -> float:
+		"""
+		The estimated seconds until the job ends, or None while there is no estimate yet.
+		"""
+		frames_done = self.frames_done
+		if self.start_time is None or not frames_done or not self.frame_count:
+			return None
+		elapsed = time.perf_counter() - self.start_time
+		return max(elapsed / frames_done * (self.frame_count - frames_done), 0.0)
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".avi", ".webm")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+	path TEXT PRIMARY KEY,
+	size INTEGER NOT NULL,
+	mtime_ns INTEGER NOT NULL,
+	duration REAL,
+	fps REAL,
+	frame_count INTEGER,
+	width INTEGER,
+	height INTEGER,
+	thumbnail TEXT,
+	features_key TEXT,
+	audio_path TEXT,
+	scanned_at REAL NOT NULL
+)
+"""
+
+COLUMNS = ("path", "size", "mtime_ns", "duration", "fps", "frame_count", "width", "height",
+	"thumbnail", "features_key", "audio_path", "scanned_at")
+
+
+
+def probe(video_path:str) -> dict:
+	"""
+	Reads the container metadata of a video.
+
+	Return:
+		A dictionary with duration, fps, frame_count, width and height, all None if the video can't be opened.
+	"""
+	import cv2
+	capture = cv2.VideoCapture(video_path)
+	if not capture.isOpened():
+		return {"duration": None, "fps": None, "frame_count": None, "width": None, "height": None}
+	fps = capture.get(cv2.CAP_PROP_FPS)
+	frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+	metadata = {
+		"duration": frame_count / fps if fps else None,
+		"fps": fps,
+		"frame_count": frame_count,
+		"width": int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+		"height": int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+	}
+	capture.release()
+	return metadata
+
+
+class LibraryIndex():
+	"""
+	An SQLite index of the videos in the library, keyed by path and validated by size and mtime.
+
+	It keeps the container metadata of every video, its thumbnail, the key of its cached
+	features and the last generated soundtrack, so listing the library doesn't touch the videos.
+	Only new or changed files are probed on a rescan, and changing a file clears its
+	features and soundtrack. The index can be shared between threads.
+	"""
+
+	def __init__(self, db_path:str, thumbnails_dir:str = None) -> None:
+		"""
+		Args:
+			db_path (str): The SQLite database file, created if it doesn't exist.
+			thumbnails_dir (str): Where the thumbnails of the videos are stored, if anywhere.
+		"""
+		self.db_path = db_path
+		self.thumbnails_dir = thumbnails_dir
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(db_path, check_same_thread=False)
+		self.connection.row_factory = sqlite3.Row
+		with self.lock, self.connection:
+			self.connection.execute(SCHEMA)
+
+	def close(self) -> None:
+		with self.lock:
+			self.connection.close()
+
+	def thumbnail_for(self, video_path:str) -> str:
+		if self.thumbnails_dir is None:
+			return None
+		path = os.path.join(self.thumbnails_dir, f"{os.path.splitext(os.path.basename(video_path))[0]}.jpg")
+		return path if os.path.exists(path) else None
+
+	def scan(self, directory:str, extensions:tuple = VIDEO_EXTENSIONS) -> tuple:
+		"""
+		Brings the index up to date with the videos in the directory and its subdirectories.
+
+		Return:
+			The number of added, updated and removed videos.
+		"""
+		directory = os.path.abspath(directory)
+		found = {}
+		for root, dirs, files in os.walk(directory):
+			for filename in files:
+				if filename.lower().endswith(extensions):
+					path = os.path.join(root, filename)
+					try:
+						stat = os.stat(path)
+					except OSError:
+						continue
+					found[path] = (stat.st_size, stat.st_mtime_ns)
+
+		with self.lock:
+			known = {row["path"]: (row["size"], row["mtime_ns"]) for row in self.connection.execute(
+				"SELECT path, size, mtime_ns FROM videos WHERE path LIKE ? ESCAPE '\\'", (self.prefix_pattern(directory),))}
+
+		added = updated = 0
+		for path, signature in found.items():
+			if path not in known:
+				added += 1
+			elif known[path] != signature:
+				updated += 1
+			else:
+				continue
+			# probed outside the lock, so queries aren't blocked by slow files
+			self.store(path, signature[0], signature[1], probe(path))
+
+		removed = [path for path in known if path not in found]
+		with self.lock, self.connection:
+			self.connection.executemany("DELETE FROM videos WHERE path = ?", [(p,) for p in removed])
+		return added, updated, len(removed)
+
+	def update_file(self, video_path:str) -> dict:
+		"""
+		Indexes a single video if it is new or changed.
+
+		Return:
+			The indexed entry, or None if the file doesn't exist.
+		"""
+		video_path = os.path.abspath(video_path)
+		try:
+			stat = os.stat(video_path)
+		except OSError:
+			with self.lock, self.connection:
+				self.connection.execute("DELETE FROM videos WHERE path = ?", (video_path,))
+			return None
+		entry = self.get(video_path)
+		if entry is None or (entry["size"], entry["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+			self.store(video_path, stat.st_size, stat.st_mtime_ns, probe(video_path))
+			entry = self.get(video_path)
+		return entry
+
+	def store(self, path:str, size:int, mtime_ns:int, metadata:dict) -> None:
+		# a new or changed file, so anything derived from the old contents is dropped
+		with self.lock, self.connection:
+			self.connection.execute(
+				"INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, ?)",
+				(path, size, mtime_ns, metadata["duration"], metadata["fps"], metadata["frame_count"],
+					metadata["width"], metadata["height"], self.thumbnail_for(path), time.time()))
+
+	def get(self, video_path:str) -> dict:
+		with self.lock:
+			row = self.connection.execute("SELECT * FROM videos WHERE path = ?", (os.path.abspath(video_path),)).fetchone()
+		return dict(row) if row else None
+
+	def videos(self, directory:str = None) -> list:
+		"""
+		Return:
+			The indexed entries, optionally only those inside the directory, sorted by path.
+		"""
+		with self.lock:
+			if directory is None:
+				rows = self.connection.execute("SELECT * FROM videos ORDER BY path").fetchall()
+			else:
+				rows = self.connection.execute("SELECT * FROM videos WHERE path LIKE ? ESCAPE '\\' ORDER BY path",
+					(self.prefix_pattern(os.path.abspath(directory)),)).fetchall()
+		return [dict(row) for row in rows]
+
+	def set_thumbnail(self, video_path:str, thumbnail:str) -> None:
+		self.set_column(video_path, "thumbnail", thumbnail)
+
+	def set_features(self, video_path:str, features_key:str) -> None:
+		self.set_column(video_path, "features_key", features_key)
+
+	def set_audio(self, video_path:str, audio_path:str) -> None:
+		self.set_column(video_path, "audio_path", audio_path)
+
+	def set_column(self, video_path:str, column:str, value) -> None:
+		assert column in COLUMNS
+		with self.lock, self.connection:
+			self.connection.execute(f"UPDATE videos SET {column} = ? WHERE path = ?", (value, os.path.abspath(video_path)))
+
+	@staticmethod
+	def prefix_pattern(directory:str) -> str:
+		escaped = directory.rstrip(os.sep).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+		return escaped + os.sep.replace("\\", "\\\\") + "%"
@@ -0,0 +1,373 @@
+import argparse
+import json
+import threading
+import time
+
+import cv2
+
+from atmosvideo import Atmosvideo
+from governor import AnalysisGovernor
+from live_preview import PlaybackBuffer, NullOutput, DeviceOutput
+
+
+
+# frame rate assumed for sources that don't report theirs, e.g. pipes and some network streams
+DEFAULT_FPS = 30.0
+
+
+def open_source(source:str) -> cv2.VideoCapture:
+	"""
+	Opens a live source: a camera index (e.g. "0", a V4L2 device on Linux), a device or pipe path, or
+	a network stream URL.
+	"""
+	capture = cv2.VideoCapture(int(source)) if source.isdigit() else cv2.VideoCapture(source)
+	# cameras queue a few frames, only the newest is wanted
+	capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+	return capture
+
+
+class ReplaySource():
+	"""
+	Plays a video file at real-time speed, standing in for a camera: read() blocks until the next frame
+	is due, and the frames its reader is too late for are skipped without decoding, as a camera would
+	drop them. It is read like a cv2.VideoCapture and reports no frame count.
+	"""
+
+	def __init__(self, video_path:str, speed:float = 1.0, loop:bool = False) -> None:
+		"""
+		Args:
+			video_path (str): The video replayed.
+			speed (float): How many times faster than real time the frames come.
+			loop (bool): Whether the video starts over at its end, for an endless source.
+		"""
+		self.capture = cv2.VideoCapture(video_path)
+		self.fps = (self.capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS) * speed
+		self.loop = loop
+		self.position = 0
+		self.start_time = None
+		self.skipped = 0
+
+	def isOpened(self) -> bool:
+		return self.capture.isOpened()
+
+	def get(self, prop:int) -> float:
+		if prop == cv2.CAP_PROP_FPS:
+			return self.fps
+		if prop == cv2.CAP_PROP_FRAME_COUNT:
+			return 0
+		return self.capture.get(prop)
+
+	def set(self, prop:int, value) -> bool:
+		return False
+
+	def read(self) -> tuple:
+		if self.start_time is None:
+			self.start_time = time.perf_counter()
+		# the frames whose successor is already due went by unseen
+		while self.start_time + (self.position + 1) / self.fps <= time.perf_counter():
+			if not self.capture.grab() and not self.rewind():
+				return False, None
+			self.position += 1
+			self.skipped += 1
+		wait = self.start_time + self.position / self.fps - time.perf_counter()
+		if wait > 0:
+			time.sleep(wait)
+		success, frame = self.capture.read()
+		if not success:
+			if not self.rewind():
+				return False, None
+			success, frame = self.capture.read()
+		self.position += 1
+		return success, frame
+
+	def rewind(self) -> bool:
+		"""
+		Starts the video over when looping, keeping the frame times going.
+		"""
+		if not self.loop:
+			return False
+		self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+		self.start_time += self.position / self.fps
+		self.position = 0
+		return True
+
+	def release(self) -> None:
+		self.capture.release()
+
+
+class FrameGrabber():
+	"""
+	Reads a live source on its own thread as fast as it delivers, and keeps only its newest frame.
+
+	A slow reader never works on stale frames: read() returns the newest frame not read yet, waiting
+	for one if needed, and the frames that arrived in between are dropped. Every frame is numbered
+	in the order the source delivered it and stamped with the perf_counter() time it was read, so
+	the reader knows how many were dropped and how old its frame is. The latency of the source
+	itself, before the frame reaches the process, isn't seen.
+	"""
+
+	def __init__(self, capture, fps:float = None) -> None:
+		"""
+		Args:
+			capture: The source, a cv2.VideoCapture or anything read like one, e.g. a ReplaySource.
+			fps (float): The frame rate of the source, by default the one it reports or DEFAULT_FPS.
+		"""
+		self.capture = capture
+		self.fps = fps if fps else capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+		self.size = None
+		self.condition = threading.Condition()
+		self.thread = None
+		self.running = False
+		self.finished = False
+		self.frame = None
+		self.frame_sequence = 0
+		self.frame_captured = None
+		# of the frame last returned by read()
+		self.sequence = 0
+		self.captured = None
+		self.dropped = 0
+
+	def start(self, timeout:float = 10.0) -> bool:
+		"""
+		Starts reading and waits for the first frame, which gives the size of the source.
+
+		Return:
+			False if the source couldn't be opened or gave no frame within the timeout.
+		"""
+		if not self.capture.isOpened():
+			return False
+		self.running = True
+		self.thread = threading.Thread(target=self.run, name="grabber", daemon=True)
+		self.thread.start()
+		with self.condition:
+			self.condition.wait_for(lambda: self.frame is not None or self.finished, timeout)
+			if self.frame is None:
+				return False
+			self.size = (self.frame.shape[1], self.frame.shape[0])
+		return True
+
+	def run(self) -> None:
+		while self.running:
+			success, frame = self.capture.read()
+			captured = time.perf_counter()
+			with self.condition:
+				if not success:
+					self.finished = True
+					self.condition.notify_all()
+					return
+				if self.frame is not None:
+					self.dropped += 1
+				self.frame = frame
+				self.frame_sequence += 1
+				self.frame_captured = captured
+				self.condition.notify_all()
+
+	def wait(self) -> bool:
+		"""
+		Waits for a frame not read yet, so a reader timing its work doesn't count the wait for the source.
+
+		Return:
+			False once the source has ended or the grabber was released.
+		"""
+		with self.condition:
+			self.condition.wait_for(lambda: self.frame is not None or self.finished or not self.running)
+			return self.frame is not None and self.running
+
+	def read(self) -> tuple:
+		"""
+		Return:
+			(success, frame) like cv2.VideoCapture.read(), with the newest frame not read yet. Fails once
+			the source has ended or the grabber was released.
+		"""
+		with self.condition:
+			self.condition.wait_for(lambda: self.frame is not None or self.finished or not self.running)
+			if self.frame is None:
+				return False, None
+			frame = self.frame
+			self.frame = None
+			self.sequence = self.frame_sequence
+			self.captured = self.frame_captured
+			return True, frame
+
+	def release(self) -> None:
+		with self.condition:
+			self.running = False
+			self.condition.notify_all()
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+		self.capture.release()
+
+
+class LiveInput():
+	"""
+	Generates music in real time from a live source, e.g. a camera, for as long as it runs.
+
+	The frames are analysed as they come, the newest one each time: when the analysis can't keep up
+	the frames in between are dropped and the audio generated for the next one covers them too, so
+	the music keeps the pace of the source. The analysis governor lowers the quality before frames
+	have to be dropped. At most max_latency seconds of audio are buffered, older audio is dropped
+	if the output falls behind. The latency from the capture of a frame to its audio, when it is
+	synthesized and when it starts playing, is measured for every frame, see stats().
+	"""
+	def __init__(self, capture, fps:float = None, sample_rate:int = None, max_latency:float = 0.25,
+			jitter:float = 0.05, output:str = "device", atmos:Atmosvideo = None, quality:str = "draft",
+			analysis_budget:float = 0.7) -> None:
+		"""
+		Args:
+			capture: The source, see open_source() and ReplaySource.
+			fps (float): The frame rate of the source, by default the one it reports.
+			sample_rate (int): The sample rate of the generated audio, by default the one of the quality.
+			max_latency (float): The seconds of audio that may be buffered ahead of the output.
+			jitter (float): The seconds of audio buffered before the output starts, so small delays
+				of the analysis don't leave it without samples.
+			output (str): "device" to play the audio, "null" to only consume it in real time.
+			atmos (Atmosvideo): An atmosvideo to reuse, otherwise one is created and closed on stop().
+			quality (str): The render tier of the atmosvideo created, "draft" costs less per frame.
+			analysis_budget (float): The share of a frame's time the analysis may take before its
+				quality is lowered. None keeps the full quality.
+		"""
+		self.grabber = FrameGrabber(capture, fps)
+		self.max_latency = max_latency
+		self.jitter = jitter
+		self.analysis_budget = analysis_budget
+		self.governor = None
+		self.owns_atmos = atmos is None
+		self.atmos = atmos if atmos else Atmosvideo(sample_rate=sample_rate, live=False, quality=quality)
+		self.buffer = PlaybackBuffer(self.atmos.music.output_rate, self.atmos.music.channels)
+		self.output = DeviceOutput(self.buffer, self.atmos.music.channels) if output == "device" else NullOutput(self.buffer)
+		self.running = False
+		self.thread = None
+		self.generated_time = 0.0
+		self.frames = 0
+		self.source_frames = 0
+		self.synthesis_latencies = []
+
+	def start(self) -> None:
+		if not self.grabber.start():
+			self.grabber.release()
+			raise RuntimeError("Couldn't read the live source")
+		self.running = True
+		self.loaded = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+		self.loaded.wait()
+		if self.atmos.status == Atmosvideo.ERROR:
+			self.running = False
+			self.thread.join()
+			self.thread = None
+			self.grabber.release()
+			raise RuntimeError("Couldn't read the live source")
+		self.output.start()
+
+	def load(self) -> bool:
+		# on the analysis thread, which ends the timing of the source that load_stream() starts
+		self.atmos.load_stream(self.grabber)
+		if self.atmos.status == Atmosvideo.ERROR:
+			return False
+		if self.analysis_budget:
+			self.governor = AnalysisGovernor(self.atmos.video, self.analysis_budget / self.atmos.video.fps, log=None)
+			self.atmos.governor = self.governor
+		return True
+
+	def stop(self) -> None:
+		self.running = False
+		# a read waiting for the next frame returns at once
+		self.grabber.release()
+		if self.thread:
+			self.thread.join()
+		self.output.stop()
+		if self.governor:
+			self.atmos.governor = None
+			self.governor.reset()
+		if self.owns_atmos:
+			self.atmos.close()
+		else:
+			self.atmos.video.release()
+
+	def wait(self, timeout:float = None) -> bool:
+		"""
+		Return:
+			True if the source ended within the timeout.
+		"""
+		self.thread.join(timeout)
+		return not self.thread.is_alive()
+
+	def run(self) -> None:
+		loaded = self.load()
+		self.loaded.set()
+		if not loaded:
+			return
+		atmos = self.atmos
+		video = atmos.video
+		nsamples_frame = round(atmos.music.samplerate / video.fps)
+		while self.running and atmos.status == Atmosvideo.RUNNING:
+			if not self.grabber.wait():
+				# finds no frame either, and ends the run as at the end of a video
+				atmos.frame()
+				break
+			atmos.timer.start("analysis")
+			atmos.frame()
+			atmos.timer.time("analysis")
+			# the audio covers every frame of the source since the last one, those dropped included
+			samples = atmos.synthesize(video.values, nsamples_frame * video.advance)
+			captured = video.captured
+			self.synthesis_latencies.append(time.perf_counter() - captured)
+			self.buffer.push(self.generated_time, samples, captured)
+			self.buffer.trim(self.max_latency)
+			if self.buffer.paused and self.buffer.buffered_seconds() >= self.jitter:
+				self.buffer.paused = False
+			self.generated_time += nsamples_frame * video.advance / atmos.music.samplerate
+			self.frames += 1
+			self.source_frames += video.advance
+
+	def stats(self) -> dict:
+		"""
+		Return:
+			The frames analysed and those of the source, the frames the grabber dropped, the latency
+			from the capture of a frame to the synthesis of its audio and to the start of its playback,
+			the audio dropped to keep the latency bounded, underruns and the decisions of the governor.
+		"""
+		synthesis = sorted(self.synthesis_latencies)
+		return {
+			"max_latency_s": self.max_latency,
+			"frames": self.frames,
+			"source_frames": self.source_frames,
+			"dropped_frames": self.grabber.dropped,
+			"synthesis_latency": {
+				"mean_s": sum(synthesis) / len(synthesis) if synthesis else None,
+				"p95_s": synthesis[min(int(0.95 * len(synthesis)), len(synthesis) - 1)] if synthesis else None,
+				"max_s": synthesis[-1] if synthesis else None,
+			},
+			"playback_latency": self.buffer.latency_stats(),
+			"trimmed_s": self.buffer.trimmed_bytes / self.buffer.frame_bytes / self.buffer.sample_rate,
+			"underruns": self.buffer.underruns,
+			"analysis": self.governor.stats() if self.governor else None,
+		}
+
+
+def main(argv=None) -> int:
+	parser = argparse.ArgumentParser(description="Generate Atmosvideo music in real time from a camera or a live stream.")
+	parser.add_argument("source", help="camera index, device or pipe path, stream URL, or a video file with --replay")
+	parser.add_argument("--replay", action="store_true", help="replay the video file at real-time speed, as a camera would")
+	parser.add_argument("--seconds", type=float, help="stop after this many seconds, by default when the source ends")
+	parser.add_argument("--fps", type=float, help="frame rate of the source, if it doesn't report it")
+	parser.add_argument("--quality", default="draft", help="render tier of the synthesis")
+	parser.add_argument("--max-latency", type=float, default=0.25, help="seconds of audio buffered at most")
+	parser.add_argument("--output", choices=("device", "null"), default="device")
+	args = parser.parse_args(argv)
+
+	capture = ReplaySource(args.source) if args.replay else open_source(args.source)
+	live = LiveInput(capture, fps=args.fps, max_latency=args.max_latency, output=args.output, quality=args.quality)
+	live.start()
+	try:
+		live.wait(args.seconds)
+	except KeyboardInterrupt:
+		pass
+	live.stop()
+	print(json.dumps(live.stats(), indent=2))
+	return 0
+
+
+if __name__ == "__main__":
+	raise SystemExit(main())
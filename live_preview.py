@@ -0,0 +1,321 @@
+import threading
+import time
+from collections import deque
+
+from atmosvideo import Atmosvideo
+from governor import AnalysisGovernor
+
+
+
+class PlaybackBuffer():
+	"""
+	A thread safe queue of generated samples, each chunk tagged with the video time it starts at.
+
+	The output pulls from it at its own pace, so the video time of the sample being played is
+	always known, and a seek only has to clear it. Chunks pushed with the time their frame was
+	captured, from a live source, add the delay until they start playing to latencies.
+	"""
+	def __init__(self, sample_rate:int, channels:int = 2) -> None:
+		self.sample_rate = sample_rate
+		self.frame_bytes = 2 * channels
+		self.chunks = deque()
+		self.offset = 0
+		self.buffered_bytes = 0
+		self.position = 0.0
+		self.paused = True
+		self.underruns = 0
+		# the perf_counter() time the frame of every chunk was captured, or None
+		self.captured = deque()
+		# seconds between the pull and the sound leaving the device, set by the output
+		self.output_latency = 0.0
+		self.latencies = deque(maxlen=10000)
+		self.trimmed_bytes = 0
+		self.lock = threading.Lock()
+
+	def push(self, start_time:float, samples:bytes, captured:float = None) -> None:
+		with self.lock:
+			if not self.chunks and not self.buffered_bytes:
+				self.position = start_time
+			self.chunks.append(samples)
+			self.captured.append(captured)
+			self.buffered_bytes += len(samples)
+
+	def trim(self, max_seconds:float) -> None:
+		"""
+		Drops the oldest chunks until at most max_seconds are buffered, bounding the latency of a live
+		source when the output consumes slower than the source produces.
+		"""
+		with self.lock:
+			while len(self.chunks) > 1 and self.buffered_bytes > max_seconds * self.sample_rate * self.frame_bytes:
+				dropped = len(self.chunks.popleft()) - self.offset
+				self.captured.popleft()
+				self.offset = 0
+				self.buffered_bytes -= dropped
+				self.trimmed_bytes += dropped
+
+	def pull(self, nframes:int) -> bytes:
+		"""
+		Return:
+			The next nframes of audio, padded with silence if not enough was generated or if paused.
+		"""
+		nbytes = nframes * self.frame_bytes
+		out = bytearray()
+		with self.lock:
+			if self.paused:
+				return bytes(nbytes)
+			while self.chunks and len(out) < nbytes:
+				chunk = self.chunks[0]
+				if self.offset == 0 and self.captured[0] is not None:
+					self.latencies.append(time.perf_counter() + len(out) / self.frame_bytes / self.sample_rate
+						- self.captured[0] + self.output_latency)
+					self.captured[0] = None
+				take = min(len(chunk) - self.offset, nbytes - len(out))
+				out += chunk[self.offset:self.offset + take]
+				self.offset += take
+				if self.offset >= len(chunk):
+					self.chunks.popleft()
+					self.captured.popleft()
+					self.offset = 0
+			self.buffered_bytes -= len(out)
+			self.position += len(out) / self.frame_bytes / self.sample_rate
+			if len(out) < nbytes:
+				self.underruns += 1
+		return bytes(out) + bytes(nbytes - len(out))
+
+	def clear(self, position:float) -> None:
+		with self.lock:
+			self.chunks.clear()
+			self.captured.clear()
+			self.offset = 0
+			self.buffered_bytes = 0
+			self.position = position
+
+	def buffered_seconds(self) -> float:
+		return self.buffered_bytes / self.frame_bytes / self.sample_rate
+
+	def latency_stats(self) -> dict:
+		"""
+		Return:
+			The mean, median, 95th percentile and maximum of the latencies, in seconds, and their count.
+		"""
+		with self.lock:
+			latencies = sorted(self.latencies)
+		if not latencies:
+			return {"count": 0, "mean_s": None, "p50_s": None, "p95_s": None, "max_s": None}
+		return {
+			"count": len(latencies),
+			"mean_s": sum(latencies) / len(latencies),
+			"p50_s": latencies[len(latencies) // 2],
+			"p95_s": latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)],
+			"max_s": latencies[-1],
+		}
+
+
+class NullOutput():
+	"""
+	Consumes the buffer in real time without playing it, for headless use and measurements.
+	"""
+	def __init__(self, buffer:PlaybackBuffer) -> None:
+		self.buffer = buffer
+		self.running = False
+		self.thread = None
+
+	def start(self) -> None:
+		self.running = True
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def run(self) -> None:
+		last = time.perf_counter()
+		pending = 0.0
+		while self.running:
+			time.sleep(0.01)
+			now = time.perf_counter()
+			pending += (now - last) * self.buffer.sample_rate
+			last = now
+			self.buffer.pull(int(pending))
+			pending -= int(pending)
+
+	def stop(self) -> None:
+		self.running = False
+		if self.thread:
+			self.thread.join()
+
+
+class DeviceOutput():
+	"""
+	Plays the buffer on the default audio device.
+	"""
+	def __init__(self, buffer:PlaybackBuffer, channels:int = 2) -> None:
+		self.buffer = buffer
+		self.channels = channels
+		self.pyaudio = None
+		self.stream = None
+		self.continue_flag = None
+
+	def callback(self, in_data, frame_count, time_info, status):
+		return self.buffer.pull(frame_count), self.continue_flag
+
+	def start(self) -> None:
+		# imported here so headless use (NullOutput) doesn't need PortAudio
+		from pyaudio import PyAudio, paContinue
+		self.continue_flag = paContinue
+		self.pyaudio = PyAudio()
+		self.stream = self.pyaudio.open(format=self.pyaudio.get_format_from_width(2), channels=self.channels,
+			rate=self.buffer.sample_rate, output=True, frames_per_buffer=512, stream_callback=self.callback)
+		self.buffer.output_latency = self.stream.get_output_latency()
+		self.stream.start_stream()
+
+	def stop(self) -> None:
+		if self.stream:
+			self.stream.stop_stream()
+			self.stream.close()
+			self.pyaudio.terminate()
+			self.stream = None
+
+
+class LivePreview():
+	"""
+	Generates the soundtrack in real time following the playhead of a video player, without pre-rendering.
+
+	The analysis and synthesis are kept at most lookahead seconds ahead of the player. When the
+	player jumps (a seek, or drift beyond resync_threshold) the buffered audio is dropped and the
+	analysis continues from the new position, keeping the musical state.
+	"""
+	def __init__(self, video_path:str, clock, is_playing, sample_rate:int = None, lookahead:float = 0.3,
+			resync_threshold:float = 0.5, output:str = "device", atmos:Atmosvideo = None, quality:str = "final",
+			analysis_budget:float = 0.7) -> None:
+		"""
+		Args:
+			video_path (str): The video being played.
+			clock: Callable returning the current player time in milliseconds, e.g. vlc.MediaPlayer.get_time.
+			is_playing: Callable returning whether the player is playing.
+			sample_rate (int): The sample rate of the generated audio, by default the one of the quality.
+			lookahead (float): The latency budget, the seconds of audio generated ahead of the player.
+			resync_threshold (float): The drift, in seconds, from which the preview jumps to the player time.
+			output (str): "device" to play the audio, "null" to only consume it in real time.
+			atmos (Atmosvideo): An atmosvideo to reuse, otherwise one is created and closed on stop().
+			quality (str): The render tier of the atmosvideo created, "draft" costs less per frame.
+			analysis_budget (float): The share of a frame's time the analysis may take before its
+				quality is lowered, the rest is left to the synthesis. None keeps the full quality.
+		"""
+		self.video_path = video_path
+		self.clock = clock
+		self.is_playing = is_playing
+		self.lookahead = lookahead
+		self.resync_threshold = resync_threshold
+		self.analysis_budget = analysis_budget
+		self.governor = None
+		self.owns_atmos = atmos is None
+		self.atmos = atmos if atmos else Atmosvideo(sample_rate=sample_rate, live=False, quality=quality)
+		self.buffer = PlaybackBuffer(self.atmos.music.output_rate, self.atmos.music.channels)
+		self.output = DeviceOutput(self.buffer, self.atmos.music.channels) if output == "device" else NullOutput(self.buffer)
+		self.running = False
+		self.thread = None
+		self.generated_time = 0.0
+		self.frames = 0
+		self.deadline_misses = 0
+		self.seeks = 0
+		self.drift_samples = 0
+		self.drift_sum = 0.0
+		self.drift_max = 0.0
+
+	def start(self) -> None:
+		self.running = True
+		self.loaded = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+		self.loaded.wait()
+		if self.atmos.status == Atmosvideo.ERROR:
+			self.running = False
+			self.thread.join()
+			self.thread = None
+			raise RuntimeError(f"Couldn't open \"{self.video_path}\"")
+		self.output.start()
+
+	def load(self) -> bool:
+		# on the preview thread, which ends the timing of the video that load() starts
+		self.atmos.load(self.video_path)
+		if self.atmos.status == Atmosvideo.ERROR:
+			return False
+		if self.analysis_budget:
+			self.governor = AnalysisGovernor(self.atmos.video, self.analysis_budget / self.atmos.video.fps)
+			self.atmos.governor = self.governor
+		return True
+
+	def stop(self) -> None:
+		self.running = False
+		if self.thread:
+			self.thread.join()
+		self.output.stop()
+		if self.governor:
+			self.atmos.governor = None
+			self.governor.reset()
+		if self.owns_atmos:
+			self.atmos.close()
+		else:
+			self.atmos.video.release()
+
+	def run(self) -> None:
+		loaded = self.load()
+		self.loaded.set()
+		if not loaded:
+			return
+		atmos = self.atmos
+		fps = atmos.video.fps
+		frame_time = 1 / fps
+		nsamples_frame = round(atmos.music.samplerate / fps)
+		while self.running:
+			player_time = self.clock() / 1000.0
+			self.buffer.paused = not self.is_playing()
+			if not self.buffer.paused:
+				self.measure_drift(player_time)
+
+			if abs(self.buffer.position - player_time) > self.resync_threshold:
+				self.jump(player_time, fps)
+
+			if atmos.status != Atmosvideo.RUNNING or self.generated_time > player_time + self.lookahead:
+				time.sleep(frame_time / 4)
+				continue
+
+			start = time.perf_counter()
+			samples = atmos.process_frame(nsamples_frame)
+			if time.perf_counter() - start > frame_time:
+				self.deadline_misses += 1
+			self.buffer.push(self.generated_time, samples)
+			self.generated_time += nsamples_frame / atmos.music.samplerate
+			self.frames += 1
+
+	def jump(self, player_time:float, fps:float) -> None:
+		frame = max(int(player_time * fps), 0)
+		self.buffer.clear(player_time)
+		self.atmos.seek(frame)
+		self.generated_time = frame / fps
+		self.seeks += 1
+
+	def measure_drift(self, player_time:float) -> None:
+		drift = self.buffer.position - player_time
+		if abs(drift) > self.resync_threshold:
+			return
+		self.drift_samples += 1
+		self.drift_sum += abs(drift)
+		self.drift_max = max(self.drift_max, abs(drift))
+
+	def stats(self) -> dict:
+		"""
+		Return:
+			The latency budget and how well it was kept: drift between the audio being played and the
+			player, buffer underruns, frames over their deadline and seeks, and the decisions of the
+			analysis governor.
+		"""
+		return {
+			"lookahead_s": self.lookahead,
+			"buffered_s": self.buffer.buffered_seconds(),
+			"frames": self.frames,
+			"deadline_misses": self.deadline_misses,
+			"analysis": self.governor.stats() if self.governor else None,
+			"underruns": self.buffer.underruns,
+			"seeks": self.seeks,
+			"drift_mean_s": self.drift_sum / self.drift_samples if self.drift_samples else 0.0,
+			"drift_max_s": self.drift_max,
+		}
@@ -2,64 +2,161 @@ import customtkinter
 import os
 import datetime
 import vlc
-import cv2
 import threading
 import platform
 from PIL import Image
-import tempfile
-from atmosvideo import *
-from moviepy.editor import VideoFileClip, AudioFileClip
-import wave
+from jobs import GenerationJob
+from thumbnails import ThumbnailCache
+from library_index import LibraryIndex
+from render_cache import RenderCache
+from feature_cache import FeatureCache
+from preanalysis import PreAnalyzer
+from timeline import Timeline
+import bisect
 import shutil
+import time
 
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 THUMBNAILS_DIR = os.path.join(CURRENT_DIR, 'thumbnails')
 VIDEOS_DIR = os.path.join(CURRENT_DIR, 'videos')
 IMAGES_DIR = os.path.join(CURRENT_DIR, 'images')
-
-
-class ScrollableLabelButtonFrame(customtkinter.CTkScrollableFrame):
-    def __init__(self, master, command, **kwargs):
+LIBRARY_DB = os.path.join(CURRENT_DIR, 'library.db')
+RENDER_CACHE_DIR = os.path.join(CURRENT_DIR, 'render_cache')
+RENDER_CACHE_BYTES = 2 * 1024**3
+FEATURES_DIR = os.path.join(CURRENT_DIR, 'features')
+# seconds of soundtrack rendered before playback starts, 0 waits for the whole video
+PREVIEW_SECONDS = 5
+# how often the background analysis is told whether the app is idle, in ms
+PREANALYSIS_POLL_MS = 500
+
+
+class VideoLibraryFrame(customtkinter.CTkFrame):
+    """
+    Lists the videos of the library, creating widgets only for the rows that fit in the frame.
+
+    The rows are reused while scrolling, and thumbnails are loaded in the background.
+    """
+    ROW_HEIGHT = 82
+    THUMBNAIL_SIZE = (128, 72)
+
+    def __init__(self, master, command, index, **kwargs):
         super().__init__(master, **kwargs)
+        self.grid_rowconfigure(0, weight=1)
         self.grid_columnconfigure(0, weight=1)
 
         self.command = command
-        self.radiobutton_variable = customtkinter.StringVar()
-        self.label_list = []
-        self.button_list = []
-
-        mp4_files = []
-
-        for root, dirs, files in os.walk(VIDEOS_DIR):
-            for filename in files:
-                if filename.endswith('.mp4'):
-                    mp4_files.append(os.path.join(root, filename))
-                    image_name = f"{os.path.splitext(filename)[0]}.jpg"
-                    self.add_item(os.path.join(root, filename), thumbnail=customtkinter.CTkImage(
-                        Image.open(os.path.join(THUMBNAILS_DIR, image_name)), size=(128, 72)))
-
-    def add_item(self, video_path, thumbnail):
-        filename = os.path.basename(video_path)
-        label = customtkinter.CTkLabel(self, text=filename.split('.')[
-                                       0], image=thumbnail, compound="left", padx=10, anchor="w", wraplength=150, justify="left")
+        self.index = index
+        self.videos = [entry["path"] for entry in index.videos(VIDEOS_DIR)]
+        self.scanned_videos = None
+        self.first_row = 0
+        self.rows = []
+        self.thumbnails = ThumbnailCache(THUMBNAILS_DIR, size=self.THUMBNAIL_SIZE)
+        self.placeholder = customtkinter.CTkImage(Image.new("RGB", self.THUMBNAIL_SIZE, "gray20"), size=self.THUMBNAIL_SIZE)
+
+        self.rows_frame = customtkinter.CTkFrame(master=self, fg_color="transparent")
+        self.rows_frame.grid_columnconfigure(0, weight=1)
+        # the frame's size comes from the window, never from the rows it holds
+        self.rows_frame.grid_propagate(False)
+        self.rows_frame.grid(row=0, column=0, sticky="nsew")
+        self.scrollbar = customtkinter.CTkScrollbar(master=self, command=self.scroll)
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+        self.rows_frame.bind("<Configure>", self.resize_rows)
+        self.bind_scroll(self.rows_frame)
+
+        # the list starts from the index, new and changed files are picked up in the background
+        threading.Thread(target=self.rescan, daemon=True).start()
+        self.poll_thumbnails()
+
+    def rescan(self):
+        self.index.scan(VIDEOS_DIR)
+        self.scanned_videos = [entry["path"] for entry in self.index.videos(VIDEOS_DIR)]
+
+    def bind_scroll(self, widget):
+        widget.bind("<MouseWheel>", lambda event: self.scroll("scroll", -1 if event.delta > 0 else 1, "units"))
+        widget.bind("<Button-4>", lambda event: self.scroll("scroll", -1, "units"))
+        widget.bind("<Button-5>", lambda event: self.scroll("scroll", 1, "units"))
+
+    def create_row(self, row):
+        label = customtkinter.CTkLabel(self.rows_frame, text="", image=self.placeholder, compound="left", padx=10, anchor="w", wraplength=150, justify="left")
         button = customtkinter.CTkButton(
-            self, text="Play", width=50, height=35)
-        button.configure(command=lambda: self.command(video_path))
-        label.grid(row=len(self.label_list),
-                   column=0, pady=(0, 10), sticky="w")
-        button.grid(row=len(self.button_list), column=1, pady=(0, 10), padx=5)
-        self.label_list.append(label)
-        self.button_list.append(button)
+            self.rows_frame, text="Play", width=50, height=35, command=lambda: self.play_row(row))
+        label.grid(row=row, column=0, pady=(0, 10), sticky="w")
+        button.grid(row=row, column=1, pady=(0, 10), padx=5)
+        self.bind_scroll(label)
+        self.bind_scroll(button)
+        return label, button
+
+    def resize_rows(self, event):
+        n_rows = event.height // self.ROW_HEIGHT + 1
+        while len(self.rows) < n_rows:
+            self.rows.append(self.create_row(len(self.rows)))
+        while len(self.rows) > n_rows:
+            label, button = self.rows.pop()
+            label.destroy()
+            button.destroy()
+        self.scroll("moveto", self.first_row / max(len(self.videos), 1))
+
+    def visible_rows(self):
+        return max(len(self.rows) - 1, 1)
+
+    def scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            first_row = int(float(amount) * len(self.videos))
+        elif unit == "pages":
+            first_row = self.first_row + int(amount) * self.visible_rows()
+        else:
+            first_row = self.first_row + int(amount)
+        self.first_row = max(0, min(first_row, len(self.videos) - self.visible_rows()))
+        self.refresh()
+
+    def refresh(self):
+        visible = set()
+        for i, (label, button) in enumerate(self.rows):
+            index = self.first_row + i
+            if index >= len(self.videos):
+                label.grid_remove()
+                button.grid_remove()
+                continue
+            video_path = self.videos[index]
+            visible.add(video_path)
+            thumbnail = self.thumbnails.get(video_path)
+            if thumbnail is None:
+                self.thumbnails.request(video_path)
+            label.configure(text=os.path.basename(video_path).split('.')[0], image=thumbnail or self.placeholder)
+            label.grid()
+            button.grid()
+        self.thumbnails.retain(visible)
+
+        total = len(self.videos)
+        if total:
+            self.scrollbar.set(self.first_row / total, min(self.first_row + self.visible_rows(), total) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def poll_thumbnails(self):
+        if self.scanned_videos is not None:
+            self.videos, self.scanned_videos = self.scanned_videos, None
+            self.scroll("scroll", 0)
+        loaded = self.thumbnails.drain()
+        if loaded.intersection(self.videos[self.first_row:self.first_row + len(self.rows)]):
+            self.refresh()
+        self.after(50, self.poll_thumbnails)
+
+    def play_row(self, row):
+        index = self.first_row + row
+        if index < len(self.videos):
+            self.command(self.videos[index])
+
+    def add_video(self, video_path):
+        self.thumbnails.forget(video_path)
+        if video_path not in self.videos:
+            bisect.insort(self.videos, video_path)
+        self.refresh()
 
     def remove_item(self, item):
-        for label, button in zip(self.label_list, self.button_list):
-            if item == label.cget("text"):
-                label.destroy()
-                button.destroy()
-                self.label_list.remove(label)
-                self.button_list.remove(button)
-                return
+        self.videos = [v for v in self.videos if os.path.basename(v).split('.')[0] != item]
+        self.scroll("scroll", 0)
 
 
 class PlayerControlsFrame(customtkinter.CTkFrame):
@@ -71,7 +168,12 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
         self.saved_video_event = saved_video_event
         self.video_path = ("", False)
         self.last_volume = 100
+        self.last_time = 0
         self.popup_generating = None
+        self.live_preview = None
+        self.quality = "final"
+        self.render_cache = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_BYTES)
+        self.features = FeatureCache(FEATURES_DIR)
 
         self.grid_rowconfigure(0, weight=1)
         self.grid_rowconfigure(1, weight=1)
@@ -101,6 +203,10 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
             master=self.slider_frame, width=550, variable=self.progress_value, from_=0, to=1, orientation="horizontal", command=self.seek)
         self.end_time_label = customtkinter.CTkLabel(
             master=self.slider_frame, text=str(datetime.timedelta(seconds=0)))
+        # the energy of the video along the slider, shown once its timeline is known
+        self.energy_canvas = customtkinter.CTkCanvas(
+            master=self.slider_frame, width=550, height=16, highlightthickness=0,
+            bg=self.slider_frame._apply_appearance_mode(self.slider_frame.cget("fg_color")))
         self.slider_frame.grid_columnconfigure(0, weight=1)
         self.slider_frame.grid_columnconfigure(1, weight=4)
         self.slider_frame.grid_columnconfigure(2, weight=1)
@@ -120,6 +226,10 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
             master=self.buttons_frame, image=self.fast_forward_image, text="", height=40, width=40, command=lambda: self.skip(5))
         self.button_generate = customtkinter.CTkButton(
             master=self.buttons_frame, image=self.generate_image, text="", height=40, width=40, command=lambda: self.generate())
+        self.button_live = customtkinter.CTkButton(
+            master=self.buttons_frame, width=60, height=40, text="Live", command=self.toggle_live)
+        self.button_quality = customtkinter.CTkButton(
+            master=self.buttons_frame, width=60, height=40, text="Final", command=self.toggle_quality)
         self.button_settings = customtkinter.CTkButton(
             master=self.buttons_frame, image=self.setting_image, text="", height=40, width=40, command=lambda: self.settings())
 
@@ -146,7 +256,9 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
         self.button_fast_forward.grid(row=0, column=4, padx=10, pady=10)
         self.volume_frame.grid(row=0, column=5, padx=0, pady=10)
         self.button_generate.grid(row=0, column=6, padx=10, pady=10)
-        self.button_settings.grid(row=0, column=7, padx=10, pady=10)
+        self.button_live.grid(row=0, column=7, padx=10, pady=10)
+        self.button_quality.grid(row=0, column=8, padx=10, pady=10)
+        self.button_settings.grid(row=0, column=9, padx=10, pady=10)
         self.button_volume.grid(row=0, column=0, padx=10, pady=10)
 
         self.volume_frame.bind("<Enter>", self.show_volume_slider)
@@ -165,9 +277,13 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
         self.end_time_label.configure(
             text=str(datetime.timedelta(milliseconds=duration))[:-3].split(".", 1)[0])
         self.progress_slider.configure(to=duration)
-        self.progress_value.set(int(self.video_player.get_time()))
+        self.last_time = self.video_player.get_time()
+        self.progress_value.set(int(self.last_time))
 
     def video_ended(self, event):
+        if self.popup_generating is not None and self.popup_generating.previews_shown:
+            # the end of a preview, playback continues when the next one is ready
+            return
         self.progress_slider.set(0)
         self.start_time_label.configure(
             text=str(datetime.timedelta(seconds=0)))
@@ -223,6 +339,7 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
         self.video_player.set_time(new_time)
 
     def browse(self, video_path=None):
+        self.stop_live()
         if video_path:
             self.video_path = video_path
         else:
@@ -232,6 +349,47 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
             self.video_player.set_media(media)
             self.progress_slider.configure(from_=0, to=1)
             self.progress_value.set(0)
+            self.last_time = 0
+            self.show_energy(None)
+
+    def swap_video(self, video_path, is_temp):
+        """
+        Replaces the media with another version of the same video, continuing from the current time.
+        """
+        position = self.last_time
+        self.video_path = (video_path, is_temp)
+        media = self.vlc_instance.media_new(video_path)
+        if position > 0:
+            media.add_option(f"start-time={position / 1000.0}")
+        self.video_player.set_media(media)
+        self.video_player.play()
+
+    def show_energy(self, timeline_path, cuts=None):
+        """
+        Draws the energy curve of a property timeline under the progress slider, or hides it if timeline_path is None.
+        Only the energy channel is read, so it is quick even for very long videos. The rows of cuts, if given, are
+        marked on it.
+        """
+        self.energy_canvas.delete("all")
+        if timeline_path is None:
+            self.energy_canvas.grid_remove()
+            return
+        timeline = Timeline(timeline_path)
+        width = int(self.energy_canvas.cget("width"))
+        height = int(self.energy_canvas.cget("height"))
+        peaks = timeline.envelope(width)
+        rows = len(timeline)
+        timeline.close()
+        points = [0, height]
+        for i, peak in enumerate(peaks):
+            points += [(i + 0.5) * width / len(peaks), height - float(peak) * height]
+        points += [width, height]
+        self.energy_canvas.create_polygon(points, fill=self.progress_slider._apply_appearance_mode(
+            self.progress_slider.cget("progress_color")), outline="")
+        for cut in cuts or ():
+            x = cut * width / max(rows, 1)
+            self.energy_canvas.create_line(x, 0, x, height, fill="gray60")
+        self.energy_canvas.grid(row=1, column=1, padx=10, pady=(0, 10))
 
     def play_pause(self):
         if self.video_path[0] == "":
@@ -244,6 +402,28 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
     def settings(self):
         pass
 
+    def toggle_quality(self):
+        # draft renders only synthesize more cheaply, they analyse like the final render and play the same notes
+        self.quality = "draft" if self.quality == "final" else "final"
+        self.button_quality.configure(text=self.quality.capitalize())
+
+    def toggle_live(self):
+        if self.live_preview:
+            self.stop_live()
+        elif self.video_path[0] != "":
+            # music generated on the fly around the playhead, nothing is rendered to disk
+            from live_preview import LivePreview
+            self.live_preview = LivePreview(self.video_path[0], self.video_player.get_time, self.video_player.is_playing)
+            self.live_preview.start()
+            self.button_live.configure(text="Live on")
+
+    def stop_live(self):
+        if self.live_preview:
+            print(f"Live preview: {self.live_preview.stats()}")
+            self.live_preview.stop()
+            self.live_preview = None
+            self.button_live.configure(text="Live")
+
     def save_video(self):
         if not os.path.exists(VIDEOS_DIR):
             os.makedirs(VIDEOS_DIR)
@@ -273,26 +453,8 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
             delete_thread = threading.Thread(target=delete_temp_file, args=(temp_video_path,))
             delete_thread.start()
 
-        self.create_thumbnail(self.video_path[0])
         self.saved_video_event(self.video_path[0])
 
-    def create_thumbnail(self, video_path):
-        if not os.path.exists(THUMBNAILS_DIR):
-            os.makedirs(THUMBNAILS_DIR)
-
-        filename = os.path.basename(video_path)
-        if filename.endswith('.mp4'):
-            thumbnail_path = os.path.join(
-                THUMBNAILS_DIR, f"{os.path.splitext(filename)[0]}.jpg")
-            video_capture = cv2.VideoCapture(video_path)
-            success, frame = video_capture.read()
-            if success:
-                cv2.imwrite(thumbnail_path, frame)
-                print(f"Thumbnail saved for {filename}")
-            else:
-                print(f"Failed to extract thumbnail for {filename}")
-            video_capture.release()
-
     def show_volume_slider(self, event):
         self.volume_slider.grid(row=0, column=1, padx=10, pady=10)
 
@@ -301,66 +463,108 @@ class PlayerControlsFrame(customtkinter.CTkFrame):
             self.volume_slider.grid_forget()
 
     def generate(self):
-        if self.video_path[0] != "":
+        if self.video_path[0] != "" and self.popup_generating is None:
             if self.video_player.is_playing():
                 self.video_player.pause()
-            self.popup_generating = PopupGenerating(self.master.master, self.done_generating)
+            job = GenerationJob(self.video_path[0], preview_seconds=PREVIEW_SECONDS or None, quality=self.quality,
+                                render_cache=self.render_cache, features=self.features)
+            self.popup_generating = PopupGenerating(self.master.master, job, self.done_generating, self.preview_ready)
             self.popup_generating.place(relx=.5, rely=.5, anchor="center")
-            create_audio_thread = threading.Thread(target=self.create_and_merge_audio, args=[self.popup_generating, self.done_generating])
-            create_audio_thread.start()
-
-    def create_and_merge_audio(self, popup_generating, callback):
-        sample_rate = 44100
-        atmos = Atmosvideo(sample_rate=sample_rate, live=False)
-        atmos.load(self.video_path[0])
-        samples = atmos.start()
-        temp_audio_fd, temp_audio_path = tempfile.mkstemp(suffix='.wav')
-        popup_generating.title.configure(text="Merging audio to video...")
-
-        with open(temp_audio_fd, 'wb') as temp_audio_file:
-            with wave.open(temp_audio_file, 'wb') as wave_file:
-                wave_file.setframerate(sample_rate)
-                wave_file.setsampwidth(2)
-                wave_file.setnchannels(2)
-                wave_file.writeframes(samples)
-
-        audioclip = AudioFileClip(temp_audio_path)
-        videoclip = VideoFileClip(self.video_path[0])
-        videoclip = videoclip.set_audio(audioclip)
-        temp_video_fd, temp_video_path = tempfile.mkstemp(suffix='.mp4')
-        videoclip.write_videofile(temp_video_path)
-        videoclip.close()
-        os.remove(temp_audio_path)
-        os.close(temp_video_fd)
-        callback(temp_video_path)
-
-    def done_generating(self, temp_video_path):
+            job.start()
+
+    def preview_ready(self, video_path, first):
+        # previews belong to the job, which deletes them, so they are not marked as temporary here
+        if first:
+            self.browse((video_path, False))
+            self.play_pause()
+        else:
+            self.swap_video(video_path, False)
+
+    def done_generating(self, job):
         if self.popup_generating:
-            self.video_path = (temp_video_path, True)
+            previews_shown = self.popup_generating.previews_shown
             self.popup_generating.close_popup()
             self.popup_generating = None
-            self.browse(self.video_path)
-            self.play_pause()
+            if job.status == GenerationJob.FINISHED and previews_shown:
+                self.swap_video(job.output_path, True)
+                self.after(3000, job.remove_previews)
+            elif job.status == GenerationJob.FINISHED:
+                self.video_path = (job.output_path, True)
+                self.browse(self.video_path)
+                self.play_pause()
+            elif previews_shown:
+                self.video_player.stop()
+                self.browse((job.video_path, False))
+            if job.status == GenerationJob.FINISHED:
+                self.show_energy(job.timeline_path, self.features.cuts(job.features_key) if job.features_key else None)
 
 
 class PopupGenerating(customtkinter.CTkFrame):
-    def __init__(self, master, callback, **kwargs):
+    STAGE_TEXT = {
+        GenerationJob.LOADING: "Loading video...",
+        GenerationJob.GENERATING: "Generating music from video...",
+        GenerationJob.MERGING: "Merging audio to video...",
+        GenerationJob.DONE: "Done",
+    }
+
+    def __init__(self, master, job, callback, preview_callback=None, **kwargs):
+        self.job = job
         self.callback = callback
+        self.preview_callback = preview_callback
+        self.previews_shown = 0
         self.overlay_frame = customtkinter.CTkFrame(master, bg_color='transparent', fg_color=None)
         self.overlay_frame.place(x=0, y=0, relwidth=1, relheight=1)
         self.overlay_frame.lift()
 
         super().__init__(master, corner_radius=10, width=500,fg_color="transparent", border_color="black", **kwargs)
-        self.title = customtkinter.CTkLabel(master=self, text="Extracting properties from video...", font=("Helvetica", 16))
-        progressbar = customtkinter.CTkProgressBar(master=self, width=500)
-        progressbar.configure(mode="indeterminnate")
-        progressbar.start()
+        self.title = customtkinter.CTkLabel(master=self, text=self.STAGE_TEXT[job.stage], font=("Helvetica", 16))
+        self.progress_label = customtkinter.CTkLabel(master=self, text="")
+        self.progressbar = customtkinter.CTkProgressBar(master=self, width=500)
+        self.progressbar.configure(mode="determinate")
+        self.progressbar.set(0)
+        self.button_cancel = customtkinter.CTkButton(master=self, text="Cancel", width=80, command=self.cancel)
         self.grid_columnconfigure(0, weight=1)
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(1, weight=1)
 
         self.title.grid(row=0, column=0, columnspan=2,padx=20, pady=10, sticky="nsew")
-        progressbar.grid(row=1, column=1, padx=20, pady=10, sticky="nsew")
+        self.progressbar.grid(row=1, column=0, columnspan=2, padx=20, pady=10, sticky="nsew")
+        self.progress_label.grid(row=2, column=0, padx=20, pady=10, sticky="w")
+        self.button_cancel.grid(row=2, column=1, padx=20, pady=10, sticky="e")
+        self.after(200, self.poll)
+
+    def poll(self):
+        # the job runs on its own thread, the widgets are only touched from tkinter's
+        job = self.job
+        if job.is_done():
+            self.callback(job)
+            return
+        if self.preview_callback and len(job.previews) > self.previews_shown:
+            video_path, _ = job.previews[-1]
+            if not self.previews_shown:
+                self.dock()
+            self.preview_callback(video_path, not self.previews_shown)
+            self.previews_shown = len(job.previews)
+        self.title.configure(text=self.STAGE_TEXT[job.stage])
+        self.progressbar.set(job.progress)
+        text = f"{job.frames_done}/{job.frame_count} frames"
+        if job.eta is not None:
+            text += f", {datetime.timedelta(seconds=round(job.eta))} left"
+        self.progress_label.configure(text=text)
+        self.after(200, self.poll)
+
+    def cancel(self):
+        self.title.configure(text="Canceling...")
+        self.button_cancel.configure(state="disabled")
+        self.job.cancel()
+
+    def dock(self):
+        """
+        Moves the popup to a corner and removes the overlay, so the video can be watched while the job continues.
+        """
+        self.overlay_frame.place_forget()
+        self.place(relx=1, rely=0, x=-10, y=10, anchor="ne")
+        self.lift()
 
     def close_popup(self):
         self.overlay_frame.destroy()
@@ -396,20 +600,34 @@ class App(customtkinter.CTk):
                                                   video_player=self.video_player, saved_video_event=self.saved_video_event, corner_radius=0, fg_color="transparent")
         self.controls_frame.grid(row=1, column=0, padx=0, pady=0, sticky="NEW")
 
-        self.scrollable_label_button_frame = ScrollableLabelButtonFrame(
-            master=self, width=350, command=self.label_button_frame_event)
+        self.library_index = LibraryIndex(LIBRARY_DB, THUMBNAILS_DIR)
+        self.scrollable_label_button_frame = VideoLibraryFrame(
+            master=self, width=350, command=self.label_button_frame_event, index=self.library_index)
         self.scrollable_label_button_frame.grid(
             row=0, column=1, padx=0, pady=10, sticky="nsew")
 
+        self.preanalysis = PreAnalyzer(VIDEOS_DIR, FEATURES_DIR)
+        self.preanalysis.start()
+        self.poll_preanalysis()
+
     def label_button_frame_event(self, video_path):
         self.controls_frame.browse((video_path, False))
         self.controls_frame.play_pause()
 
     def saved_video_event(self, video_path):
-        filename = os.path.basename(video_path)
-        image_name = f"{os.path.splitext(filename)[0]}.jpg"
-        self.scrollable_label_button_frame.add_item(video_path, thumbnail=customtkinter.CTkImage(
-            Image.open(os.path.join(THUMBNAILS_DIR, image_name)), size=(128, 72)))
+        video_path = os.path.abspath(video_path)
+        self.library_index.update_file(video_path)
+        self.scrollable_label_button_frame.add_video(video_path)
+        self.preanalysis.add(video_path)
+
+    def poll_preanalysis(self):
+        # the analysis holds while anything else needs the CPU
+        controls = self.controls_frame
+        busy = self.video_player.is_playing() or controls.popup_generating is not None or controls.live_preview is not None
+        self.preanalysis.set_idle(not busy)
+        for video_path, features_key in self.preanalysis.finished():
+            self.library_index.set_features(video_path, features_key)
+        self.after(PREANALYSIS_POLL_MS, self.poll_preanalysis)
 
     def run(self):
         if platform.system() == "Windows":
@@ -421,6 +639,10 @@ class App(customtkinter.CTk):
         else:
             raise NotImplementedError("Unsupported operating system")
         self.mainloop()
+        self.controls_frame.stop_live()
+        self.preanalysis.stop()
+        self.scrollable_label_button_frame.thumbnails.shutdown()
+        self.library_index.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,255 @@
+import bisect
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from MusicGeneration import MusicGenerator
+from timeline import CHANNELS
+
+
+
+# The mapping from the video properties (energy, hue, saturation and value, all [0,1]) to the music.
+# The motion channels of the flow (direction, center, pan and coverage, see timeline.CHANNELS) are
+# only used by profiles with a "motion" list.
+#
+# Bins are listed from the lowest values: "edges" separate them and a value goes in the first bin
+# whose edge is above it. An edge written {"up_to": x} keeps x itself in the bin below.
+DEFAULT_PROFILE = {
+	"name": "default",
+	# bpm = energy * scale + offset, only applied when it differs from the current tempo by more than change
+	"tempo": {"scale": 110, "offset": 50, "change": 0.2},
+	# slope * value + offset, the chords use a different line from split on
+	"melody_transposition": {"slope": 3, "offset": -1},
+	"chord_transposition": {"split": 0.5, "below": [2, 1], "above": [2, -1]},
+	"rest_rate": 0.2,
+	"beats_per_chord": 4.0,
+	"scale": {
+		"edges": [0.5/6, 1.5/6, 2.5/6, 3.5/6, 4.5/6, {"up_to": 5.5/6}],
+		"values": ["japanese", "maj_pentatonic", "maj", "min_pentatonic", "min", "hmin", "japanese"],
+	},
+	# binned by saturation_weight * saturation + calm_weight * (1 - energy)
+	"chord_type": {
+		"saturation_weight": 0.5,
+		"calm_weight": 0.5,
+		# the first mapping also chose "power" under 1/3, but overwrote it with "triad"
+		"edges": [2/3],
+		"values": ["triad", "seven"],
+	},
+	# rows are value bins, columns energy bins. The volumes keep the instruments leveled,
+	# a null entry keeps the current instruments.
+	"instruments": {
+		"value_edges": [1/3, 2/3],
+		"energy_edges": [1/6, 1/2],
+		"table": [
+			[
+				{"chords": [17, 89], "melody": [0, 104], "arpeggio": 0, "chords_volume": 0.7, "melody_volume": 0.5}, # pad, sitar
+				{"chords": [2, 92], "melody": [2, 92], "arpeggio": 0, "chords_volume": 0.5, "melody_volume": 0.7}, # square
+				{"chords": [0, 29], "melody": [0, 34], "arpeggio": 4, "chords_volume": 0.5, "melody_volume": 0.7}, # electric guitar, bass
+			],
+			[
+				{"chords": [0, 0], "melody": [0, 0], "arpeggio": 0, "chords_volume": 0.5, "melody_volume": 0.6}, # piano
+				{"chords": [0, 0], "melody": [0, 71], "arpeggio": 0, "chords_volume": 0.5, "melody_volume": 0.6}, # piano, clarinet
+				None,
+			],
+			[
+				{"chords": [0, 4], "melody": [0, 4], "arpeggio": 0, "chords_volume": 0.5, "melody_volume": 0.6}, # electric piano
+				{"chords": [0, 107], "melody": [1, 104], "arpeggio": 2, "chords_volume": 0.5, "melody_volume": 0.5}, # koto, tampura
+				{"chords": [0, 61], "melody": [0, 60], "arpeggio": 0, "chords_volume": 0.45, "melody_volume": 0.55}, # brass, french horn
+			],
+		],
+	},
+}
+
+# generator parameters a "motion" entry can drive, and the generator they belong to
+MOTION_TARGETS = {
+	"subdivision_rate": ("melody", "subdivision_rate"),
+	"rest_rate": ("melody", "rest_rate"),
+	"beats_per_chord": ("chords", "beats_per_chord"),
+}
+
+# Every entry sets its target to slope * channel + offset, clipped to [min, max], after the rest of the mapping.
+MOTION_PROFILE = dict(DEFAULT_PROFILE, name="motion", motion=[
+	# busier melodies the more of the frame moves
+	{"channel": "coverage", "target": "subdivision_rate", "slope": 1.5, "offset": 0.0, "min": 0.0, "max": 0.75},
+	# long chords under camera pans, short ones when objects move their own ways
+	{"channel": "pan", "target": "beats_per_chord", "slope": 4.0, "offset": 2.0, "min": 2.0, "max": 6.0},
+	# fewer rests when the motion is at the center of the frame
+	{"channel": "center", "target": "rest_rate", "slope": -0.4, "offset": 0.35, "min": 0.05, "max": 0.35},
+])
+
+PROFILES = {"default": DEFAULT_PROFILE, "motion": MOTION_PROFILE}
+
+
+def load_profile(profile) -> dict:
+	"""
+	Args:
+		profile: The name of a built-in profile, the path of a JSON profile, or a profile dictionary.
+	"""
+	if isinstance(profile, dict):
+		return profile
+	if profile in PROFILES:
+		return PROFILES[profile]
+	if not os.path.exists(profile):
+		raise ValueError(f"Unknown mapping profile \"{profile}\", expected one of {', '.join(PROFILES)} or a JSON file")
+	with open(profile) as f:
+		return json.load(f)
+
+
+def compile_edges(edges:list) -> list:
+	# an inclusive edge is moved just above its value, so every edge can be compared with <
+	return [float(np.nextafter(edge["up_to"], np.inf)) if isinstance(edge, dict) else float(edge) for edge in edges]
+
+
+def find_bin(edges:list, x):
+	"""
+	Return:
+		The index of the bin of x, or an array of indices if x is an array.
+	"""
+	if np.ndim(x) == 0:
+		# parameters change one at a time while rendering, bisect is much cheaper than numpy on scalars
+		return bisect.bisect_right(edges, x)
+	return np.searchsorted(edges, x, side="right")
+
+
+class MappingProfile():
+	"""
+	A mapping profile compiled to lookup tables.
+
+	map() turns properties into music parameters, on single values or on whole timelines at once.
+	apply() sets the parameters of a MusicGenerator when some properties changed.
+	"""
+
+	def __init__(self, profile = "default") -> None:
+		"""
+		Args:
+			profile: The name of a built-in profile, the path of a JSON profile, or a profile dictionary.
+		"""
+		self.profile = load_profile(profile)
+		self.name = self.profile.get("name", "custom")
+		self.hash = hashlib.sha1(json.dumps(self.profile, sort_keys=True).encode()).hexdigest()[:16]
+
+		p = self.profile
+		self.tempo = p["tempo"]
+		self.melody_transposition = p["melody_transposition"]
+		self.chord_transposition = p["chord_transposition"]
+		self.scale_edges = compile_edges(p["scale"]["edges"])
+		self.scales = [MusicGenerator.scales[name] for name in p["scale"]["values"]]
+		self.chord_weights = (p["chord_type"]["saturation_weight"], p["chord_type"]["calm_weight"])
+		self.chord_edges = compile_edges(p["chord_type"]["edges"])
+		self.chord_types = [MusicGenerator.chord_types[name] for name in p["chord_type"]["values"]]
+		instruments = p["instruments"]
+		self.value_edges = compile_edges(instruments["value_edges"])
+		self.energy_edges = compile_edges(instruments["energy_edges"])
+		self.n_energy_bins = len(self.energy_edges) + 1
+		# flattened so a single index picks the preset
+		self.presets = [preset for row in instruments["table"] for preset in row]
+		self.motion = []
+		for entry in p.get("motion", []):
+			if entry["channel"] not in CHANNELS or entry["target"] not in MOTION_TARGETS:
+				raise ValueError(f"Unknown motion mapping from \"{entry['channel']}\" to \"{entry['target']}\", expected a channel "
+					f"out of {', '.join(CHANNELS)} and a target out of {', '.join(MOTION_TARGETS)}")
+			self.motion.append((CHANNELS.index(entry["channel"]), *MOTION_TARGETS[entry["target"]],
+				float(entry.get("slope", 1.0)), float(entry.get("offset", 0.0)),
+				float(entry.get("min", -np.inf)), float(entry.get("max", np.inf))))
+		assert len(self.scales) == len(self.scale_edges) + 1 and len(self.chord_types) == len(self.chord_edges) + 1
+		assert len(self.presets) == (len(self.value_edges) + 1) * self.n_energy_bins
+
+	def bpm(self, energy):
+		return energy * self.tempo["scale"] + self.tempo["offset"]
+
+	def melody_transposition_of(self, value):
+		return value * self.melody_transposition["slope"] + self.melody_transposition["offset"]
+
+	def chord_transposition_of(self, value):
+		c = self.chord_transposition
+		(slope_below, offset_below), (slope_above, offset_above) = c["below"], c["above"]
+		if np.ndim(value) == 0:
+			return slope_below * value + offset_below if value < c["split"] else slope_above * value + offset_above
+		return np.where(value < c["split"], slope_below * value + offset_below, slope_above * value + offset_above)
+
+	def chord_value(self, saturation, energy):
+		return self.chord_weights[0] * saturation + self.chord_weights[1] * (1 - energy)
+
+	def preset_index(self, value, energy):
+		return find_bin(self.value_edges, value) * self.n_energy_bins + find_bin(self.energy_edges, energy)
+
+	def map(self, energy, hue, saturation, value) -> dict:
+		"""
+		Maps properties, single values or arrays of a timeline, to the music parameters they select.
+
+		Return:
+			The bpm, the transpositions and the indices of the scale, chord type and instrument preset,
+			see scales, chord_types and presets.
+		"""
+		return {
+			"bpm": self.bpm(energy),
+			"melody_transposition": self.melody_transposition_of(value),
+			"chord_transposition": self.chord_transposition_of(value),
+			"scale": find_bin(self.scale_edges, hue),
+			"chord_type": find_bin(self.chord_edges, self.chord_value(saturation, energy)),
+			"preset": self.preset_index(value, energy),
+		}
+
+	def timeline(self, values:np.ndarray, window:int = 10) -> dict:
+		"""
+		Maps a (frames, channels) property timeline in one pass, after averaging it over the last window
+		frames as atmosvideo does before updating the music.
+		"""
+		values = np.asarray(values, dtype=np.float64)
+		sums = np.cumsum(values, axis=0)
+		sums[window:] -= sums[:-window]
+		# the first frames are averaged over the frames seen so far
+		smoothed = sums / np.minimum(np.arange(1, len(values) + 1), window)[:, None]
+		return self.map(smoothed[:, 0], smoothed[:, 1], smoothed[:, 2], smoothed[:, 3])
+
+	def apply(self, music:MusicGenerator, changed:tuple, last:tuple) -> None:
+		"""
+		Sets the parameters of the music that depend on the properties that changed.
+
+		Args:
+			changed: The properties in the order of timeline.CHANNELS, energy, hue, saturation and value
+				first, with None, or 0, for those that didn't change.
+			last: The last values of the properties, used for those that didn't change.
+		"""
+		energy_p, hue_p, saturation_p, value_p = changed[:4]
+		energy, hue, saturation, value = (new if new else old for new, old in zip(changed[:4], last[:4]))
+
+		if energy_p:
+			new_bpm = self.bpm(energy)
+			if abs(new_bpm - music.bpm) > music.bpm * self.tempo["change"]:
+				music.setBPM(new_bpm)
+
+		if value_p:
+			music.melody.transposition = self.melody_transposition_of(value)
+			music.chords.transposition = self.chord_transposition_of(value)
+
+		if saturation_p or energy_p or value_p:
+			music.melody.rest_rate = self.profile["rest_rate"]
+
+		if hue_p:
+			scale = self.scales[find_bin(self.scale_edges, hue)]
+			music.melody.scale = scale
+			music.chords.scale = scale
+
+		if saturation_p or energy_p:
+			music.chords.chord_type = self.chord_types[find_bin(self.chord_edges, self.chord_value(saturation, energy))]
+
+		music.chords.beats_per_chord = self.profile["beats_per_chord"]
+
+		if value_p or energy_p:
+			preset = self.presets[self.preset_index(value, energy)]
+			if preset is not None:
+				music.control.changeInstrument(music.channel["chords"], *preset["chords"])
+				music.control.changeInstrument(music.channel["melody"], *preset["melody"])
+				music.control.set(music.chords, "arpeggio_freq", preset["arpeggio"])
+				music.control.set(music.chords, "volume", preset["chords_volume"])
+				music.control.set(music.melody, "volume", preset["melody_volume"])
+
+		for channel, generator, attribute, slope, offset, low, high in self.motion:
+			x = changed[channel] if channel < len(changed) and changed[channel] else last[channel] if channel < len(last) else -1
+			# not measured yet, or by a timeline without the motion channels
+			if x < 0:
+				continue
+			setattr(getattr(music, generator), attribute, min(max(slope * x + offset, low), high))
@@ -0,0 +1,168 @@
+import struct
+
+import numpy as np
+
+
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+BANK_SELECT = 0x00
+
+
+def variable_length(value:int) -> bytes:
+	"""
+	Encodes a number as a MIDI variable length quantity, 7 bits per byte, most significant first.
+	"""
+	out = [value & 0x7F]
+	value >>= 7
+	while value:
+		out.append(0x80 | (value & 0x7F))
+		value >>= 7
+	return bytes(reversed(out))
+
+
+class MidiSynth():
+	"""
+	Stands in for Synth and records the events sent to it instead of rendering them.
+
+	Events are kept with the sample they happen at, so they can be written as a Standard MIDI File
+	aligned to the video with save(), or played through the audio synth with replay(). get_samples()
+	only advances the clock, so generating the MIDI of a video costs no more than its analysis.
+	"""
+
+	def __init__(self, samplerate:int = 44100, ticks_per_beat:int = 480) -> None:
+		self.samplerate = samplerate
+		self.ticks_per_beat = ticks_per_beat
+		self.reset()
+
+	def reset(self):
+		"""
+		Drops the recorded events and starts again from sample 0 with the initial instruments and tempo.
+		"""
+		self.position = 0
+		self.events = []
+		self.programs = {}
+		self.active = set()
+		self.set_tempo(120)
+		self.changeInstrument(0, 17, 89)
+		self.changeInstrument(1, 0, 104)
+
+	def close(self):
+		pass
+
+	def changeInstrument(self, channel:int, bank:int, instrument:int):
+		# selecting the instrument already playing is a no-op for the synth, so it isn't recorded
+		if self.programs.get(channel) == (bank, instrument):
+			return
+		self.programs[channel] = (bank, instrument)
+		self.events.append((self.position, "program", channel, bank, instrument))
+
+	def noteon(self, channel:int, key:int, velocity:int):
+		self.active.add((channel, key))
+		self.events.append((self.position, "noteon", channel, key, velocity))
+
+	def noteoff(self, channel:int, key:int):
+		# the generators stop notes that may not be playing, only real note ends are recorded
+		if (channel, key) not in self.active:
+			return
+		self.active.remove((channel, key))
+		self.events.append((self.position, "noteoff", channel, key))
+
+	def silence(self):
+		# a MIDI file has no tails, the notes still playing just end
+		for channel, key in sorted(self.active):
+			self.noteoff(channel, key)
+
+	def align(self, position:int):
+		# events have no blocks, they are recorded at their place in the whole render instead
+		self.position = position
+
+	def set_tempo(self, bpm:float):
+		self.events.append((self.position, "tempo", bpm))
+
+	def get_samples(self, nsamples:int) -> np.ndarray:
+		self.position += nsamples
+		return np.zeros(0, dtype=np.int16)
+
+	def ticks(self) -> list:
+		"""
+		Maps the sample of every event to MIDI ticks, following the tempo changes, so the file
+		plays back at the same times as the audio while the notes stay on the beat grid.
+
+		Return:
+			The tick of every event, in the order of the events.
+		"""
+		ticks = []
+		tick = 0.0
+		last_position = 0
+		bpm = 120
+		for event in self.events:
+			tick += (event[0] - last_position) / self.samplerate * bpm / 60 * self.ticks_per_beat
+			last_position = event[0]
+			if event[1] == "tempo":
+				bpm = event[2]
+			ticks.append(round(tick))
+		return ticks
+
+	def save(self, path:str) -> None:
+		"""
+		Writes the recorded events as a single track Standard MIDI File. Notes still playing end
+		at the current position.
+		"""
+		for channel, key in sorted(self.active):
+			self.noteoff(channel, key)
+
+		track = bytearray()
+		previous = 0
+		for tick, event in zip(self.ticks(), self.events):
+			track += variable_length(tick - previous)
+			previous = tick
+			kind = event[1]
+			if kind == "tempo":
+				track += b"\xFF\x51\x03" + round(60_000_000 / event[2]).to_bytes(3, "big")
+			elif kind == "program":
+				channel, bank, instrument = event[2:]
+				track += bytes((CONTROL_CHANGE | channel, BANK_SELECT, bank))
+				track += variable_length(0) + bytes((PROGRAM_CHANGE | channel, instrument))
+			elif kind == "noteon":
+				channel, key, velocity = event[2:]
+				track += bytes((NOTE_ON | channel, key, velocity))
+			else:
+				channel, key = event[2:]
+				track += bytes((NOTE_OFF | channel, key, 0))
+		track += variable_length(0) + b"\xFF\x2F\x00"
+
+		with open(path, "wb") as f:
+			f.write(b"MThd" + struct.pack(">IHHH", 6, 0, 1, self.ticks_per_beat))
+			f.write(b"MTrk" + struct.pack(">I", len(track)) + bytes(track))
+
+	def replay(self, synth, nsamples:int = None) -> bytes:
+		"""
+		Plays the recorded events through an audio synth at the samples they were recorded at.
+
+		Args:
+			synth (Synth): The synth rendering the events, in its initial state.
+			nsamples (int): The length of the audio, by default up to the current position.
+
+		Return:
+			The rendered samples, the same bytes the audio path generates for the same events.
+		"""
+		nsamples = self.position if nsamples is None else nsamples
+		samples = []
+		position = 0
+		for event in self.events:
+			if event[0] > position:
+				samples.append(synth.get_samples(event[0] - position))
+				position = event[0]
+			kind = event[1]
+			if kind == "program":
+				synth.changeInstrument(*event[2:])
+			elif kind == "noteon":
+				synth.noteon(*event[2:])
+			elif kind == "noteoff":
+				synth.noteoff(*event[2:])
+		if nsamples > position:
+			samples.append(synth.get_samples(nsamples - position))
+		return np.concatenate(samples).astype(np.int16).tobytes() if samples else b""
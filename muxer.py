@@ -0,0 +1,122 @@
+import os
+import subprocess
+
+
+
+def get_ffmpeg_exe() -> str:
+	# ffmpeg comes with imageio-ffmpeg, imported only once something is encoded
+	from imageio_ffmpeg import get_ffmpeg_exe
+	return get_ffmpeg_exe()
+
+
+class AudioMuxer():
+	"""
+	Streams raw audio into an ffmpeg process while it is being generated.
+
+	The audio is read from ffmpeg's stdin as signed 16 bit little endian PCM, so encoding
+	and muxing run alongside the generation and no intermediate WAV file is written.
+	When a video is given its video stream is copied as is and the audio is added to it,
+	otherwise the output is a plain audio file whose format follows its extension.
+	"""
+
+	def __init__(self, output_path:str, sample_rate:int = 44100, channels:int = 2, video_path:str = None) -> None:
+		"""
+		Creates a muxer for the output file.
+
+		Args:
+			output_path (str): The path of the file to be written.
+			sample_rate (int): The sample rate of the incoming audio.
+			channels (int): The number of interleaved channels of the incoming audio.
+			video_path (str): The video whose picture is kept, or None for audio only output.
+		"""
+		self.output_path = output_path
+		self.sample_rate = sample_rate
+		self.channels = channels
+		self.video_path = video_path
+		self.process = None
+		self.bytes_written = 0
+
+	def command(self) -> list:
+		cmd = [get_ffmpeg_exe(), "-y", "-loglevel", "error"]
+		if self.video_path:
+			cmd += ["-i", self.video_path]
+		cmd += ["-f", "s16le", "-ar", str(self.sample_rate), "-ac", str(self.channels), "-i", "pipe:0"]
+		if self.video_path:
+			cmd += ["-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac", "-shortest"]
+		cmd.append(self.output_path)
+		return cmd
+
+	def open(self) -> None:
+		self.process = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+		self.bytes_written = 0
+
+	def write(self, samples:bytes) -> None:
+		"""
+		Sends a chunk of samples to the encoder. Blocks while the encoder is behind.
+		"""
+		try:
+			self.process.stdin.write(samples)
+		except BrokenPipeError:
+			raise RuntimeError(f"ffmpeg stopped while muxing \"{self.output_path}\": {self.error()}")
+		self.bytes_written += len(samples)
+
+	def close(self) -> None:
+		"""
+		Signals the end of the audio and waits for the output file to be finalized.
+		"""
+		try:
+			self.process.stdin.close()
+		except BrokenPipeError:
+			pass
+		returncode = self.process.wait()
+		if returncode != 0:
+			raise RuntimeError(f"ffmpeg failed muxing \"{self.output_path}\": {self.error()}")
+
+	def abort(self) -> None:
+		"""
+		Stops the encoder and removes the partially written output.
+		"""
+		if self.process and self.process.poll() is None:
+			self.process.kill()
+			self.process.wait()
+		try:
+			os.remove(self.output_path)
+		except FileNotFoundError:
+			pass
+
+	def error(self) -> str:
+		if self.process.poll() is None:
+			return ""
+		return self.process.stderr.read().decode(errors="replace").strip()
+
+	def __enter__(self):
+		self.open()
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+		return False
+
+
+def mux_raw_prefix(raw_path:str, video_path:str, output_path:str, seconds:float, sample_rate:int = 44100, channels:int = 2) -> None:
+	"""
+	Muxes the first seconds of a raw PCM file with the same span of a video into a playable file.
+
+	The raw file may still be growing, only the requested span is read from it.
+
+	Args:
+		raw_path (str): Signed 16 bit little endian PCM, as written to AudioMuxer.
+		video_path (str): The video whose picture is copied.
+		output_path (str): The file to be written.
+		seconds (float): The length of the output.
+	"""
+	cmd = [get_ffmpeg_exe(), "-y", "-loglevel", "error",
+		"-t", f"{seconds:.3f}", "-i", video_path,
+		"-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-t", f"{seconds:.3f}", "-i", raw_path,
+		"-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac", "-shortest", output_path]
+	result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	if result.returncode != 0:
+		raise RuntimeError(f"ffmpeg failed muxing \"{output_path}\": {result.stderr.decode(errors='replace').strip()}")
@@ -0,0 +1,156 @@
+import multiprocessing
+import os
+import queue
+import time
+
+from library_index import VIDEO_EXTENSIONS
+
+
+
+class PreAnalyzer():
+	"""
+	Analyses the videos of the library in the background, so generating their soundtrack only
+	costs the synthesis.
+
+	A separate process, at a lower priority and with a limited number of threads, looks for videos
+	of the library without a cached property timeline (new ones, changed ones, and those handed to
+	add()) and extracts their timeline and cut index into the feature cache, most recent first.
+	It only works while the app is idle: set_idle(False), e.g. during playback or generation,
+	holds it before its next frame. Files modified in the last settle_seconds are left for later,
+	they may still be being copied.
+	"""
+
+	def __init__(self, directory:str, features_dir:str, quality:str = "final", threads:int = 1, niceness:int = 10,
+			rescan_seconds:float = 10.0, settle_seconds:float = 2.0) -> None:
+		"""
+		Args:
+			directory (str): The library directory, watched with its subdirectories.
+			features_dir (str): The directory of the FeatureCache the timelines are stored in.
+			quality (str): The render tier whose analysis settings are used, see quality.py.
+			threads (int): The threads the analysis may use, for the optical flow and for OpenCV.
+			niceness (int): How much the priority of the process is lowered, where os.nice() exists.
+			rescan_seconds (float): How often the directory is checked for new or changed videos.
+			settle_seconds (float): How long a file must be left unmodified before it is analysed.
+		"""
+		self.settings = (directory, features_dir, quality, threads, niceness, rescan_seconds, settle_seconds)
+		# spawned, as forking a process with a GUI and its threads is unsafe
+		context = multiprocessing.get_context("spawn")
+		self.idle = context.Event()
+		self.idle.set()
+		self.stopping = context.Event()
+		self.requests = context.Queue()
+		self.results = context.Queue()
+		self.process = context.Process(target=run_preanalysis, args=self.settings + (self.idle, self.stopping,
+			self.requests, self.results), name="preanalysis", daemon=True)
+
+	def start(self) -> None:
+		self.process.start()
+
+	def add(self, video_path:str) -> None:
+		"""
+		Analyses a video before any other waiting, e.g. one just saved into the library.
+		"""
+		self.requests.put(os.path.abspath(video_path))
+
+	def set_idle(self, idle:bool) -> None:
+		if idle:
+			self.idle.set()
+		else:
+			self.idle.clear()
+
+	def finished(self) -> list:
+		"""
+		Return:
+			The (video path, features key) of the videos analysed since the last call.
+		"""
+		finished = []
+		while True:
+			try:
+				finished.append(self.results.get_nowait())
+			except queue.Empty:
+				return finished
+
+	def stop(self, timeout:float = 5.0) -> None:
+		self.stopping.set()
+		# a held analysis sees the stop at once
+		self.idle.set()
+		self.process.join(timeout)
+		if self.process.is_alive():
+			self.process.terminate()
+
+
+def run_preanalysis(directory:str, features_dir:str, quality:str, threads:int, niceness:int, rescan_seconds:float,
+		settle_seconds:float, idle, stopping, requests, results) -> None:
+	# lowered first, the threads started afterwards inherit the priority
+	if hasattr(os, "nice"):
+		os.nice(niceness)
+	import cv2
+	from feature_cache import FeatureCache
+	from quality import quality_settings
+	from video_properties_2 import VideoPropertiesExtractor
+	cv2.setNumThreads(threads)
+	features = FeatureCache(features_dir)
+	extractor = VideoPropertiesExtractor(quality_settings(quality)["analysis_height"])
+	extractor.n_threads = threads
+	params = extractor.params()
+	# (path, size, mtime) of the videos that couldn't be read, tried again only once they change
+	failed = set()
+
+	def wait(key:str) -> bool:
+		if idle.is_set():
+			return not stopping.is_set()
+		while not idle.wait(0.5):
+			if stopping.is_set():
+				return False
+		# the video may have been generated, and so analysed, in the meantime
+		return not stopping.is_set() and not os.path.exists(features.path(key))
+
+	def next_video() -> str:
+		try:
+			return requests.get_nowait()
+		except queue.Empty:
+			pass
+		now = time.time()
+		latest = None
+		for root, dirs, files in os.walk(directory):
+			for filename in files:
+				if not filename.lower().endswith(VIDEO_EXTENSIONS):
+					continue
+				path = os.path.join(root, filename)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				if now - stat.st_mtime < settle_seconds or (path, stat.st_size, stat.st_mtime_ns) in failed:
+					continue
+				if os.path.exists(features.path(features.key(path, params))):
+					continue
+				if latest is None or stat.st_mtime > latest[0]:
+					latest = (stat.st_mtime, path)
+		return latest[1] if latest else None
+
+	while not stopping.is_set():
+		video_path = next_video()
+		if video_path is None:
+			try:
+				# a saved video is taken at once, the directory is checked again after a while
+				video_path = requests.get(timeout=rescan_seconds)
+			except queue.Empty:
+				continue
+		try:
+			stat = os.stat(video_path)
+			key = features.key(video_path, params)
+		except OSError:
+			continue
+		if not wait(key):
+			continue
+		try:
+			_, _, timeline = features.extract(video_path, extractor, wait)
+			timeline.close()
+		except RuntimeError:
+			if not os.path.exists(features.path(key)) and not stopping.is_set():
+				failed.add((video_path, stat.st_size, stat.st_mtime_ns))
+				continue
+		if os.path.exists(features.path(key)):
+			features.cuts(key)
+			results.put((video_path, key))
@@ -0,0 +1,22 @@
+EVENT_RATE = 44100
+
+# render tiers: the synth settings and the analysis height they are paired with. The tiers share the height,
+# the energy and with it the notes and tempo depend on it, and a final render reuses the timeline cached for a draft
+QUALITIES = {
+	"final": {"sample_rate": 44100, "channels": 2, "polyphony": 256, "effects": True, "analysis_height": 180},
+	# for quick "does this sound right" checks, the notes are the same as the final render, only the synth is cheaper
+	"draft": {"sample_rate": 22050, "channels": 1, "polyphony": 32, "effects": False, "analysis_height": 180},
+}
+
+
+def quality_settings(quality:str, sample_rate:int = None) -> dict:
+	"""
+	Return:
+		The settings of a render tier, with its sample rate replaced by sample_rate if given.
+	"""
+	if quality not in QUALITIES:
+		raise ValueError(f"Unknown quality \"{quality}\", expected one of {', '.join(QUALITIES)}")
+	settings = dict(QUALITIES[quality])
+	if sample_rate:
+		settings["sample_rate"] = sample_rate
+	return settings
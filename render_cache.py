@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import shutil
+
+
+
+class RenderCache():
+	"""
+	Keeps finished renders (muxed videos, audio or MIDI files) so a repeated request is answered
+	by copying a file instead of rendering again.
+
+	Renders are keyed by the feature cache key of the video (its identity and analysis settings)
+	and the render configuration (mapping, seed, synth settings and output format). The least
+	recently used renders are removed once the cache grows over max_bytes. Several processes can
+	share the cache directory.
+	"""
+
+	def __init__(self, cache_dir:str, max_bytes:int = 2 * 1024**3) -> None:
+		"""
+		Args:
+			cache_dir (str): Where the renders are stored.
+			max_bytes (int): The size the cache is trimmed to after every store().
+		"""
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		os.makedirs(cache_dir, exist_ok=True)
+
+	@staticmethod
+	def key(features_key:str, config:dict, output_format:str) -> str:
+		identity = json.dumps([features_key, config, output_format], sort_keys=True)
+		return hashlib.sha1(identity.encode()).hexdigest()
+
+	def path(self, key:str, output_format:str) -> str:
+		return os.path.join(self.cache_dir, f"{key}.{output_format}")
+
+	def used_path(self, path:str) -> str:
+		# its mtime is when the render was last used, the render's own keeps when it was made
+		return f"{path}.used"
+
+	def fetch(self, key:str, output_format:str, output_path:str) -> bool:
+		"""
+		Copies the cached render to output_path, if there is one.
+
+		Return:
+			True if the render was cached.
+		"""
+		path = self.path(key, output_format)
+		try:
+			copy_render(path, output_path)
+		except FileNotFoundError:
+			return False
+		self.touch(path)
+		return True
+
+	def store(self, key:str, output_format:str, render_path:str) -> None:
+		"""
+		Adds a finished render to the cache, then evicts the least recently used ones over the size limit.
+		"""
+		path = self.path(key, output_format)
+		copy_render(render_path, path)
+		self.touch(path)
+		self.evict()
+
+	def touch(self, path:str) -> None:
+		"""
+		Marks a render as recently used.
+		"""
+		with open(self.used_path(path), "a"):
+			pass
+		os.utime(self.used_path(path))
+
+	def evict(self) -> int:
+		"""
+		Return:
+			The number of renders removed to bring the cache under max_bytes.
+		"""
+		entries = []
+		markers = []
+		for entry in os.scandir(self.cache_dir):
+			if entry.name.endswith(".used"):
+				markers.append(entry.path)
+				continue
+			if entry.name.endswith(".part"):
+				continue
+			try:
+				stat = entry.stat()
+			except FileNotFoundError:
+				continue
+			try:
+				used = os.stat(self.used_path(entry.path)).st_mtime
+			except FileNotFoundError:
+				used = stat.st_mtime
+			entries.append((used, stat.st_size, entry.path))
+		# left by a fetch racing the eviction of its render
+		renders = {path for _, _, path in entries}
+		for marker in markers:
+			if marker[:-len(".used")] not in renders:
+				try:
+					os.remove(marker)
+				except FileNotFoundError:
+					pass
+		total = sum(size for _, size, _ in entries)
+		removed = 0
+		for _, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			for name in (path, self.used_path(path)):
+				try:
+					os.remove(name)
+				except FileNotFoundError:
+					pass
+			total -= size
+			removed += 1
+		return removed
+
+
+def copy_render(source:str, destination:str) -> None:
+	"""
+	Copies source to destination through a temporary file, so the destination is never seen half
+	written. The two never share their data, an output edited later leaves the cache intact.
+	copy_file_range() lets the kernel copy without going through the process, and file systems
+	with shared extents (btrfs, XFS) make it a reflink that costs no space until either is changed.
+	"""
+	tmp_path = f"{destination}.{os.getpid()}.part"
+	try:
+		with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+			copied = 0
+			if hasattr(os, "copy_file_range"):
+				size = os.fstat(src.fileno()).st_size
+				try:
+					while copied < size:
+						n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+						if n == 0:
+							break
+						copied += n
+				except OSError:
+					# e.g. across file systems on older kernels
+					copied = 0
+					src.seek(0)
+					dst.seek(0)
+					dst.truncate()
+			if not copied:
+				shutil.copyfileobj(src, dst)
+		os.replace(tmp_path, destination)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
@@ -0,0 +1,230 @@
+import os
+import sys
+import threading
+import time
+
+try:
+	import resource
+except ImportError:
+	# Windows, where the CPU times come from os.times() and the memory and I/O aren't measured
+	resource = None
+
+
+# the stages of a run, they follow one another on the thread rendering the soundtrack
+STAGES = ("decode", "resize", "flow", "synthesis", "mux")
+# /proc/self/io counters and the names they are reported under: every byte passed to read() and write(),
+# pipes and page cache included, then what actually went to or came from the storage
+IO_FIELDS = {"rchar": "read_bytes", "wchar": "write_bytes", "read_bytes": "storage_read_bytes", "write_bytes": "storage_write_bytes"}
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+
+def cpu_times() -> tuple:
+	"""
+	Return:
+		The (user, system) seconds of this process and of the children it waited for, e.g. an ffmpeg encoder.
+	"""
+	if resource is None:
+		times = os.times()
+		return times.user + times.children_user, times.system + times.children_system
+	own = resource.getrusage(resource.RUSAGE_SELF)
+	children = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime
+
+
+def current_rss() -> int:
+	"""
+	Return:
+		The resident memory of the process in bytes, or None where /proc isn't available.
+	"""
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[1]) * PAGE_SIZE
+	except OSError:
+		return None
+
+
+def lifetime_peak_rss() -> int:
+	"""
+	Return:
+		The highest resident memory of the process since it started, in bytes.
+	"""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kilobytes on Linux, bytes on macOS
+	return peak if sys.platform == "darwin" else peak * 1024
+
+
+def io_counters() -> dict:
+	"""
+	Return:
+		The I/O counters of the process, see IO_FIELDS, or None where /proc/self/io isn't available.
+	"""
+	try:
+		with open("/proc/self/io") as f:
+			lines = f.read().splitlines()
+	except OSError:
+		return None
+	counters = {}
+	for line in lines:
+		name, _, value = line.partition(":")
+		if name in IO_FIELDS:
+			counters[IO_FIELDS[name]] = int(value)
+	return counters
+
+
+def usage() -> dict:
+	"""
+	Return:
+		The CPU seconds used so far and the current resident memory, to measure a step with difference().
+	"""
+	user, system = cpu_times()
+	return {"cpu_seconds": user + system, "rss_bytes": current_rss()}
+
+
+def difference(after:dict, before:dict) -> dict:
+	return {name: None if value is None or before[name] is None else value - before[name] for name, value in after.items()}
+
+
+class ResourceMonitor():
+	"""
+	Records the CPU time, memory and I/O of a run per stage, for sizing worker pools.
+
+	The stages are the components of a ComponentTimer whose monitor it is: every span of a stage
+	adds the CPU time the process (and the children it waited for) used during it, minus that of
+	the stages nested in it, e.g. the decoding of the next frame within the flow. A thread samples
+	the resident memory and the I/O counters every interval, the I/O since the last sample is
+	counted for the stage running at the sample and the memory is kept as the peak of that stage.
+	Time outside the stages is reported as "other".
+
+	The stages are expected to follow one another, as in offline renders. Stages running at once on
+	several threads, e.g. in the live preview, are each charged with the CPU of both.
+	"""
+
+	def __init__(self, stages:tuple = STAGES, interval:float = 0.01) -> None:
+		"""
+		Args:
+			stages (tuple): The timer components accounted for.
+			interval (float): The seconds between two samples of the memory and I/O.
+		"""
+		self.stages = frozenset(stages)
+		self.interval = interval
+		self.thread = None
+		self.running = threading.Event()
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self) -> None:
+		# spans left open by a run that failed don't carry over
+		self.active = []
+		# the stages open on every thread, and the CPU time when the innermost one was last charged
+		self.stacks = {}
+		self.marks = {}
+		self.totals = {}
+		self.start_time = time.perf_counter()
+		self.start_usage = usage()
+		self.peak_rss = self.start_usage["rss_bytes"]
+		self.last_io = io_counters()
+
+	def stage(self, name:str) -> dict:
+		if name not in self.totals:
+			self.totals[name] = {"spans": 0, "cpu_seconds": 0.0, "peak_rss_bytes": None}
+			if self.last_io is not None:
+				self.totals[name].update(dict.fromkeys(IO_FIELDS.values(), 0))
+		return self.totals[name]
+
+	def start(self) -> None:
+		"""
+		Starts recording a run. Does nothing while one is already being recorded, so a caller can
+		cover more of the run than the Atmosvideo it drives.
+		"""
+		if self.running.is_set():
+			return
+		self.reset()
+		self.running.set()
+		self.thread = threading.Thread(target=self.run, name="resources", daemon=True)
+		self.thread.start()
+
+	def enter(self, name:str) -> None:
+		now = sum(cpu_times())
+		tid = threading.get_ident()
+		with self.lock:
+			stack = self.stacks.setdefault(tid, [])
+			if stack:
+				# the enclosing stage is charged up to here
+				self.stage(stack[-1])["cpu_seconds"] += now - self.marks[tid]
+			stack.append(name)
+			self.marks[tid] = now
+			self.active.append(name)
+
+	def leave(self, name:str) -> None:
+		now = sum(cpu_times())
+		tid = threading.get_ident()
+		with self.lock:
+			stack = self.stacks.get(tid)
+			if not stack or name not in stack:
+				return
+			totals = self.stage(name)
+			totals["spans"] += 1
+			totals["cpu_seconds"] += now - self.marks[tid]
+			stack.remove(name)
+			# the enclosing stage resumes
+			self.marks[tid] = now
+			self.active.remove(name)
+
+	def run(self) -> None:
+		while self.running.is_set():
+			self.sample()
+			time.sleep(self.interval)
+
+	def sample(self) -> None:
+		rss = current_rss()
+		io = io_counters()
+		with self.lock:
+			name = self.active[-1] if self.active else "other"
+			totals = self.stage(name)
+			if rss is not None:
+				totals["peak_rss_bytes"] = max(totals["peak_rss_bytes"] or 0, rss)
+				self.peak_rss = max(self.peak_rss or 0, rss)
+			if io is not None and self.last_io is not None:
+				for field, value in io.items():
+					totals[field] += value - self.last_io[field]
+			self.last_io = io
+
+	def stop(self) -> dict:
+		"""
+		Ends the run and returns its report, see report(). Returns None if no run was being recorded.
+		"""
+		if not self.running.is_set():
+			return None
+		self.running.clear()
+		self.thread.join()
+		# what happened since the last sample
+		self.sample()
+		return self.report()
+
+	def report(self) -> dict:
+		"""
+		Return:
+			The wall and CPU seconds of the run, the resident memory at its start (models and soundfont
+			already loaded) and its peak, the peak since the process started, the bytes read and written,
+			and the same per stage, "other" for everything outside the stages.
+		"""
+		run = difference(usage(), self.start_usage)
+		with self.lock:
+			stages = {name: dict(totals) for name, totals in self.totals.items()}
+		other = stages.setdefault("other", {"spans": 0, "cpu_seconds": 0.0, "peak_rss_bytes": None})
+		other["cpu_seconds"] = max(run["cpu_seconds"] - sum(totals["cpu_seconds"] for name, totals in stages.items() if name != "other"), 0.0)
+		report = {
+			"wall_seconds": time.perf_counter() - self.start_time,
+			"cpu_seconds": run["cpu_seconds"],
+			"start_rss_bytes": self.start_usage["rss_bytes"],
+			"peak_rss_bytes": self.peak_rss,
+			"lifetime_peak_rss_bytes": lifetime_peak_rss(),
+			"stages": stages,
+		}
+		if self.last_io is not None:
+			for field in IO_FIELDS.values():
+				report[field] = sum(totals.get(field, 0) for totals in stages.values())
+		return report
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from atmosvideo import Atmosvideo
+from MusicGeneration import SYNTH_BLOCK
+from midi import MidiSynth
+
+# how long a note is heard after it ends, its release and the reverb
+TAIL_SECONDS = 4.0
+SEGMENT_CACHE_BYTES = 2 * 1024**3
+
+
+class SegmentRenderer():
+	"""
+	Renders a soundtrack from a property timeline as fixed length segments cached by their content.
+
+	The synth's voices and effects can't be saved, so a segment can't simply continue from the music state at its
+	start: the notes held there would start again and the tails of earlier notes would be cut. Every segment
+	has a pre-roll instead, from the start of the earliest note still heard at its start (see score_segments()).
+	Segments rendered one after the other continue the same synth, as the streamed render does. When the segment
+	before was reused, the music state at the start of the pre-roll is restored and the pre-roll is rendered and
+	dropped, after which the same notes sound as in the streamed render. Only the chorus and the reverb can
+	differ slightly from it there, with what they kept of the notes before the pre-roll.
+
+	A segment is keyed by the timeline from its pre-roll to its end, the music state at the start of its pre-roll
+	(property history, random number generators, tempo, instruments and held notes) and the render configuration.
+	Any change of the configuration renders every segment again. After a change of the timeline the segments
+	whose pre-roll and frames come before the first changed frame are reused; later segments only when their
+	music state is unchanged too, as every segment depends on the music that led to it.
+
+	The least recently used segments are removed once the cache grows over max_bytes. Several processes
+	can share the cache directory.
+	"""
+
+	def __init__(self, cache_dir:str, atmos:Atmosvideo, segment_seconds:float = 10.0, tail_seconds:float = TAIL_SECONDS,
+			max_bytes:int = SEGMENT_CACHE_BYTES) -> None:
+		"""
+		Args:
+			cache_dir (str): Where the segments are stored.
+			atmos (Atmosvideo): Renders the segments that aren't cached.
+			segment_seconds (float): The length of the segments.
+			tail_seconds (float): How long a note is heard after it ends, see score_segments().
+			max_bytes (int): The size the cache is trimmed to after every render().
+		"""
+		self.cache_dir = cache_dir
+		self.atmos = atmos
+		self.segment_seconds = segment_seconds
+		self.tail_seconds = tail_seconds
+		self.max_bytes = max_bytes
+		self.scorer = None
+		os.makedirs(cache_dir, exist_ok=True)
+
+	def config(self) -> dict:
+		return self.atmos.render_config()
+
+	def segment_key(self, values:np.ndarray, state:dict, preroll:int, block:int) -> str:
+		digest = hashlib.sha1(np.ascontiguousarray(values, dtype=np.float32).tobytes())
+		digest.update(json.dumps([self.config(), state, preroll, block], sort_keys=True).encode())
+		return digest.hexdigest()
+
+	def paths(self, key:str) -> tuple:
+		return os.path.join(self.cache_dir, f"{key}.pcm"), os.path.join(self.cache_dir, f"{key}.json")
+
+	def segment_bytes(self, start:int, end:int, nsamples_frame:int) -> int:
+		"""
+		Return:
+			The size of the samples of the frames from start to end.
+		"""
+		music = self.atmos.music
+		if isinstance(music.synth, MidiSynth):
+			return 0
+		frames = music.output_position(end * nsamples_frame) - music.output_position(start * nsamples_frame)
+		return frames * music.channels * 2
+
+	def fetch(self, key:str, size:int):
+		"""
+		Return:
+			The samples of a cached segment, or None if it isn't cached or its files are incomplete or
+			don't have the size expected, e.g. after a crash or a full disk, so it is rendered again.
+		"""
+		samples_path, state_path = self.paths(key)
+		try:
+			with open(state_path) as f:
+				written = json.load(f)
+			with open(samples_path, "rb") as f:
+				samples = f.read()
+		except (OSError, ValueError):
+			return None
+		if written.get("bytes") != size or len(samples) != size:
+			return None
+		# the sidecar's mtime is when the segment was last used
+		try:
+			os.utime(state_path)
+		except FileNotFoundError:
+			pass
+		return samples
+
+	def evict(self) -> int:
+		"""
+		Return:
+			The number of segments removed to bring the cache under max_bytes.
+		"""
+		segments = {}
+		for entry in os.scandir(self.cache_dir):
+			if entry.name.endswith(".part"):
+				continue
+			key, extension = os.path.splitext(entry.name)
+			try:
+				stat = entry.stat()
+			except FileNotFoundError:
+				continue
+			size, used = segments.get(key, (0, 0.0))
+			# samples without a sidecar are incomplete and go first
+			segments[key] = (size + stat.st_size, stat.st_mtime if extension == ".json" else used)
+		total = sum(size for size, _ in segments.values())
+		removed = 0
+		for used, key in sorted((used, key) for key, (_, used) in segments.items()):
+			if total <= self.max_bytes:
+				break
+			# the sidecar first, a segment without it is never reused
+			for path in reversed(self.paths(key)):
+				try:
+					os.remove(path)
+				except FileNotFoundError:
+					pass
+			total -= segments[key][0]
+			removed += 1
+		return removed
+
+	def score(self, values, fps:float, frames_per_segment:int) -> list:
+		if self.atmos.music.seed is None:
+			raise ValueError("Segments can only be reused with a seeded music generator")
+		if self.scorer is None:
+			atmos = self.atmos
+			# the notes are timed on the event clock, a MIDI run goes through the states of the audio render
+			self.scorer = Atmosvideo(live=False, timing=False, midi=True, quality=atmos.quality, seed=atmos.music.seed,
+				profile=atmos.profile.profile)
+		return score_segments(self.scorer, values, fps, frames_per_segment, self.tail_seconds)
+
+	def render(self, features_key:str, fps:float, values:np.ndarray, sink) -> dict:
+		"""
+		Renders the soundtrack of a timeline, reusing the cached segments.
+
+		Args:
+			features_key (str): The key of the timeline in the feature cache.
+			fps (float): The frame rate of the timeline.
+			values: The (frames, 4) timeline of energy, hue, saturation and value, an array or a Timeline
+				from the feature cache, of which only one segment is read at a time.
+			sink: Callable receiving the samples in order, e.g. AudioMuxer.write.
+
+		Return:
+			The number of segments, how many were reused and rendered, and the frames of pre-roll rendered.
+		"""
+		atmos = self.atmos
+		nsamples_frame = round(atmos.music.samplerate / fps)
+		frames_per_segment = max(1, round(self.segment_seconds * fps))
+		scores = self.score(values, fps, frames_per_segment)
+		atmos.reset()
+		stats = {"segments": 0, "reused": 0, "rendered": 0, "preroll_frames": 0}
+		# the frame the synth has rendered up to, it continues from there if the next segment is rendered
+		position = 0
+
+		for start, (preroll, state) in zip(range(0, len(values), frames_per_segment), scores):
+			segment = values[start:start + frames_per_segment]
+			block = atmos.music.output_position(preroll * nsamples_frame) % SYNTH_BLOCK
+			key = self.segment_key(values[preroll:start + len(segment)], state, start - preroll, block)
+			stats["segments"] += 1
+
+			samples = self.fetch(key, self.segment_bytes(start, start + len(segment), nsamples_frame))
+			if samples is not None:
+				sink(samples)
+				atmos.samples_done += nsamples_frame * len(segment)
+				atmos.i_frame += len(segment)
+				stats["reused"] += 1
+				continue
+
+			if position != start:
+				continue_from(atmos, preroll, state, values[preroll:start], nsamples_frame)
+				stats["preroll_frames"] += start - preroll
+			samples_path, state_path = self.paths(key)
+			tmp_path = f"{samples_path}.{os.getpid()}.part"
+			try:
+				with open(tmp_path, "wb") as f:
+					for row in segment:
+						atmos.i_frame += 1
+						samples = atmos.synthesize(tuple(float(x) for x in row), nsamples_frame)
+						f.write(samples)
+						sink(samples)
+					size = f.tell()
+				os.replace(tmp_path, samples_path)
+			except BaseException:
+				if os.path.exists(tmp_path):
+					os.remove(tmp_path)
+				raise
+			position = start + len(segment)
+			# written last, it marks the segment as complete
+			write_json(state_path, {"bytes": size, "state": state})
+			stats["rendered"] += 1
+
+		stats["evicted"] = self.evict()
+		return stats
+
+
+def score_segments(scorer:Atmosvideo, values, fps:float, segment_frames:int, tail_seconds:float = TAIL_SECONDS) -> list:
+	"""
+	Finds where the pre-roll of every segment starts and the music state there, by generating the MIDI
+	of the timeline, which costs no more than reading it.
+
+	A pre-roll starts with the frame of the earliest note still held at the start of its segment or that
+	ended less than tail_seconds before, so it is long enough that every note heard at the segment start
+	is started at the same sample as in a render of the whole timeline. The notes held at the start of
+	the pre-roll, started again when its state is restored, have ended tail_seconds before the segment.
+
+	Args:
+		scorer (Atmosvideo): An atmosvideo recording MIDI, with the settings of the one rendering the segments.
+		values: The (frames, channels) timeline, see timeline.CHANNELS, an array or a Timeline.
+		fps (float): The frame rate of the timeline.
+		segment_frames (int): The length of the segments.
+		tail_seconds (float): How long a note is heard after it ends.
+
+	Return:
+		For every segment, the frame at which its pre-roll starts and the get_state() of the scorer there.
+	"""
+	nsamples_frame = round(scorer.music.samplerate / fps)
+	tail = round(tail_seconds * scorer.music.samplerate)
+	prerolls = []
+	scorer.reset()
+	events = scorer.music.synth.events
+	seen = 0
+	# the sample each playing note started at, and the start and end of the notes that ended lately
+	held = {}
+	ended = []
+	for i, row in enumerate(values):
+		if i % segment_frames == 0:
+			for event in events[seen:]:
+				if event[1] == "noteon":
+					# a note started again while it plays ends the one before
+					if (event[2], event[3]) in held:
+						ended.append((held[(event[2], event[3])], event[0]))
+					held[(event[2], event[3])] = event[0]
+				elif event[1] == "noteoff":
+					ended.append((held.pop((event[2], event[3])), event[0]))
+			seen = len(events)
+			position = i * nsamples_frame
+			ended = [(on, off) for on, off in ended if off > position - tail]
+			first = min([*held.values(), *(on for on, _ in ended)], default=position)
+			prerolls.append(min(i, first // nsamples_frame))
+		scorer.i_frame += 1
+		scorer.synthesize(tuple(float(x) for x in row), nsamples_frame)
+
+	# the states are taken in a second run, the frames they are needed at are only known now
+	states = {}
+	needed = set(prerolls)
+	scorer.reset()
+	last = max(prerolls, default=0)
+	for i, row in enumerate(values[:last + 1]):
+		if i in needed:
+			# taking a snapshot flushes held changes, the notes are left as the audio render plays them
+			states[i] = scorer.get_state()
+		if i == last:
+			break
+		scorer.i_frame += 1
+		scorer.synthesize(tuple(float(x) for x in row), nsamples_frame)
+	return [(preroll, states[preroll]) for preroll in prerolls]
+
+
+def write_json(path:str, value) -> None:
+	"""
+	Writes a JSON file through a temporary file, so it is never seen half written.
+	"""
+	tmp_path = f"{path}.{os.getpid()}.part"
+	try:
+		with open(tmp_path, "w") as f:
+			json.dump(value, f)
+		os.replace(tmp_path, path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+
+def continue_from(atmos:Atmosvideo, frame:int, state:dict, preroll, nsamples_frame:int) -> None:
+	"""
+	Brings atmosvideo from any state to where a render of the whole timeline is at the end of the pre-roll.
+	The synth is aligned with the render at frame, the music state taken there is restored and the
+	pre-roll is rendered with its samples dropped.
+
+	Args:
+		atmos (Atmosvideo): The atmosvideo to continue.
+		frame (int): The frame the pre-roll starts at.
+		state (dict): The get_state() of the render at frame.
+		preroll: The values of the frames of the pre-roll.
+		nsamples_frame (int): The samples of a frame on the event clock.
+	"""
+	atmos.music.align(frame * nsamples_frame)
+	# as in the whole render, the parameters are updated on the same samples
+	atmos.samples_done = frame * nsamples_frame
+	atmos.set_state(state)
+	for row in preroll:
+		atmos.synthesize(tuple(float(x) for x in row), nsamples_frame)
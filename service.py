@@ -0,0 +1,423 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from batch import OUTPUT_FORMATS, RENDER_CACHE_BYTES, init_worker, process_video
+from library_index import VIDEO_EXTENSIONS
+from quality import QUALITIES
+
+
+CONTENT_TYPES = {"mp4": "video/mp4", "wav": "audio/wav", "mp3": "audio/mpeg", "mid": "audio/midi"}
+UPLOAD_CHUNK = 1024 * 1024
+
+
+class ServiceJob():
+	"""
+	A soundtrack requested from the service. Its fields are only changed under the service's lock.
+	"""
+	# status codes, the names are what the API reports
+	QUEUED = "queued"
+	RUNNING = "running"
+	DONE = "done"
+	ERROR = "error"
+
+	def __init__(self, job_id:str, video_path:str, output_format:str, output_path:str) -> None:
+		self.id = job_id
+		self.video_path = video_path
+		self.output_format = output_format
+		self.output_path = output_path
+		self.status = ServiceJob.QUEUED
+		self.stage = None
+		self.frames = 0
+		self.total = None
+		self.error = None
+		self.cached = False
+		self.resources = None
+		self.requests = 1
+		self.created = time.time()
+		self.finished = None
+		# bumped on every change, so streams only send what changed
+		self.version = 0
+
+	def describe(self) -> dict:
+		return {
+			"id": self.id,
+			"input": self.video_path,
+			"format": self.output_format,
+			"status": self.status,
+			"stage": self.stage,
+			"frames": self.frames,
+			"total": self.total,
+			"progress": 1.0 if self.status == ServiceJob.DONE else (min(self.frames / self.total, 1.0) if self.total else 0.0),
+			"cached": self.cached,
+			"requests": self.requests,
+			"error": self.error,
+			"seconds": (self.finished or time.time()) - self.created,
+			"resources": self.resources,
+		}
+
+
+class JobService():
+	"""
+	Generates soundtracks for other local tools, on a bounded pool of worker processes.
+
+	Jobs are keyed by the identity of the video (path, size and mtime) and the output format, so a
+	request for a soundtrack already queued or running joins that job. Finished soundtracks are kept
+	in the render cache and the analysed timelines in the feature cache, both under cache_dir, so
+	a repeated request is answered without rendering or analysing again. At most max_pending jobs
+	wait or run at once, further requests are refused until some finish.
+	"""
+
+	def __init__(self, cache_dir:str, jobs:int = 2, max_pending:int = 64, sample_rate:int = None, quality:str = "final",
+			seed:int = 0, profile:str = "default", render_cache_bytes:int = RENDER_CACHE_BYTES, keep_seconds:float = 3600) -> None:
+		"""
+		Args:
+			cache_dir (str): Where the caches, the uploaded videos and the results are stored.
+			jobs (int): The number of worker processes of each pool, audio and MIDI jobs have their own.
+			max_pending (int): The number of jobs waiting or running above which requests are refused.
+			sample_rate, quality, seed, profile: The settings of the soundtracks, see batch.py.
+			keep_seconds (float): How long a finished job and its result are kept, the render cache
+				still answers a later request for the same soundtrack. An uploaded video is kept as long
+				after it was last uploaded or its last job ended.
+		"""
+		self.cache_dir = cache_dir
+		self.jobs = jobs
+		self.max_pending = max_pending
+		self.keep_seconds = keep_seconds
+		self.settings = (sample_rate, False, quality, None, seed, profile)
+		self.render_cache_bytes = render_cache_bytes
+		self.uploads_dir = os.path.abspath(os.path.join(cache_dir, "uploads"))
+		self.results_dir = os.path.join(cache_dir, "results")
+		os.makedirs(self.uploads_dir, exist_ok=True)
+		os.makedirs(self.results_dir, exist_ok=True)
+		# the uploaded videos and when they were last uploaded or used, those of earlier runs by their mtime
+		self.uploads = {}
+		for entry in os.scandir(self.uploads_dir):
+			if entry.name.endswith(".part"):
+				# left by an upload that was cut short
+				os.remove(entry.path)
+			else:
+				self.uploads[entry.path] = entry.stat().st_mtime
+		self.lock = threading.Condition()
+		self.by_id = {}
+		self.by_key = {}
+		self.pools = {}
+		self.progress = multiprocessing.Queue()
+		self.listener = threading.Thread(target=self.listen, daemon=True)
+		self.listener.start()
+
+	def pool(self, midi:bool) -> ProcessPoolExecutor:
+		# called under the lock. MIDI jobs need workers recording events, created on the first request for one
+		if midi not in self.pools:
+			sample_rate, trace, quality, analysis_quality, seed, profile = self.settings
+			self.pools[midi] = ProcessPoolExecutor(max_workers=self.jobs, initializer=init_worker,
+				initargs=(sample_rate, trace, midi, quality, analysis_quality, seed, profile, self.progress))
+		return self.pools[midi]
+
+	def forget_old(self) -> None:
+		# called under the lock
+		now = time.time()
+		for key, job in list(self.by_key.items()):
+			if job.finished is not None and now - job.finished > self.keep_seconds:
+				del self.by_key[key]
+				self.by_id.pop(job.id, None)
+				if os.path.exists(job.output_path):
+					os.remove(job.output_path)
+		in_use = {job.video_path for job in self.by_key.values() if job.status in (ServiceJob.QUEUED, ServiceJob.RUNNING)}
+		for path, used in list(self.uploads.items()):
+			if path not in in_use and now - used > self.keep_seconds:
+				del self.uploads[path]
+				try:
+					os.remove(path)
+				except FileNotFoundError:
+					pass
+
+	def pending(self) -> int:
+		return sum(1 for job in self.by_key.values() if job.status in (ServiceJob.QUEUED, ServiceJob.RUNNING))
+
+	def submit(self, video_path:str, output_format:str) -> tuple:
+		"""
+		Queues the soundtrack of a video, or joins the job already making it.
+
+		Return:
+			(job, created) with created False when an existing job was joined, or (None, False) when too
+			many jobs are pending.
+		"""
+		if output_format not in OUTPUT_FORMATS:
+			raise ValueError(f"Unknown format \"{output_format}\", expected one of {', '.join(OUTPUT_FORMATS)}")
+		video_path = os.path.abspath(video_path)
+		stat = os.stat(video_path)
+		key = hashlib.sha1(json.dumps([video_path, stat.st_size, stat.st_mtime_ns, output_format]).encode()).hexdigest()
+		with self.lock:
+			self.forget_old()
+			job = self.by_key.get(key)
+			if job is not None and job.status != ServiceJob.ERROR and (job.status != ServiceJob.DONE or os.path.exists(job.output_path)):
+				job.requests += 1
+				return job, False
+			if self.pending() >= self.max_pending:
+				return None, False
+			job_id = uuid.uuid4().hex[:16]
+			job = ServiceJob(job_id, video_path, output_format, os.path.join(self.results_dir, f"{job_id}.{output_format}"))
+			self.by_id[job_id] = job
+			self.by_key[key] = job
+			pool = self.pool(output_format == "mid")
+		future = pool.submit(process_video, video_path, job.output_path, output_format, None, self.cache_dir,
+			self.render_cache_bytes, job_id)
+		future.add_done_callback(lambda future: self.finish(job, future))
+		return job, True
+
+	def upload(self, stream, length:int, name:str) -> str:
+		"""
+		Stores an uploaded video under the hash of its content, so uploading the same video again
+		reuses the file, and with it the cached analysis and renders.
+
+		Return:
+			The path of the stored video.
+		"""
+		extension = os.path.splitext(name)[1].lower() if name else ""
+		if extension not in VIDEO_EXTENSIONS:
+			extension = ".mp4"
+		digest = hashlib.sha1()
+		fd, tmp_path = tempfile.mkstemp(dir=self.uploads_dir, suffix=".part")
+		with os.fdopen(fd, "wb") as f:
+			remaining = length
+			while remaining > 0:
+				chunk = stream.read(min(UPLOAD_CHUNK, remaining))
+				if not chunk:
+					break
+				digest.update(chunk)
+				f.write(chunk)
+				remaining -= len(chunk)
+		if remaining > 0:
+			os.remove(tmp_path)
+			raise ValueError("The upload ended before its Content-Length")
+		path = os.path.join(self.uploads_dir, f"{digest.hexdigest()}{extension}")
+		with self.lock:
+			if os.path.exists(path):
+				# keeps the mtime of the first upload, which the cache keys depend on
+				os.remove(tmp_path)
+			else:
+				os.replace(tmp_path, path)
+			self.uploads[path] = time.time()
+		return path
+
+	def listen(self) -> None:
+		while True:
+			message = self.progress.get()
+			if message is None:
+				return
+			job_id, stage, frames, total = message
+			with self.lock:
+				job = self.by_id.get(job_id)
+				if job is None or job.status not in (ServiceJob.QUEUED, ServiceJob.RUNNING):
+					continue
+				total = total if total is not None else job.total
+				if (job.status, job.stage, job.frames, job.total) == (ServiceJob.RUNNING, stage, frames, total):
+					continue
+				job.status = ServiceJob.RUNNING
+				job.stage = stage
+				job.frames = frames
+				job.total = total
+				job.version += 1
+				self.lock.notify_all()
+
+	def finish(self, job:ServiceJob, future) -> None:
+		try:
+			result = future.result()
+		except Exception as e:
+			result = {"status": "error", "error": str(e)}
+		with self.lock:
+			job.finished = time.time()
+			if job.video_path in self.uploads:
+				self.uploads[job.video_path] = job.finished
+			job.cached = bool(result.get("cached"))
+			job.resources = result.get("resources")
+			job.status = ServiceJob.DONE if result["status"] == "done" else ServiceJob.ERROR
+			job.error = result.get("error")
+			job.stage = None
+			if job.status == ServiceJob.DONE and job.total:
+				job.frames = job.total
+			job.version += 1
+			self.lock.notify_all()
+
+	def get(self, job_id:str) -> ServiceJob:
+		with self.lock:
+			return self.by_id.get(job_id)
+
+	def describe(self, job:ServiceJob) -> dict:
+		with self.lock:
+			return job.describe()
+
+	def wait(self, job:ServiceJob, version:int, timeout:float) -> tuple:
+		"""
+		Waits until the job changes after version, or until the timeout.
+
+		Return:
+			(version, description) of the job at that point.
+		"""
+		with self.lock:
+			self.lock.wait_for(lambda: job.version != version, timeout)
+			return job.version, job.describe()
+
+	def close(self) -> None:
+		for pool in self.pools.values():
+			pool.shutdown(wait=True, cancel_futures=True)
+		self.progress.put(None)
+		self.listener.join()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+	"""
+	The HTTP API of a JobService:
+
+		POST /jobs                   {"path": "...", "format": "wav"}, or the video itself as the body with
+		                             the format and its file name in the query (?format=wav&name=clip.mp4)
+		GET  /jobs/<id>              the state of a job
+		GET  /jobs/<id>/events       a text/event-stream of the state of the job until it ends
+		GET  /jobs/<id>/result       the generated file
+	"""
+	service = None
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args) -> None:
+		# requests are many and short, errors are still reported
+		pass
+
+	def send_json(self, status:int, body:dict, headers:dict = None) -> None:
+		data = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(data)
+
+	def route(self) -> tuple:
+		url = urlparse(self.path)
+		parts = [part for part in url.path.split("/") if part]
+		return parts, {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+	def do_POST(self) -> None:
+		parts, query = self.route()
+		if parts != ["jobs"]:
+			return self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+		length = int(self.headers.get("Content-Length", 0))
+		try:
+			if self.headers.get("Content-Type", "").startswith("application/json"):
+				request = json.loads(self.rfile.read(length))
+				video_path = request["path"]
+				output_format = request.get("format", "wav")
+			else:
+				video_path = self.service.upload(self.rfile, length, query.get("name"))
+				output_format = query.get("format", "wav")
+			job, created = self.service.submit(video_path, output_format)
+		except (KeyError, ValueError, OSError) as e:
+			return self.send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+		if job is None:
+			return self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": "too many pending jobs"}, {"Retry-After": "1"})
+		self.send_json(HTTPStatus.ACCEPTED if created else HTTPStatus.OK, self.service.describe(job),
+			{"Location": f"/jobs/{job.id}"})
+
+	def do_GET(self) -> None:
+		parts, query = self.route()
+		job = self.service.get(parts[1]) if len(parts) >= 2 and parts[0] == "jobs" else None
+		if job is None:
+			return self.send_json(HTTPStatus.NOT_FOUND, {"error": "no such job"})
+		if len(parts) == 2:
+			return self.send_json(HTTPStatus.OK, self.service.describe(job))
+		if parts[2:] == ["events"]:
+			return self.stream_events(job)
+		if parts[2:] == ["result"]:
+			return self.send_result(job)
+		self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+	def stream_events(self, job:ServiceJob) -> None:
+		self.send_response(HTTPStatus.OK)
+		self.send_header("Content-Type", "text/event-stream")
+		self.send_header("Cache-Control", "no-cache")
+		# the stream ends with the job, the connection isn't reused
+		self.send_header("Connection", "close")
+		self.end_headers()
+		self.close_connection = True
+		version = None
+		while True:
+			version, description = self.service.wait(job, version, timeout=15.0)
+			try:
+				self.wfile.write(f"data: {json.dumps(description)}\n\n".encode())
+				self.wfile.flush()
+			except OSError:
+				return
+			if description["status"] in (ServiceJob.DONE, ServiceJob.ERROR):
+				return
+
+	def send_result(self, job:ServiceJob) -> None:
+		description = self.service.describe(job)
+		if description["status"] != ServiceJob.DONE:
+			return self.send_json(HTTPStatus.CONFLICT, description)
+		try:
+			f = open(job.output_path, "rb")
+		except FileNotFoundError:
+			return self.send_json(HTTPStatus.GONE, {"error": "the result was removed"})
+		with f:
+			self.send_response(HTTPStatus.OK)
+			self.send_header("Content-Type", CONTENT_TYPES[job.output_format])
+			self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+			self.send_header("Content-Disposition",
+				f"attachment; filename=\"{os.path.splitext(os.path.basename(job.video_path))[0]}.{job.output_format}\"")
+			self.end_headers()
+			shutil.copyfileobj(f, self.wfile)
+
+
+def serve(service:JobService, port:int = 8765) -> ThreadingHTTPServer:
+	"""
+	Return:
+		A server for the service on localhost, started with serve_forever(). Port 0 picks a free port.
+	"""
+	handler = type("Handler", (ServiceHandler,), {"service": service})
+	server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+	server.daemon_threads = True
+	return server
+
+
+def main(argv=None) -> int:
+	parser = argparse.ArgumentParser(description="Serve Atmosvideo soundtrack generation over HTTP on localhost.")
+	parser.add_argument("-p", "--port", type=int, default=8765, help="port on 127.0.0.1")
+	parser.add_argument("--cache-dir", default="service_cache", help="directory of the caches, uploads and results")
+	parser.add_argument("-j", "--jobs", type=int, default=max(os.cpu_count() // 2, 1), help="worker processes per pool")
+	parser.add_argument("--max-pending", type=int, default=64, help="jobs queued or running above which requests are refused")
+	parser.add_argument("-r", "--sample-rate", type=int, help="sample rate of the audio, by default the one of the quality")
+	parser.add_argument("-q", "--quality", choices=QUALITIES, default="final", help="render tier")
+	parser.add_argument("--seed", type=int, default=0, help="seed of the music")
+	parser.add_argument("--profile", default="default", help="mapping profile, a built-in name or the path of a JSON profile")
+	parser.add_argument("--render-cache-size", type=int, default=RENDER_CACHE_BYTES // 1024**2,
+		help="MB of finished renders kept in the cache directory")
+	args = parser.parse_args(argv)
+
+	service = JobService(args.cache_dir, args.jobs, args.max_pending, args.sample_rate, args.quality, args.seed, args.profile,
+		args.render_cache_size * 1024**2)
+	server = serve(service, args.port)
+	print(f"Serving on http://127.0.0.1:{server.server_address[1]}")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		service.close()
+	return 0
+
+
+if __name__ == "__main__":
+	raise SystemExit(main())
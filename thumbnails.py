@@ -0,0 +1,128 @@
+import os
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import customtkinter
+from PIL import Image
+
+
+def thumbnail_path(thumbnails_dir, video_path):
+    return os.path.join(thumbnails_dir, f"{os.path.splitext(os.path.basename(video_path))[0]}.jpg")
+
+
+def create_thumbnail(video_path, path):
+    """
+    Saves the first frame of the video as its thumbnail.
+
+    Return:
+        True if the thumbnail was written.
+    """
+    import cv2
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    video_capture = cv2.VideoCapture(video_path)
+    success, frame = video_capture.read()
+    video_capture.release()
+    if not success:
+        print(f"Failed to extract thumbnail for {os.path.basename(video_path)}")
+        return False
+    cv2.imwrite(path, frame)
+    return True
+
+
+class ThumbnailCache:
+    """
+    Loads video thumbnails on a background pool and keeps the most recently used ones as sized CTkImages.
+
+    Missing thumbnails are created from the first frame of the video when they are first requested.
+    Loaded images are handed back through a queue, so drain() and the widgets using the images
+    are only ever called from tkinter's thread.
+    """
+    def __init__(self, thumbnails_dir, size=(128, 72), capacity=256, workers=2):
+        """
+        Args:
+            thumbnails_dir (str): The directory where the thumbnails are stored.
+            size (tuple): The size of the images given to the widgets.
+            capacity (int): The maximum number of images kept in memory.
+            workers (int): The number of threads decoding and creating thumbnails.
+        """
+        self.thumbnails_dir = thumbnails_dir
+        self.size = size
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.failed = set()
+        self.results = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+
+    def get(self, video_path):
+        """
+        Return:
+            The CTkImage of the video if it is loaded, otherwise None.
+        """
+        image = self.cache.get(video_path)
+        if image is not None:
+            self.cache.move_to_end(video_path)
+        return image
+
+    def request(self, video_path):
+        """
+        Starts loading the thumbnail of the video in the background, unless it is loaded or loading already.
+        """
+        if video_path in self.cache or video_path in self.pending or video_path in self.failed:
+            return
+        self.pending[video_path] = self.pool.submit(self.load, video_path)
+
+    def retain(self, video_paths):
+        """
+        Cancels the requests that haven't started for videos not in video_paths, e.g. rows scrolled out of view.
+        """
+        for video_path, future in list(self.pending.items()):
+            if video_path not in video_paths and future.cancel():
+                del self.pending[video_path]
+
+    def load(self, video_path):
+        # runs on the pool
+        path = thumbnail_path(self.thumbnails_dir, video_path)
+        image = None
+        try:
+            if os.path.exists(path) or create_thumbnail(video_path, path):
+                image = Image.open(path)
+                # lets the jpeg decoder skip most of the pixels
+                image.draft("RGB", (self.size[0] * 2, self.size[1] * 2))
+                image = image.convert("RGB").resize(self.size, Image.BILINEAR)
+        except OSError as e:
+            print(f"Failed to load thumbnail {path}: {e}")
+            image = None
+        self.results.put((video_path, image))
+
+    def drain(self):
+        """
+        Turns the images loaded since the last call into CTkImages.
+
+        Return:
+            The set of videos whose thumbnail became available.
+        """
+        loaded = set()
+        while True:
+            try:
+                video_path, image = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.pop(video_path, None)
+            if image is None:
+                self.failed.add(video_path)
+                continue
+            self.cache[video_path] = customtkinter.CTkImage(image, size=self.size)
+            self.cache.move_to_end(video_path)
+            loaded.add(video_path)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+        return loaded
+
+    def forget(self, video_path):
+        self.cache.pop(video_path, None)
+        self.failed.discard(video_path)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,197 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+
+
+# A property timeline file: the per frame values extracted from a video, readable in any range
+# through a memory map so even a day long video never has to be loaded whole.
+#
+#   offset 0            fixed header, little endian (HEADER below):
+#                         magic "ATMOSTL\0", version (u32), channels (u32), block size in frames (u32),
+#                         data offset (u32), frames written (u64), fps (f64)
+#   offset 40           JSON {"channels": [names], "params": {extractor settings}}, zero padded up to the data offset
+#   data offset         blocks of float32[channels][block size], the last one padded with zeros
+#
+# Frame f of channel c is at data offset + 4 * ((f // B * C + c) * B + f % B). The blocks let the file
+# be written as frames arrive, without knowing their number, while a single channel of a range
+# is still read from a few contiguous runs. The frame count is updated after the data it covers,
+# so a file being written can be read up to its last flushed frame.
+MAGIC = b"ATMOSTL\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIQd")
+FRAMES_OFFSET = 24
+ALIGNMENT = 4096
+BLOCK_SIZE = 4096
+# the colors, then the motion features of the optical flow, see VideoPropertiesExtractor.join_flow()
+CHANNELS = ("energy", "hue", "saturation", "value", "direction", "center", "pan", "coverage")
+
+
+class TimelineWriter():
+	"""
+	Writes a timeline file frame by frame. The file only appears at path once close() is called,
+	until then it is written to a ".part" file of its own next to it, so several writers of the
+	same timeline (e.g. the background pre-analysis and a generation) don't write over each other.
+	"""
+
+	def __init__(self, path:str, fps:float, params:dict = None, channels:tuple = CHANNELS, block_size:int = BLOCK_SIZE) -> None:
+		"""
+		Args:
+			path (str): Where the timeline is written.
+			fps (float): The frame rate of the video.
+			params (dict): The settings of the extractor, stored with the values.
+			channels (tuple): The names of the values of a frame, energy, hue, saturation and value
+				first, optionally followed by extra channels.
+			block_size (int): The number of frames per block.
+		"""
+		self.path = path
+		self.tmp_path = f"{path}.{os.getpid()}.{id(self):x}.part"
+		self.fps = fps
+		self.channels = tuple(channels)
+		self.block_size = block_size
+		self.frames = 0
+		self.flushed = 0
+		self.block = np.zeros((len(self.channels), block_size), dtype=np.float32)
+
+		meta = json.dumps({"channels": self.channels, "params": params or {}}).encode()
+		self.data_offset = -(-(HEADER.size + len(meta)) // ALIGNMENT) * ALIGNMENT
+		self.file = open(self.tmp_path, "wb")
+		self.file.write(HEADER.pack(MAGIC, VERSION, len(self.channels), block_size, self.data_offset, 0, fps))
+		self.file.write(meta.ljust(self.data_offset - HEADER.size, b"\0"))
+
+	def append(self, values:tuple) -> None:
+		"""
+		Adds the values of the next frame, in the order of the channels.
+		"""
+		i = self.frames % self.block_size
+		self.block[:, i] = values
+		self.frames += 1
+		if i == self.block_size - 1:
+			self.flush()
+			self.block[:] = 0
+
+	def flush(self) -> None:
+		"""
+		Writes the frames appended so far, making them visible to readers of the partial file.
+		A partial block is written again once it fills up.
+		"""
+		if self.frames == self.flushed:
+			return
+		block = (self.frames - 1) // self.block_size
+		self.file.seek(self.data_offset + block * self.block.nbytes)
+		self.file.write(self.block.tobytes())
+		self.file.flush()
+		self.file.seek(FRAMES_OFFSET)
+		self.file.write(struct.pack("<Q", self.frames))
+		self.file.flush()
+		self.flushed = self.frames
+
+	def close(self) -> None:
+		"""
+		Completes the file and moves it to its path.
+		"""
+		self.flush()
+		self.file.close()
+		os.replace(self.tmp_path, self.path)
+
+	def abort(self) -> None:
+		if not self.file.closed:
+			self.file.close()
+		if os.path.exists(self.tmp_path):
+			os.remove(self.tmp_path)
+
+
+class Timeline():
+	"""
+	A timeline file opened as a memory map. Only the pages of the ranges and channels read are loaded.
+
+	Indexing with a frame or a slice of frames returns their values as a (frames, channels) array,
+	and iterating goes over the rows a block at a time, so a Timeline can be used where a
+	(frames, channels) array of the values is expected.
+	"""
+
+	def __init__(self, path:str) -> None:
+		self.path = path
+		with open(path, "rb") as f:
+			header = f.read(HEADER.size)
+			magic, version, n_channels, self.block_size, data_offset, self.frames, self.fps = HEADER.unpack(header)
+			if magic != MAGIC or version != VERSION:
+				raise ValueError(f"\"{path}\" is not a version {VERSION} timeline file")
+			meta = json.loads(f.read(data_offset - HEADER.size).rstrip(b"\0"))
+		self.channels = tuple(meta["channels"])
+		self.params = meta["params"]
+		n_blocks = -(-self.frames // self.block_size)
+		self.blocks = np.memmap(path, dtype=np.float32, mode="r", offset=data_offset,
+			shape=(n_blocks, n_channels, self.block_size)) if n_blocks else np.zeros((0, n_channels, self.block_size), np.float32)
+
+	def __len__(self) -> int:
+		return self.frames
+
+	@property
+	def duration(self) -> float:
+		return self.frames / self.fps
+
+	def read(self, start:int = 0, stop:int = None, channels:tuple = None) -> np.ndarray:
+		"""
+		Args:
+			start, stop (int): The range of frames, clipped to the frames in the file.
+			channels (tuple): The names of the channels to read, all of them by default.
+
+		Return:
+			A (frames, channels) float32 array.
+		"""
+		stop = self.frames if stop is None else min(stop, self.frames)
+		start = min(max(start, 0), stop)
+		columns = slice(None) if channels is None else [self.channels.index(name) for name in channels]
+		first_block = start // self.block_size
+		last_block = -(-stop // self.block_size)
+		values = self.blocks[first_block:last_block, columns, :]
+		values = values.transpose(0, 2, 1).reshape(-1, values.shape[1])
+		offset = first_block * self.block_size
+		return np.array(values[start - offset:stop - offset])
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			start, stop, step = index.indices(self.frames)
+			return self.read(start, stop)[::step]
+		if index < 0:
+			index += self.frames
+		if not 0 <= index < self.frames:
+			raise IndexError("timeline frame out of range")
+		return self.read(index, index + 1)[0]
+
+	def __array__(self, dtype=None, copy=None):
+		# the whole timeline, for the numpy functions taking arrays
+		values = self.read()
+		return values if dtype is None else values.astype(dtype)
+
+	def __iter__(self):
+		for start in range(0, self.frames, self.block_size):
+			yield from self.read(start, start + self.block_size)
+
+	def envelope(self, points:int, channel:str = "energy") -> np.ndarray:
+		"""
+		Return:
+			The maximum of a channel over points equal spans of the timeline, e.g. to draw it along
+			a progress bar. Only that channel is read.
+		"""
+		points = max(min(points, self.frames), 1)
+		c = self.channels.index(channel)
+		peaks = np.zeros(points, dtype=np.float32)
+		edges = np.linspace(0, self.frames, points + 1).astype(np.int64)
+		for start in range(0, self.frames, self.block_size):
+			values = np.asarray(self.blocks[start // self.block_size, c, :min(self.block_size, self.frames - start)])
+			# the spans overlapping this block, each frame is read once
+			first = np.searchsorted(edges, start, side="right") - 1
+			last = np.searchsorted(edges, start + len(values), side="left")
+			for i in range(first, last):
+				span = values[max(edges[i] - start, 0):edges[i + 1] - start]
+				if len(span):
+					peaks[i] = max(peaks[i], span.max())
+		return peaks
+
+	def close(self) -> None:
+		# the map is closed once nothing refers to it, the arrays returned by read() are copies
+		self.blocks = None
@@ -1,11 +1,51 @@
 import cv2
 import numpy as np
-from threading import Thread
-import time
 import colorsys
+import itertools
+import math
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
-
+from component_timer import ComponentTimer
+
+
+
+# tiles of the optical flow are at least this many pixels wide and high, without their halo
+MIN_TILE = 64
+# tiles scheduled per worker, the ones finishing first take over the rest of the frame
+TILES_PER_WORKER = 2
+# flow magnitude, in pixels per frame at the height the extractor was created with, from which a pixel counts as moving
+MOVING_THRESHOLD = 0.5
+# the flow magnitude grows with the analysis height as height ** HEIGHT_EXPONENT, fitted on the mean energy
+# of earth1 and windmill1 at heights 45 to 180 (0.74 to 0.84). Less than linear, as the frames have to be
+# smoothed to a lower height; footage dominated by grain or by motion beyond the reach of the flow departs from it.
+HEIGHT_EXPONENT = 0.8
+
+
+def plan_tiles(width:int, height:int, workers:int, halo:int = 16, min_tile:int = MIN_TILE) -> list:
+	"""
+	Splits a frame into a grid of tiles for the optical flow, close to square and as many as
+	workers * TILES_PER_WORKER allows without going under min_tile, or one tile for a single worker. Every tile is extended by halo
+	pixels on each side, within the frame, so the flow of its interior sees the motion around it.
+
+	Return:
+		A list of (padded, interior) with padded the (y0, y1, x0, x1) of the tile in the frame and interior
+		the (y0, y1, x0, x1) of the pixels it accounts for, relative to padded. The largest tiles come first.
+	"""
+	# a single worker has nothing to balance, and the untiled flow is the most accurate
+	target = workers * TILES_PER_WORKER if workers > 1 else 1
+	cols = max(1, min(width // min_tile, round(math.sqrt(target * width / height))))
+	rows = max(1, min(height // min_tile, math.ceil(target / cols)))
+	xs = [width * i // cols for i in range(cols + 1)]
+	ys = [height * i // rows for i in range(rows + 1)]
+	tiles = []
+	for y0, y1 in zip(ys, ys[1:]):
+		for x0, x1 in zip(xs, xs[1:]):
+			py0, py1 = max(y0 - halo, 0), min(y1 + halo, height)
+			px0, px1 = max(x0 - halo, 0), min(x1 + halo, width)
+			tiles.append(((py0, py1, px0, px1), (y0 - py0, y1 - py0, x0 - px0, x1 - px0)))
+	tiles.sort(key=lambda tile: (tile[0][1] - tile[0][0]) * (tile[0][3] - tile[0][2]), reverse=True)
+	return tiles
 
 
 
@@ -18,29 +58,79 @@ class VideoPropertiesExtractor:
 	CANCELED = 4
 
 
-	def __init__(self, height:int = 180) -> None:
+	def __init__(self, height:int = 180, timer:ComponentTimer = None, halo:int = None) -> None:
 		"""
 		Creates an object for video properties extraction, and initializes its functionality.
 
 		Args:
-			video_path (str): The path of the video stream.
 			height (int): The height which the video will be resized to.
+			timer (ComponentTimer): Timer for the extraction stages, none are timed if not given.
+			halo (int): The pixels of context added around every tile of the optical flow, by default
+				enough for the reach of the flow pyramid, see tile_halo().
 		"""
 		self.status = VideoPropertiesExtractor.DISCONNECTED
 		self.capture = None
 		self.frame_count = 0
 		self.height = height
+		# the energy stays on the scale of this height when configure() changes the height
+		self.base_height = height
 		self.width = 0
 		self.prev_frame = None
 		self.next_frame = None
 		self.prev_gray = None
 		self.next_gray = None
 		self.n_threads = multiprocessing.cpu_count()
-		#self.timer = ComponentTimer()
-		#self.th_length = self.width // self.n_threads
+		self.halo = halo
+		self.tiles = []
+		self.tile_centers = []
+		# started on the first frame and kept for the following ones
+		self.pool = None
+		self.timer = timer if timer else ComponentTimer(enabled=False)
+		self.timeline = None
+		# the analysis settings a governor can lower, see configure()
+		self.levels = 3
+		self.iterations = 3
+		self.stride = 1
+		self.skipped = 0
+		self.values = None
+		self.source_size = None
+		# a live source, see load_stream(), and the sequence number of its frame held in next_frame
+		self.live = False
+		self.sequence = 0
+		# source frames between the frame held in next_frame and the one before it, 1 unless a live source dropped some
+		self.next_advance = 1
+		# source frames between prev_gray and the last frame consumed, more than 1 when a live source dropped some
+		self.span = 0
+		# the source frames the last step() moved past and the time its frame was captured, None for files
+		self.advance = 1
+		self.captured = None
+		self.next_captured = None
 	
+	def params(self) -> dict:
+		"""
+		Return:
+			The settings that change the extracted values, used to key cached features.
+		"""
+		return {"version": 4, "height": self.height, "levels": self.levels, "iterations": self.iterations, "stride": self.stride}
+
+
+	def record(self, timeline:"TimelineWriter") -> None:
+		"""
+		Appends the values of every frame analysed from now on to a timeline file, None stops recording.
+		Meant for sequential extraction, seek() stops recording as the frames would no longer follow each other.
+		"""
+		self.timeline = timeline
+
+
 	def load(self, video_path:str) -> None:
+		self.release()
 		self.status = VideoPropertiesExtractor.RUNNING
+		self.skipped = 0
+		self.span = 0
+		self.values = None
+		self.live = False
+		self.next_advance = 1
+		self.next_captured = None
 		
 		self.capture = cv2.VideoCapture(video_path)
 		if not self.capture.isOpened():
@@ -52,7 +142,7 @@ class VideoPropertiesExtractor:
 		self.fps = self.capture.get(cv2.CAP_PROP_FPS)
 		cap_width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
 		cap_height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
-		self.width = int(self.height * cap_width / cap_height)
+		self.set_size(cap_width, cap_height)
 
 		
 		self.capture_frame()
@@ -60,10 +150,138 @@ class VideoPropertiesExtractor:
 		self.prev_gray = self.next_gray
 		self.capture_frame()
 
-		# thread constants
-		self.th_length = self.width // self.n_threads
-		
+
+	def load_stream(self, grabber:"FrameGrabber") -> None:
+		"""
+		Analyses a source with no known length, e.g. a camera, a pipe or a network stream, read by a
+		started FrameGrabber. Every step() reads the newest frame, waiting for one if needed, those
+		that arrived since the last step are dropped and the energy is spread over them. frame_count stays 0 and the
+		extraction finishes when the source ends.
+		"""
+		self.release()
+		self.status = VideoPropertiesExtractor.RUNNING
+		self.skipped = 0
+		self.span = 0
+		self.values = None
+		self.live = True
+		self.sequence = 0
+		self.capture = grabber
+		self.frame_count = 0
+		self.fps = grabber.fps
+		self.set_size(*grabber.size)
+
+		self.capture_frame()
+		self.prev_frame = self.next_frame
+		self.prev_gray = self.next_gray
+
 	
+	def set_size(self, cap_width:int, cap_height:int) -> None:
+		"""
+		Sets the analysis width from the size of the source, keeping its aspect ratio.
+		"""
+		self.source_size = (cap_width, cap_height)
+		self.width = int(self.height * cap_width / cap_height)
+		self.tiles = plan_tiles(self.width, self.height, self.n_threads, self.tile_halo())
+		self.tile_centers = [self.center_of(tile) for tile in self.tiles]
+
+
+	def center_of(self, tile:tuple) -> tuple:
+		"""
+		Return:
+			The slices of the interior of a tile within the center of the frame, its middle half in both
+			directions, or None if they don't overlap.
+		"""
+		(y0, _, x0, _), (iy0, iy1, ix0, ix1) = tile
+		cy0, cy1 = self.height // 4, self.height - self.height // 4
+		cx0, cx1 = self.width // 4, self.width - self.width // 4
+		top, bottom = max(y0 + iy0, cy0), min(y0 + iy1, cy1)
+		left, right = max(x0 + ix0, cx0), min(x0 + ix1, cx1)
+		if top >= bottom or left >= right:
+			return None
+		return slice(top - y0 - iy0, bottom - y0 - iy0), slice(left - x0 - ix0, right - x0 - ix0)
+
+
+	def tile_halo(self) -> int:
+		"""
+		Return:
+			The halo of the flow tiles. The window of the flow covers twice as many pixels at every pyramid
+			level, with a narrower halo the energy of a tile's interior differs from the untiled flow.
+		"""
+		return self.halo if self.halo is not None else 6 * 2 ** (self.levels - 1)
+
+
+	def configure(self, height:int = None, levels:int = None, iterations:int = None, stride:int = None) -> None:
+		"""
+		Changes the cost of the analysis, also in the middle of a video. The energy is brought back
+		to the scale of the height the extractor was created with, see height_scale(), which holds
+		for the mean energy of most footage but not for every clip: the levels, iterations and
+		stride change it much less.
+
+		Args:
+			height (int): The height the frames are resized to.
+			levels (int): The number of pyramid levels of the optical flow.
+			iterations (int): The iterations of the optical flow at every level.
+			stride (int): Analyse one frame out of stride, the others repeat the last values.
+		"""
+		if levels is not None and levels != self.levels:
+			self.levels = levels
+			if self.source_size is not None and (height is None or height == self.height):
+				self.set_size(*self.source_size)
+		if iterations is not None:
+			self.iterations = iterations
+		if stride is not None:
+			self.stride = stride
+		if height is not None and height != self.height:
+			self.height = height
+			if self.source_size is not None:
+				self.set_size(*self.source_size)
+			# the frames already captured are brought to the new size, so the flow continues
+			size = (self.width, self.height)
+			if self.next_frame is not None:
+				self.next_frame = cv2.resize(self.next_frame, size, interpolation=cv2.INTER_AREA)
+				self.next_gray = cv2.resize(self.next_gray, size, interpolation=cv2.INTER_AREA)
+			if self.prev_gray is not None:
+				self.prev_gray = cv2.resize(self.prev_gray, size, interpolation=cv2.INTER_AREA)
+
+
+	def height_scale(self) -> float:
+		"""
+		Return:
+			The factor bringing flow magnitudes at the analysis height to the height the extractor was created with.
+		"""
+		return (self.base_height / self.height) ** HEIGHT_EXPONENT
+
+
+	def seek(self, frame:int) -> None:
+		"""
+		Moves the stream so the next step() analyses the given frame.
+		"""
+		self.status = VideoPropertiesExtractor.RUNNING
+		self.timeline = None
+		self.skipped = 0
+		self.span = 0
+		self.values = None
+		self.capture.set(cv2.CAP_PROP_POS_FRAMES, max(frame - 1, 0))
+		self.capture_frame()
+		self.prev_frame = self.next_frame
+		self.prev_gray = self.next_gray
+		if frame > 0:
+			self.capture_frame()
+
+
+	def release(self) -> None:
+		"""
+		Closes the video stream and stops the flow threads. A running extraction is marked as canceled.
+		"""
+		if self.status == VideoPropertiesExtractor.RUNNING:
+			self.status = VideoPropertiesExtractor.CANCELED
+		if self.capture is not None:
+			self.capture.release()
+			self.capture = None
+		if self.pool is not None:
+			self.pool.shutdown(wait=True)
+			self.pool = None
+
 
 	def capture_frame(self) -> bool:
 		"""
@@ -73,12 +291,20 @@ class VideoPropertiesExtractor:
 			frame: the next resized frame in color
 			gray: the next resized frame in grayscale
 		"""
+		self.timer.start("decode")
 		success, frame = self.capture.read()
+		self.timer.time("decode")
 		if not success:
 			self.status = VideoPropertiesExtractor.FINISHED
 			return False
+		if self.live:
+			self.next_advance = self.capture.sequence - self.sequence
+			self.sequence = self.capture.sequence
+			self.next_captured = self.capture.captured
+		self.timer.start("resize")
 		self.next_frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
 		self.next_gray = cv2.cvtColor(self.next_frame, cv2.COLOR_BGR2GRAY)
+		self.timer.time("resize")
 		#print(f"Capture: w({len(self.next_gray[0])}), h({len(self.next_gray)})")
 		return True
 	
@@ -95,102 +321,179 @@ class VideoPropertiesExtractor:
 		"""
 		if self.status != VideoPropertiesExtractor.RUNNING:
 			return None
+		# a live source is read when its frame is needed, the newest one by then
+		if self.live and not self.capture_frame():
+			return False
+		if self.values is not None and self.skipped < self.stride - 1:
+			return self.skip()
 		
-		n_threads = self.n_threads
 		frame = self.next_frame
 		gray = self.next_gray
+		self.consume()
 
-		threads = [None] * n_threads
-		energy = [0.0] * n_threads
-
-		#self.timer.start("th_create")
-		for i in range(n_threads):
-			threads[i] = Thread(target=self.th_energy, args=(gray, self.prev_gray, self.width, self.th_length, energy, i))
-			threads[i].start()
-		#self.timer.time("th_create")
-		#self.timer.start("th_main")
+		self.timer.start("flow")
+		threads, flows = self.start_energy(gray, self.prev_gray)
 
-		h, s, v = colorsys.rgb_to_hsv(
-			frame[:,:,2].mean()/255.0,
-			frame[:,:,1].mean()/255.0,
-			frame[:,:,0].mean()/255.0
-			)
-		self.capture_frame()
+		self.timer.start("color")
+		h, s, v = self.color_stats(frame)
+		self.timer.time("color")
+		if not self.live:
+			self.capture_frame()
 
 		self.prev_frame = frame
 		self.prev_gray = gray
 
-		#self.timer.time("th_main")
-		#self.timer.start("join")
-		for i in range(n_threads):
-			threads[i].join()
-		#self.timer.time("join")
+		self.timer.start("join")
+		energy, direction, center, pan, coverage = self.join_flow(threads, flows)
+		self.timer.time("join")
+		self.timer.time("flow")
+		self.skipped = 0
+		self.span = 0
 		
 
-		self.values = min(np.mean(energy) * 1.2, 1.0), h, s, v
+		self.values = energy, h, s, v, direction, center, pan, coverage
+		if self.timeline is not None:
+			self.timeline.append(self.values)
 
 		return self.status == VideoPropertiesExtractor.RUNNING
-	
 
-	def th_energy(self, gray, prev_gray, width, length, energy, i):
-		"""
-		Calculate the energy from the previous frame and the current frame.
 
-		Args:
-			gray: The current frame in grayscale.
-			prev_gray: The previous frame in grayscale.
-			width: The width of the frame.
-			length: The amount of columns of the frame to be processed by the thread
-			energy: An array of floats where the result will be written in energy[i]
-			i: The number of the thread
+	def skip(self) -> bool:
+		"""
+		Moves past the next frame without analysing it, its values are those of the last frame analysed.
+		The skipped frame becomes the previous frame of the next one, so the motion is still measured
+		between neighbouring frames: over more frames the flow misses fast and fine motion.
 		"""
-		#name = "th" + str(i)
-		#self.timer.start(name)
-		start = length * i
-		end = start+length if i != self.n_threads-1 else width-1
+		self.consume()
+		self.prev_frame = self.next_frame
+		self.prev_gray = self.next_gray
+		# only the frames dropped by a live source before the next one are spanned
+		self.span = 0
+		if not self.live:
+			self.timer.start("skip")
+			self.capture_frame()
+			self.timer.time("skip")
+		self.skipped += 1
+		if self.timeline is not None:
+			self.timeline.append(self.values)
+		return self.status == VideoPropertiesExtractor.RUNNING
 
-		# Calculate optical flow using Lucas-Kanade method
-		flow = cv2.calcOpticalFlowFarneback(prev_gray[:,start:end], gray[:,start:end], None, 0.5, 3, 15, 3, 5, 1.2, 0)
-		# Calculate the energy as the average of the magnitude of the flow vectors
-		energy[i] = np.mean(np.sqrt(flow[..., 0]**2 + flow[..., 1]**2))
-		#energy[i] = np.mean(abs(flow[..., 0]) + abs(flow[..., 1]))
-		#self.timer.time(name)
 
+	def consume(self) -> None:
+		"""
+		Accounts for the frame held in next_frame before it is analysed or skipped.
+		"""
+		self.span += self.next_advance
+		self.advance = self.next_advance
+		self.captured = self.next_captured
 
 
+	def start_energy(self, gray, prev_gray) -> tuple:
+		"""
+		Starts calculating the energy between two frames on the flow pool, tile by tile.
 
+		Return:
+			workers: the running workers, to be given to join_flow
+			sums: the list where the flow statistics of every tile are written, see flow_stats()
+		"""
+		if self.pool is None:
+			self.pool = ThreadPoolExecutor(max_workers=self.n_threads, thread_name_prefix="flow")
+		sums = [(0.0, 0.0, 0.0, 0.0, 0)] * len(self.tiles)
+		# shared by the workers, each takes the next tile left as soon as it is done with one
+		next_tile = itertools.count()
+		workers = [self.pool.submit(self.th_energy, gray, prev_gray, next_tile, sums, i)
+			for i in range(min(self.n_threads, len(self.tiles)))]
+		return workers, sums
 
-# class to time specific parts of the code
-class ComponentTimer():
-	def __init__(self) -> None:
-		self.component = {}
-		self.start_time = {}
-	
 
-	def start(self, component = "__default__") -> None:
-		self.start_time[component] = time.time_ns()
+	def join_energy(self, workers:list, sums:list) -> float:
+		"""
+		Waits for the energy workers and combines their results into the normalized frame energy.
+		"""
+		return self.join_flow(workers, sums)[0]
 
 
-	def time(self, component = "__default__") -> None:
-		new_ts = time.time_ns()
-		if component in self.component.keys():
-			self.component[component] += new_ts - self.start_time[component]
-		else:
-			self.component[component] = new_ts - self.start_time[component]
+	def join_flow(self, workers:list, sums:list) -> tuple:
+		"""
+		Waits for the energy workers and combines their results into the motion of the frame.
 
+		Return:
+			energy: the normalized mean magnitude of the flow
+			direction: the angle of the mean flow, as a fraction of a turn counterclockwise from the right
+			center: the share of the flow magnitude within the center of the frame, 0.25 for an even motion
+			pan: how much of the frame moves together, the magnitude of the mean flow over the mean
+				magnitude times the coverage: close to 1 for a camera pan, low for objects moving
+				in a still frame or their own ways
+			coverage: the fraction of the pixels moving
+		"""
+		for worker in workers:
+			worker.result()
+		magnitude, dx, dy, center, moving = (sum(column) for column in zip(*sums))
+		pixels = self.width * self.height
+		# the flow spans the frames a live source dropped since the last frame consumed
+		energy = min(magnitude / pixels / max(self.span, 1) * self.height_scale() * 1.2, 1.0)
+		if magnitude <= 0:
+			return energy, 0.0, 0.0, 0.0, 0.0
+		# the rows of the frame go down
+		direction = math.atan2(-dy, dx) / (2 * math.pi) % 1.0
+		coverage = moving / pixels
+		return energy, direction, center / magnitude, min(math.hypot(dx, dy) / magnitude, 1.0) * coverage, coverage
+
+
+	@staticmethod
+	def color_stats(frame) -> tuple:
+		"""
+		Calculates the hue, saturation and value of the average color of a BGR frame.
+		"""
+		return colorsys.rgb_to_hsv(
+			frame[:,:,2].mean()/255.0,
+			frame[:,:,1].mean()/255.0,
+			frame[:,:,0].mean()/255.0
+			)
+	
+
+	def th_energy(self, gray, prev_gray, next_tile, sums, i):
+		"""
+		Calculates the optical flow of tiles of the frame until none are left.
 
-	def get_all_components(self) -> dict:
-		return self.component
+		Args:
+			gray: The current frame in grayscale.
+			prev_gray: The previous frame in grayscale.
+			next_tile: The iterator handing out the indices of the tiles, shared by the workers.
+			sums: The list where the flow statistics of the interior of tile t are written in sums[t].
+			i: The number of the worker
+		"""
+		name = "th" + str(i)
+		self.timer.start(name)
+		for t in next_tile:
+			if t >= len(self.tiles):
+				break
+			(y0, y1, x0, x1), (iy0, iy1, ix0, ix1) = self.tiles[t]
+			flow = cv2.calcOpticalFlowFarneback(prev_gray[y0:y1, x0:x1], gray[y0:y1, x0:x1], None, 0.5, self.levels, 15,
+				self.iterations, 5, 1.2, 0)
+			# the halo only gives context, the energy counts the interior
+			sums[t] = self.flow_stats(flow[iy0:iy1, ix0:ix1], self.tile_centers[t], MOVING_THRESHOLD * max(self.span, 1) / self.height_scale())
+		self.timer.time(name)
+
+
+	@staticmethod
+	def flow_stats(flow, center:tuple, threshold:float) -> tuple:
+		"""
+		Sums what join_flow() needs from the flow of a tile, reusing its magnitude for everything.
 
+		Args:
+			flow: The flow of the tile, (height, width, 2).
+			center: The slices of the tile within the center of the frame, or None.
+			threshold (float): The magnitude from which a pixel counts as moving.
 
-	def get(self, component = "__default__") -> int:
-		return self.component[component]
+		Return:
+			The sums of the magnitude, of the horizontal and vertical flow and of the magnitude within
+			the center, and the number of pixels moving.
+		"""
+		magnitude = np.sqrt(flow[..., 0]**2 + flow[..., 1]**2)
+		return (float(magnitude.sum()), float(flow[..., 0].sum()), float(flow[..., 1].sum()),
+			float(magnitude[center].sum()) if center else 0.0, int(np.count_nonzero(magnitude > threshold)))
 
-	def get_sum(self) -> int:
-		sum = 0
-		for _, v in self.component.items():
-			sum += v
-		return sum
 
 
 
@@ -228,7 +531,7 @@ if __name__ == "__main__":
 			i_frame += 1
 			ctimer.start("get_values")
 			running = video_extractor.step()
-			e, h, s, v = video_extractor.values
+			e, h, s, v = video_extractor.values[:4]
 			ctimer.time("get_values")
 
 			lenergy.append(e)